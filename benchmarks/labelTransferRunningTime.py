@@ -0,0 +1,70 @@
+from __future__ import print_function
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2017, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#           http://ilastik.org/license.html
+###############################################################################
+import numpy as np
+
+from lazyflow.utility import Timer
+
+from ilastik.applets.objectClassification.opObjectClassification import OpObjectClassification
+
+
+def randomBoundingBoxes(numObjects, shape, maxSize, seed):
+    """Bounding boxes of numObjects random objects, including the background (index 0)."""
+    rng = np.random.RandomState(seed)
+    mins = rng.randint(0, np.array(shape) - maxSize, size=(numObjects, len(shape)))
+    maxs = mins + rng.randint(1, maxSize, size=(numObjects, len(shape)))
+    mins[0] = 0
+    maxs[0] = np.array(shape) - 1
+    return {"Coord<Minimum>": mins, "Coord<Maximum>": maxs}
+
+
+# Label transfer after a re-threshold: many objects, a few thousand labeled ones
+class LabelTransferTime(object):
+    def __init__(self, numObjects=50000, numLabeled=3000, shape=(2000, 2000, 200), maxSize=20):
+        self.oldBoxes = randomBoundingBoxes(numObjects, shape, maxSize, seed=0)
+
+        # the new segmentation: the old objects, slightly shifted and grown
+        rng = np.random.RandomState(1)
+        shift = rng.randint(-2, 3, size=self.oldBoxes["Coord<Minimum>"].shape)
+        self.newBoxes = {"Coord<Minimum>": np.maximum(self.oldBoxes["Coord<Minimum>"] + shift, 0),
+                         "Coord<Maximum>": self.oldBoxes["Coord<Maximum>"] + shift + 1}
+
+        self.labels = np.zeros((numObjects,))
+        labeled = rng.choice(np.arange(1, numObjects), size=numLabeled, replace=False)
+        self.labels[labeled] = rng.randint(1, 4, size=numLabeled)
+
+    def run(self):
+        print("\nTransferring {} labels between segmentations with {} objects".format(
+            int(np.count_nonzero(self.labels)), self.labels.shape[0]))
+
+        with Timer() as timer:
+            newLabels, oldLost, newLost = OpObjectClassification.transferLabels(
+                self.labels, self.oldBoxes, self.newBoxes)
+
+        print("Label transfer took: {} seconds".format(timer.seconds()))
+        print("Transferred: {}, lost: {}, partially lost: {}, conflicts: {}".format(
+            int(np.count_nonzero(newLabels)), len(oldLost["full"]),
+            len(oldLost["partial"]), len(newLost["conflict"])))
+
+
+if __name__ == '__main__':
+    labelTransferTime = LabelTransferTime()
+    labelTransferTime.run()
@@ -0,0 +1,85 @@
+from __future__ import print_function
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2017, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#           http://ilastik.org/license.html
+###############################################################################
+import numpy as np
+
+from lazyflow.utility import Timer
+
+from ilastik.applets.multicut.opMulticut import AVAILABLE_SOLVER_NAMES, OpMulticutAgglomerator, compute_edge_weights
+
+
+class SyntheticRag(object):
+    """
+    The part of the ilastikrag.Rag interface used by the multicut:
+    cubic superpixels on a regular grid, with edges between neighbours.
+    """
+    def __init__(self, grid, superpixelSize):
+        ids = np.arange(1, np.prod(grid) + 1, dtype=np.uint32).reshape(grid)
+        self.label_img = ids
+        for axis in range(3):
+            self.label_img = self.label_img.repeat(superpixelSize, axis=axis)
+
+        edges = []
+        for axis in range(3):
+            view = np.moveaxis(ids, axis, 0)
+            edges.append(np.stack([view[:-1].ravel(), view[1:].ravel()], axis=1))
+        self.edge_ids = np.sort(np.concatenate(edges), axis=1)
+
+        self.num_edges = len(self.edge_ids)
+        self.max_sp = int(ids.max())
+        self.num_sp = self.max_sp + 1
+
+
+def randomEdgeProbabilities(rag, seed):
+    """Smooth random 'boundaries', so that the optimal segments are larger than single superpixels."""
+    rng = np.random.RandomState(seed)
+    centers = rng.rand(rag.max_sp + 1)
+    return np.clip(np.abs(centers[rag.edge_ids[:, 0]] - centers[rag.edge_ids[:, 1]]) * 2, 0, 1)
+
+
+def energy(rag, edgeWeights, nodeLabels):
+    cut = nodeLabels[rag.edge_ids[:, 0]] != nodeLabels[rag.edge_ids[:, 1]]
+    return edgeWeights[cut].sum()
+
+
+# Multicut of a synthetic RAG with all available solvers
+class MulticutSolverTime(object):
+    def __init__(self, grid=(60, 60, 60), superpixelSize=4, beta=0.5):
+        self.rag = SyntheticRag(grid, superpixelSize)
+        self.edgeProbabilities = randomEdgeProbabilities(self.rag, seed=0)
+        self.beta = beta
+
+    def run(self):
+        print("\nMulticut of a RAG with {} superpixels and {} edges".format(self.rag.max_sp, self.rag.num_edges))
+        weights = compute_edge_weights(self.rag.edge_ids, self.edgeProbabilities, self.beta)
+
+        # exact solvers do not finish on problems of this size
+        for solverName in [name for name in AVAILABLE_SOLVER_NAMES if 'Exact' not in name]:
+            with Timer() as timer:
+                nodeLabels = OpMulticutAgglomerator.agglomerate_with_multicut(
+                    self.rag, self.edgeProbabilities, self.beta, solverName)
+            print("{}: {} seconds, {} segments, energy {}".format(
+                solverName, timer.seconds(), len(np.unique(nodeLabels)), energy(self.rag, weights, nodeLabels)))
+
+
+if __name__ == '__main__':
+    multicutSolverTime = MulticutSolverTime()
+    multicutSolverTime.run()
@@ -290,9 +290,59 @@ class ObjectExtractionTimeComparison(object):
             result[i] = cleanup(res, nobj, features)
 
 
+# Scaling of the local (neighborhood) features with the number of threads
+class LocalFeaturesScaling(object):
+    def __init__(self, numObjects=20000, chunkSize=500):
+        # A single time step with many small objects, which is the case
+        # where only the sharding of the object loop can use several cores
+        side = int(np.ceil(np.sqrt(numObjects))) * 4
+        binary = np.zeros((1, side, side, 1, 1), dtype=np.uint8)
+        binary[0, 1::4, 1::4, 0, 0] = 1
+        binary[0, 2::4, 1::4, 0, 0] = 1
+        binary = vigra.taggedView(binary, 'txyzc')
+        raw = vigra.taggedView(np.random.randint(0, 255, size=binary.shape).astype(np.float32), 'txyzc')
+
+        self.chunkSize = chunkSize
+        self.features = {
+            NAME : {
+                "Count" : {},
+                "Mean" : {},
+                "Mean in neighborhood" : {"margin" : (2, 2, 0)},
+            }
+        }
+
+        g = Graph()
+        self.opLabel = OpLabelVolume(graph=g)
+        self.opLabel.Input.setValue(binary)
+
+        self.opRegionFeatures = OpRegionFeatures(graph=g)
+        self.opRegionFeatures.RawVolume.setValue(raw)
+        self.opRegionFeatures.LabelVolume.connect(self.opLabel.CachedOutput)
+        self.opRegionFeatures.Features.setValue(self.features)
+
+        # compute the label image once, so that only feature computation is timed
+        self.opLabel.CachedOutput[:].wait()
+
+    def run(self, threadCounts=(1, 2, 4, 8)):
+        from ilastik.config import cfg
+        cfg.set('object extraction', 'local_features_chunk_size', str(self.chunkSize))
+
+        print("\nLocal features scaling (chunk size {})".format(self.chunkSize))
+        for numThreads in threadCounts:
+            Request.reset_thread_pool(numThreads)
+            with Timer() as timer:
+                self.opRegionFeatures.Output[0:1].wait()
+            print("{} threads: {} seconds".format(numThreads, timer.seconds()))
+        Request.reset_thread_pool()
+
+
 if __name__ == '__main__':
     
     # Run object extraction comparison
     objectExtractionTimeComparison = ObjectExtractionTimeComparison()
     objectExtractionTimeComparison.run()
 
+    # Run local features scaling
+    localFeaturesScaling = LocalFeaturesScaling()
+    localFeaturesScaling.run()
+
@@ -35,14 +35,18 @@ import os
 import sys
 import re
 import tempfile
+import threading
 import h5py
 import numpy
 import warnings
 import pickle as pickle
+import collections
+from functools import partial
 
 from lazyflow.roi import TinyVector, roiToSlice, sliceToRoi
 from lazyflow.utility import timeLogged
 from lazyflow.slot import OutputSlot
+from lazyflow.request import Request
 
 #######################
 # Convenience methods #
@@ -256,6 +260,14 @@ class SerialSlot(object):
         self._deserialize(group[self.name], self.inslot)
         self.dirty = False
 
+    def deserializeLazily(self, group):
+        """Like deserialize(), but subclasses may defer reading large
+        data until it is first used.  By default, everything is read
+        immediately.
+
+        """
+        self.deserialize(group)
+
     @staticmethod
     def _getValue(subgroup, slot):
         val = subgroup[()]
@@ -377,8 +389,55 @@ class SerialListSlot(SerialSlot):
                 self.inslot.setValue(self._iterable(data))
         self.dirty = False
 
+class _DeferredLoad(object):
+    """Runs a load function just before a set of operators is first
+    used, i.e. on the first call of execute() or setInSlot() of any of
+    them.  Until then, these methods are shadowed by instance attributes,
+    which are removed again once the load is done.
+
+    """
+    _methodNames = ('execute', 'setInSlot')
+
+    def __init__(self, operators, load):
+        self._operators = operators
+        self._load = load
+        self._lock = threading.RLock()
+        self._loading = False
+        self.pending = True
+        for op in operators:
+            for methodName in self._methodNames:
+                setattr(op, methodName, self._wrap(getattr(op, methodName)))
+
+    def _wrap(self, method):
+        def wrapper(*args, **kwargs):
+            self.finish()
+            return method(*args, **kwargs)
+        return wrapper
+
+    def finish(self):
+        """Run the load function, unless it already ran."""
+        with self._lock:
+            # The load function itself writes to the operators.
+            if not self.pending or self._loading:
+                return
+            self._loading = True
+            try:
+                self._load()
+            finally:
+                self._loading = False
+            self.pending = False
+            for op in self._operators:
+                for methodName in self._methodNames:
+                    op.__dict__.pop(methodName, None)
+
 class SerialBlockSlot(SerialSlot):
-    """A slot which only saves nonzero blocks."""
+    """A slot which only saves nonzero blocks.
+
+    The rois reported dirty by each lane are remembered between saves, so
+    an existing group can be updated in place: only blocks that were
+    touched, appeared or disappeared are rewritten.
+
+    """
     def __init__(self, slot, inslot, blockslot, name=None, subname=None,
                  default=None, depends=None, selfdepends=True, shrink_to_bb=False, compression_level=0):
         """
@@ -388,6 +447,15 @@ class SerialBlockSlot(SerialSlot):
 
         """
         assert isinstance(slot, OutputSlot), "slot is of wrong type: '{}' is not an OutputSlot".format( slot.name )
+        # Needed before the base class binds to the slot.
+        # Dirty rois per lane, keyed by id(lane slot)
+        self._dirtyRois = {}
+        # Whether the stored blocks can't be trusted anymore (e.g. lanes
+        # were added or removed, or the data was never saved or loaded).
+        self._allDirty = True
+        # Lanes whose blocks are not read yet (see deserializeLazily),
+        # keyed by id(lane slot)
+        self._deferredLoads = {}
         super(SerialBlockSlot, self).__init__(
             slot, inslot, name, subname, default, depends, selfdepends
         )
@@ -396,6 +464,76 @@ class SerialBlockSlot(SerialSlot):
         self._shrink_to_bb = shrink_to_bb
         self.compression_level = compression_level
 
+    def setDirty(self, *args, **kwargs):
+        # Called for changes without a usable roi.
+        super(SerialBlockSlot, self).setDirty(*args, **kwargs)
+        if not self.ignoreDirty:
+            self._allDirty = True
+
+    def _setRoiDirty(self, slot, roi, *args, **kwargs):
+        if self.ignoreDirty:
+            return
+        self.dirty = True
+        start = getattr(roi, 'start', None)
+        stop = getattr(roi, 'stop', None)
+        if start is None or stop is None:
+            self._allDirty = True
+        else:
+            self._dirtyRois.setdefault(id(slot), []).append(
+                (numpy.asarray(start), numpy.asarray(stop)) )
+
+    def _bind(self, slot=None):
+        slot = maybe(slot, self.slot)
+        if slot.level == 0:
+            super(SerialBlockSlot, self)._bind(slot)
+            return
+
+        def doMulti(slot, index, size):
+            slot[index].notifyDirty(self._setRoiDirty)
+            slot[index].notifyValueChanged(self.setDirty)
+
+        slot.notifyInserted(doMulti)
+        # Lane indexes may shift, so the stored lane groups can't be reused.
+        slot.notifyInserted(self.setDirty)
+        slot.notifyRemoved(self.setDirty)
+
+    @staticmethod
+    def _blockKey(slicing):
+        """Hashable key for a block slicing (or its string representation)."""
+        if isinstance(slicing, (bytes, str)):
+            slicing = stringToSlicing(slicing)
+        return tuple( (s.start, s.stop) for s in slicing )
+
+    @classmethod
+    def _storedBlocks(cls, subgroup):
+        """Map the key of each block stored in subgroup to its name."""
+        stored = {}
+        for blockName, blockData in list(subgroup.items()):
+            attrs = blockData.attrs
+            # Files written before incremental saving only have 'blockSlice',
+            # which differs from the block roi if the block was shrunk.
+            if 'blockRoi' in attrs:
+                stored[cls._blockKey(attrs['blockRoi'])] = blockName
+            elif 'blockSlice' in attrs:
+                stored[cls._blockKey(attrs['blockSlice'])] = blockName
+        return stored
+
+    def _nonZeroSlicings(self, index):
+        slicings = []
+        for slicing in self.blockslot[index].value:
+            if not isinstance(slicing[0], slice):
+                slicing = roiToSlice(*slicing)
+            slicings.append(slicing)
+        return slicings
+
+    def _isBlockDirty(self, index, slicing):
+        start, stop = sliceToRoi( slicing, (0,)*len(slicing) )
+        start, stop = numpy.asarray(start), numpy.asarray(stop)
+        for dirtyStart, dirtyStop in self._dirtyRois.get(id(self.slot[index]), []):
+            if (start < dirtyStop).all() and (dirtyStart < stop).all():
+                return True
+        return False
+
     def shouldSerialize(self, group):
         # Should this be a docstring?
         #
@@ -432,22 +570,132 @@ class SerialBlockSlot(SerialSlot):
             else:
                 logger.debug("Found \"" + subname + "\" from \"" + repr(mygroup) + "\" belonging to BlockSlot \"" + self.name + "\".")
 
-            subgroup = mygroup[subname]
+            if self._isLoadPending(index):
+                # The stored blocks were never read, so they are still current.
+                continue
 
-            nonZeroBlocks = self.blockslot[index].value
-            for blockIndex in range(len(nonZeroBlocks)):
-                blockName = 'block{:04d}'.format(blockIndex)
+            subgroup = mygroup[subname]
 
-                if blockName not in subgroup:
-                    logger.debug("Missing \"" + blockName + "\" from \"" + repr(subgroup) + "\". Should serialize.")
+            # Block names are not contiguous after incremental updates,
+            # so look the blocks up by their roi.
+            storedBlocks = self._storedBlocks(subgroup)
+            for slicing in self._nonZeroSlicings(index):
+                if self._blockKey(slicing) not in storedBlocks:
+                    logger.debug("Missing block \"" + repr(slicing) + "\" from \"" + repr(subgroup) + "\". Should serialize.")
                     return True
-                else:
-                    logger.debug("Found \"" + blockName + "\" from \"" + repr(subgroup) + "\" belonging to BlockSlot \"" + self.name + "\".")
 
         logger.debug("Everything belonging to BlockSlot \"" + self.name + "\" appears to be in order. Should not serialize.")
 
         return False
 
+    def serialize(self, group):
+        """Like SerialSlot.serialize, but updates the existing group in
+        place (see _update) if the dirty rois since the last save or load
+        are known.
+
+        """
+        if not self.shouldSerialize(group):
+            return
+        if self.slot.ready() and self._canUpdate(group):
+            self._update(group[self.name])
+        else:
+            deleteIfPresent(group, self.name)
+            if self.slot.ready():
+                self._serialize(group, self.name, self.slot)
+        self.dirty = False
+        self._allDirty = False
+        self._dirtyRois = {}
+
+    def deserialize(self, group):
+        super(SerialBlockSlot, self).deserialize(group)
+        if self.name in group:
+            # Writing the loaded blocks made the slot dirty, but the file
+            # is in sync with it now.
+            self._allDirty = False
+            self._dirtyRois = {}
+
+    def _canUpdate(self, group):
+        if self._allDirty or self.name not in group:
+            return False
+        mygroup = group[self.name]
+        subnames = [self.subname.format(index) for index in range(len(self.blockslot))]
+        return sorted(mygroup.keys()) == sorted(subnames)
+
+    def _readBlock(self, index, slicing):
+        """Get the block data to be stored for the given block slicing.
+
+        :returns: (slicing, block) -- the slicing is that of the bounding
+                  box if the block was shrunk.
+
+        """
+        block = self.slot[index][slicing].wait()
+
+        if self._shrink_to_bb:
+            nonzero_coords = numpy.nonzero(block)
+            if len(nonzero_coords[0]) > 0:
+                block_start = sliceToRoi( slicing, (0,)*len(slicing) )[0]
+                block_bounding_box_start = numpy.array( list(map( numpy.min, nonzero_coords )) )
+                block_bounding_box_stop = 1 + numpy.array( list(map( numpy.max, nonzero_coords )) )
+                block_slicing = roiToSlice( block_bounding_box_start, block_bounding_box_stop )
+                bounding_box_roi = numpy.array([block_bounding_box_start, block_bounding_box_stop])
+                bounding_box_roi += block_start
+
+                # Overwrite the vars that are written to the file
+                slicing = roiToSlice(*bounding_box_roi)
+                block = block[block_slicing]
+        return slicing, block
+
+    def _fetchBlocks(self, index, slicings):
+        """Yield _readBlock(index, slicing) for each of the given slicings, in order.
+
+        The blocks are requested in parallel, a bounded number ahead of the
+        consumer, so that computing them overlaps with writing the previous
+        ones to the file (which must happen in a single thread).
+
+        """
+        max_pending = 2 * max(1, Request.global_thread_pool.num_workers)
+        pending = collections.deque()
+        for slicing in slicings:
+            pending.append( Request(partial(self._readBlock, index, slicing)).submit() )
+            if len(pending) >= max_pending:
+                yield pending.popleft().wait()
+        while pending:
+            yield pending.popleft().wait()
+
+    def _writeBlocks(self, mygroup, subgroup, index, slicings, blockNames):
+        for blockIndex, (slicing, block) in enumerate(self._fetchBlocks(index, slicings)):
+            blockName = blockNames[blockIndex]
+            blockRoi = slicingToString(slicings[blockIndex])
+
+            # If we have a masked array, convert it to a structured array so that h5py can handle it.
+            if self.slot[index].meta.has_mask:
+                mygroup.attrs["meta.has_mask"] = True
+
+                block_group = subgroup.create_group(blockName)
+
+                if self.compression_level:
+                    block_group.create_dataset("data",
+                                               data=block.data,
+                                               compression='gzip',
+                                               compression_opts=self.compression_level)
+                else:
+                    block_group.create_dataset("data", data=block.data)
+                    
+                block_group.create_dataset(
+                    "mask",
+                    data=block.mask,
+                    compression="gzip",
+                    compression_opts=2
+                )
+                block_group.create_dataset("fill_value", data=block.fill_value)
+
+                block_group.attrs['blockSlice'] = slicingToString(slicing)
+                block_group.attrs['blockRoi'] = blockRoi
+            else:
+                subgroup.create_dataset(blockName, data=block)
+                subgroup[blockName].attrs['blockSlice'] = slicingToString(slicing)
+                subgroup[blockName].attrs['blockRoi'] = blockRoi
+
     @timeLogged(logger, logging.DEBUG)
     def _serialize(self, group, name, slot):
         logger.debug("Serializing BlockSlot: {}".format( self.name ))
@@ -456,96 +704,157 @@ class SerialBlockSlot(SerialSlot):
         for index in range(num):
             subname = self.subname.format(index)
             subgroup = mygroup.create_group(subname)
-            nonZeroBlocks = self.blockslot[index].value
-            for blockIndex, slicing in enumerate(nonZeroBlocks):
-                if not isinstance(slicing[0], slice):
-                    slicing = roiToSlice(*slicing)
+            slicings = self._nonZeroSlicings(index)
+            blockNames = ['block{:04d}'.format(blockIndex) for blockIndex in range(len(slicings))]
+            self._writeBlocks(mygroup, subgroup, index, slicings, blockNames)
+
+    @timeLogged(logger, logging.DEBUG)
+    def _update(self, mygroup):
+        """Bring an existing group up to date, rewriting only the blocks
+        that are new or intersect a dirty roi, and dropping the blocks
+        that are no longer nonzero.
 
-                block = self.slot[index][slicing].wait()
+        """
+        logger.debug("Updating BlockSlot: {}".format( self.name ))
+        num = len(self.blockslot)
+        for index in range(num):
+            if self._isLoadPending(index):
+                continue
+            subgroup = mygroup[self.subname.format(index)]
+            storedBlocks = self._storedBlocks(subgroup)
+            slicings = self._nonZeroSlicings(index)
+            wantedKeys = set( self._blockKey(slicing) for slicing in slicings )
+
+            # Drop the blocks that are gone or whose contents changed.
+            for key, blockName in list(storedBlocks.items()):
+                if key not in wantedKeys or self._isBlockDirty(index, [slice(*k) for k in key]):
+                    del subgroup[blockName]
+                    del storedBlocks[key]
+
+            slicings = [slicing for slicing in slicings if self._blockKey(slicing) not in storedBlocks]
+            blockNames = []
+            blockIndex = 0
+            while len(blockNames) < len(slicings):
                 blockName = 'block{:04d}'.format(blockIndex)
+                if blockName not in subgroup:
+                    blockNames.append(blockName)
+                blockIndex += 1
+            logger.debug("Rewriting {} of {} blocks in \"{}\"".format( len(slicings), len(wantedKeys), subgroup.name ))
+            self._writeBlocks(mygroup, subgroup, index, slicings, blockNames)
 
-                if self._shrink_to_bb:
-                    nonzero_coords = numpy.nonzero(block)
-                    if len(nonzero_coords[0]) > 0:
-                        block_start = sliceToRoi( slicing, (0,)*len(slicing) )[0]
-                        block_bounding_box_start = numpy.array( list(map( numpy.min, nonzero_coords )) )
-                        block_bounding_box_stop = 1 + numpy.array( list(map( numpy.max, nonzero_coords )) )
-                        block_slicing = roiToSlice( block_bounding_box_start, block_bounding_box_stop )
-                        bounding_box_roi = numpy.array([block_bounding_box_start, block_bounding_box_stop])
-                        bounding_box_roi += block_start
-                        
-                        # Overwrite the vars that are written to the file
-                        slicing = roiToSlice(*bounding_box_roi)
-                        block = block[block_slicing]
-
-                # If we have a masked array, convert it to a structured array so that h5py can handle it.
-                if slot[index].meta.has_mask:
-                    mygroup.attrs["meta.has_mask"] = True
-
-                    block_group = subgroup.create_group(blockName)
-
-                    if self.compression_level:
-                        block_group.create_dataset("data",
-                                                   data=block.data,
-                                                   compression='gzip',
-                                                   compression_opts=compression_level)
-                    else:
-                        block_group.create_dataset("data", data=block.data)
-                        
-                    block_group.create_dataset(
-                        "mask",
-                        data=block.mask,
-                        compression="gzip",
-                        compression_opts=2
-                    )
-                    block_group.create_dataset("fill_value", data=block.fill_value)
-
-                    block_group.attrs['blockSlice'] = slicingToString(slicing)
-                else:
-                    subgroup.create_dataset(blockName, data=block)
-                    subgroup[blockName].attrs['blockSlice'] = slicingToString(slicing)
+    def deserializeLazily(self, group):
+        """Like deserialize(), but the blocks of each lane are only read
+        once the lane's operators are first used, i.e. when data is
+        requested from them or written to them.  The project file must
+        stay open until then.
 
-    @timeLogged(logger, logging.DEBUG)
-    def _deserialize(self, mygroup, slot):
-        logger.debug("Deserializing BlockSlot: {}".format( self.name ))
-        num = len(mygroup)
-        if len(self.inslot) < num:
-            self.inslot.resize(num)
+        """
+        if self.name not in group:
+            return
+        mygroup = group[self.name]
+        laneGroups = self._sortedLaneGroups(mygroup)
+        if len(self.inslot) < len(laneGroups):
+            self.inslot.resize(len(laneGroups))
+        for index, (groupName, labelGroup) in enumerate(laneGroups):
+            operators = []
+            for laneSlot in self._servingSlots(index):
+                op = laneSlot.getRealOperator()
+                if op is not None and op not in operators:
+                    operators.append(op)
+            load = partial(self._loadDeferredLane, mygroup, labelGroup, index)
+            self._deferredLoads[id(self.slot[index])] = _DeferredLoad(operators, load)
+        self.dirty = False
+        self._allDirty = False
+        self._dirtyRois = {}
+
+    def _servingSlots(self, index):
+        """The slots whose operators actually serve the data of the given
+        lane.  The serialized slots are usually connected to internal
+        operators, e.g. LabelImages is connected to the output of a label
+        pipeline, whose operator computes the data, and LabelInputs
+        forwards the written data to the input of that pipeline.
+
+        """
+        slots = []
+        for outslot in (self.slot[index], self.blockslot[index]):
+            while outslot.upstream_slot is not None:
+                outslot = outslot.upstream_slot
+            slots.append(outslot)
+        toVisit = [self.inslot[index]]
+        while toVisit:
+            inslot = toVisit.pop()
+            slots.append(inslot)
+            toVisit += inslot.downstream_slots
+        return slots
+
+    def _isLoadPending(self, index):
+        deferredLoad = self._deferredLoads.get(id(self.slot[index]))
+        return deferredLoad is not None and deferredLoad.pending
+
+    def _loadDeferredLane(self, mygroup, labelGroup, index):
+        logger.debug("Loading deferred lane {} of BlockSlot: {}".format( index, self.name ))
+        # The file is in sync with the loaded blocks.
+        ignoreDirty = self.ignoreDirty
+        self.ignoreDirty = True
+        try:
+            self._deserializeLane(mygroup, labelGroup, index, self.inslot)
+        finally:
+            self.ignoreDirty = ignoreDirty
+
+    @staticmethod
+    def _sortedLaneGroups(mygroup):
         # Annoyingly, some applets store their groups with names like, img0,img1,img2,..,img9,img10,img11
         # which means that sorted() needs a special key to avoid sorting img10 before img2
         # We have to find the index and sort according to its numerical value.
         index_capture = re.compile(r'[^0-9]*(\d*).*')
         def extract_index(s):
             return int(index_capture.match(s).groups()[0])
-        for index, t in enumerate(sorted(list(mygroup.items()), key=lambda k_v: extract_index(k_v[0]))):
-            groupName, labelGroup = t
-            for blockData in list(labelGroup.values()):
-                slicing = stringToSlicing(blockData.attrs['blockSlice'])
-
-                # If it is suppose to be a masked array,
-                # deserialize the pieces and rebuild the masked array.
-                assert slot[index].meta.has_mask == mygroup.attrs.get("meta.has_mask"), \
-                       "The slot and stored data have different values for" + \
-                       " `has_mask`. They are" + \
-                       " `bool(slot[index].meta.has_mask)`=" + \
-                       repr(bool(slot[index].meta.has_mask)) + " and" + \
-                       " `mygroup.attrs.get(\"meta.has_mask\", False)`=" + \
-                       repr(mygroup.attrs.get("meta.has_mask", False)) + \
-                       ". Please fix this to proceed with deserialization."
-                if slot[index].meta.has_mask:
-                    blockArray = numpy.ma.masked_array(
-                        blockData["data"][()],
-                        mask=blockData["mask"][()],
-                        fill_value=blockData["fill_value"][()],
-                        shrink=False
-                    )
-                else:
-                    blockArray = blockData[...]
+        return sorted(list(mygroup.items()), key=lambda k_v: extract_index(k_v[0]))
 
-                self.inslot[index][slicing] = blockArray
+    @timeLogged(logger, logging.DEBUG)
+    def _deserialize(self, mygroup, slot):
+        logger.debug("Deserializing BlockSlot: {}".format( self.name ))
+        num = len(mygroup)
+        if len(self.inslot) < num:
+            self.inslot.resize(num)
+        for index, (groupName, labelGroup) in enumerate(self._sortedLaneGroups(mygroup)):
+            self._deserializeLane(mygroup, labelGroup, index, slot)
+
+    def _deserializeLane(self, mygroup, labelGroup, index, slot):
+        for blockData in list(labelGroup.values()):
+            slicing = stringToSlicing(blockData.attrs['blockSlice'])
+
+            # If it is suppose to be a masked array,
+            # deserialize the pieces and rebuild the masked array.
+            assert slot[index].meta.has_mask == mygroup.attrs.get("meta.has_mask"), \
+                   "The slot and stored data have different values for" + \
+                   " `has_mask`. They are" + \
+                   " `bool(slot[index].meta.has_mask)`=" + \
+                   repr(bool(slot[index].meta.has_mask)) + " and" + \
+                   " `mygroup.attrs.get(\"meta.has_mask\", False)`=" + \
+                   repr(mygroup.attrs.get("meta.has_mask", False)) + \
+                   ". Please fix this to proceed with deserialization."
+            if slot[index].meta.has_mask:
+                blockArray = numpy.ma.masked_array(
+                    blockData["data"][()],
+                    mask=blockData["mask"][()],
+                    fill_value=blockData["fill_value"][()],
+                    shrink=False
+                )
+            else:
+                blockArray = blockData[...]
+
+            self.inslot[index][slicing] = blockArray
 
 class SerialHdf5BlockSlot(SerialBlockSlot):
 
+    def _canUpdate(self, group):
+        # The hdf5 slots name their own datasets, so always rewrite.
+        return False
+
+    def deserializeLazily(self, group):
+        self.deserialize(group)
+
     def _serialize(self, group, name, slot):
         mygroup = group.create_group(name)
         num = len(self.blockslot)
@@ -943,6 +1252,9 @@ class AppletSerializer(with_metaclass(ABCMeta, object)):
         self.serialSlots = maybe(slots, [])
         self.operator = operator
         self._ignoreDirty = False
+        # Whether serial slots may defer reading their data until it is
+        # used (see SerialSlot.deserializeLazily).  Set by the project manager.
+        self.lazyLoad = False
 
     def isDirty(self):
         """Returns true if the current state of this item (in memory)
@@ -1061,7 +1373,10 @@ class AppletSerializer(with_metaclass(ABCMeta, object)):
             if topGroup is not None:
                 inc = self.progressIncrement()
                 for ss in self.serialSlots:
-                    ss.deserialize(topGroup)
+                    if self.lazyLoad:
+                        ss.deserializeLazily(topGroup)
+                    else:
+                        ss.deserialize(topGroup)
                     self.progressSignal(inc)
 
                 # Call the subclass to do remaining work
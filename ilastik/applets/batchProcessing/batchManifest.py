@@ -0,0 +1,175 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+from __future__ import absolute_import
+import os
+import glob
+import json
+import logging
+logger = logging.getLogger(__name__)
+
+from lazyflow.utility import PathComponents, isUrl
+
+
+def input_filepaths(data_for_role):
+    """
+    Return the files on disk that the given batch input path refers to.
+    (A path may be a list of paths separated by os.path.pathsep, contain globs or an hdf5 internal path.)
+    """
+    if not data_for_role or not isinstance(data_for_role, str) or isUrl(data_for_role):
+        return []
+    filepaths = []
+    for path in data_for_role.split(os.path.pathsep):
+        filepaths += sorted(glob.glob(PathComponents(path).externalPath))
+    return filepaths
+
+
+def _file_signature(filepath):
+    st = os.stat(filepath)
+    return [os.path.abspath(filepath), st.st_mtime, st.st_size]
+
+
+class BatchManifest(object):
+    """
+    Records which batch datasets were exported successfully, so an interrupted batch run can be resumed.
+
+    The manifest is a file of json lines, one for each exported dataset::
+
+        {"key": ..., "inputs": [[path, mtime, size], ...], "parameters": ..., "output": [path, mtime, size],
+         "status": "done"}
+
+    Each record is appended with a single write and flushed to disk, so a killed process leaves at most a
+    truncated last line, which is ignored when the manifest is read.  Later records override earlier ones.
+
+    A dataset counts as complete if its input files and the batch parameters are unchanged since its record was
+    written, and its output file is still the one that was written.
+    """
+    STATUS_DONE = 'done'
+
+    def __init__(self, path, parameters_hash):
+        """
+        path: The manifest file.  It is created if it doesn't exist.
+
+        parameters_hash: Identifies everything besides the inputs that determines the results
+                         (project contents, export settings, etc.)
+        """
+        self.path = path
+        self.parameters_hash = parameters_hash
+        # Whether the last record was cut off, so the next one must start on a new line
+        self._truncated = False
+        # Set when writing failed (e.g. read-only directory); the batch run goes on without the manifest.
+        self._write_failed = False
+        self._records = self._load()
+
+    def _load(self):
+        records = {}
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, 'r') as f:
+            for line in f:
+                self._truncated = not line.endswith('\n')
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    records[record['key']] = record
+                except (ValueError, KeyError, TypeError):
+                    logger.warning("Ignoring invalid line in batch manifest {}".format(self.path))
+        return records
+
+    @classmethod
+    def dataset_key(cls, role_input_datas):
+        """
+        The key identifying a dataset in the manifest,
+        or None if the dataset can't be recorded (e.g. it was given as a DatasetInfo or URL).
+        """
+        for data_for_role in role_input_datas:
+            if data_for_role and not input_filepaths(data_for_role):
+                return None
+        return json.dumps([data_for_role or None for data_for_role in role_input_datas])
+
+    @classmethod
+    def _input_signatures(cls, role_input_datas):
+        return [ [_file_signature(filepath) for filepath in input_filepaths(data_for_role)]
+                 for data_for_role in role_input_datas ]
+
+    @classmethod
+    def _output_signature(cls, output_path):
+        output_filepath = PathComponents(output_path).externalPath
+        if not os.path.isfile(output_filepath):
+            return None
+        # Keep the full export path (which may include an internal path), not just the file.
+        return [output_path] + _file_signature(output_filepath)[1:]
+
+    def completed_output(self, role_input_datas):
+        """
+        Return the output path of the given dataset if it was already exported with the current parameters
+        and none of its files changed since.  Otherwise, return None.
+        """
+        key = self.dataset_key(role_input_datas)
+        record = self._records.get(key)
+        if key is None or record is None:
+            return None
+        if record['status'] != self.STATUS_DONE or record['parameters'] != self.parameters_hash:
+            return None
+        try:
+            if record['inputs'] != self._input_signatures(role_input_datas):
+                return None
+            output_path = record['output'][0]
+            if record['output'] != self._output_signature(output_path):
+                return None
+        except OSError:
+            return None
+        return output_path
+
+    def record(self, role_input_datas, output_path):
+        """
+        Record that the given dataset was exported to output_path.
+        Datasets that can't be recorded (see dataset_key()) are ignored.
+        If the manifest can't be written, a warning is logged (once) and nothing is recorded.
+        """
+        if self._write_failed:
+            return
+        key = self.dataset_key(role_input_datas)
+        output_signature = self._output_signature(output_path)
+        if key is None or output_signature is None:
+            return
+        record = { 'key': key,
+                   'inputs': self._input_signatures(role_input_datas),
+                   'parameters': self.parameters_hash,
+                   'output': output_signature,
+                   'status': self.STATUS_DONE }
+        line = json.dumps(record)
+        # Round-trip through json, so the record compares equal to the loaded ones.
+        record = json.loads(line)
+        if self._truncated:
+            line = '\n' + line
+        try:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        except (IOError, OSError) as ex:
+            logger.warning("Can't write batch manifest {}, completed datasets won't be recorded: {}"
+                           .format(self.path, ex))
+            self._write_failed = True
+            return
+        self._truncated = False
+        self._records[key] = record
@@ -1,8 +1,12 @@
 from __future__ import division
 from __future__ import absolute_import
 from builtins import range
+import os
 import copy
+import hashlib
+import argparse
 import weakref
+from functools import partial
 from collections import OrderedDict
 import logging
 logger = logging.getLogger(__name__)  # noqa
@@ -10,10 +14,15 @@ logger = logging.getLogger(__name__)  # noqa
 import numpy
 import vigra
 from lazyflow.request import Request
+from ilastik.config import cfg as ilastik_config
 from ilastik.utility import log_exception
 from ilastik.applets.base.applet import Applet
 from ilastik.applets.dataSelection import DataSelectionApplet
 from ilastik.applets.dataSelection.opDataSelection import DatasetInfo, OpMultiLaneDataSelectionGroup
+from .batchManifest import BatchManifest, input_filepaths
+
+# Chunk size used to read files (read-ahead of the next batch round, project hashing)
+READ_AHEAD_CHUNK_BYTES = 4 * 1024 * 1024
 
 
 class BatchProcessingApplet(Applet):
@@ -54,6 +63,19 @@ class BatchProcessingApplet(Applet):
         role_names = self.dataSelectionApplet.topLevelOperator.DatasetRoles.value
         parsed_args, unused_args = DataSelectionApplet.parse_known_cmdline_args(
             cmdline_args, role_names)
+
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--batch_lanes', type=int, default=None,
+                            help='Number of batch datasets to process concurrently.')
+        parser.add_argument('--batch_manifest', default=None,
+                            help='File recording the completed batch datasets, so that the run can be resumed. '
+                                 'With --resume, it defaults to <project name>_batch_manifest.jsonl, next to the project file.')
+        parser.add_argument('--resume', action='store_true',
+                            help='Skip batch datasets that the manifest records as already exported.')
+        batch_args, unused_args = parser.parse_known_args(unused_args)
+        parsed_args.batch_lanes = batch_args.batch_lanes
+        parsed_args.batch_manifest = batch_args.batch_manifest
+        parsed_args.resume = batch_args.resume
         return parsed_args, unused_args
 
     def run_export_from_parsed_args(self, parsed_args):
@@ -63,9 +85,24 @@ class BatchProcessingApplet(Applet):
         role_names = self.dataSelectionApplet.topLevelOperator.DatasetRoles.value
         role_path_dict = self.dataSelectionApplet.role_paths_from_parsed_args(
             parsed_args, role_names)
-        return self.run_export(role_path_dict, parsed_args.input_axes, sequence_axis=parsed_args.stack_along)
-
-    def run_export(self, role_data_dict, input_axes=None, export_to_array=False, sequence_axis=None):
+        # The manifest is only written if it was asked for.
+        manifest_path = getattr(parsed_args, 'batch_manifest', None)
+        resume = getattr(parsed_args, 'resume', False)
+        if manifest_path is None and resume:
+            manifest_path = self._default_manifest_path()
+        return self.run_export(role_path_dict, parsed_args.input_axes, sequence_axis=parsed_args.stack_along,
+                               num_batch_lanes=getattr(parsed_args, 'batch_lanes', None),
+                               manifest_path=manifest_path,
+                               resume=resume)
+
+    def _default_manifest_path(self):
+        project_file = self.dataSelectionApplet.topLevelOperator.ProjectFile
+        if not project_file.ready():
+            return None
+        return os.path.splitext(project_file.value.filename)[0] + '_batch_manifest.jsonl'
+
+    def run_export(self, role_data_dict, input_axes=None, export_to_array=False, sequence_axis=None,
+                   num_batch_lanes=None, manifest_path=None, resume=False):
         """
         Run the export for each dataset listed in role_data_dict,
         which must be a dict of {role_index : path-list} OR {role_index : DatasetInfo-list}
@@ -74,16 +111,23 @@ class BatchProcessingApplet(Applet):
         The latter is useful if you are batch processing data that already exists in memory as a numpy array.
         (See DatasetInfo.preloaded_array for how to provide a numpy array instead of a filepath.)
 
-        For each dataset:
-            1. Append a lane to the workflow
-            2. Configure the new lane's DataSelection inputs with the new file (or files, if there is more than one
-               role).
-            3. Export the results from the new lane
-            4. Remove the lane from the workflow.
+        The datasets are processed in rounds of up to num_batch_lanes datasets:
+            1. Append the batch lanes to the workflow (only once, in the first round)
+            2. Configure each batch lane's DataSelection inputs with the next file (or files, if there is more
+               than one role).
+            3. Export the results from all batch lanes of the round concurrently, while the input files of the
+               next round are read ahead.
+            4. Once all rounds are done, remove the batch lanes from the workflow.
+
+        Appending the batch lanes triggers the workflow's usual prepareForNewLane() and connectLane() logic,
+        which ensures that we get fresh lanes that are ready to process data.  Before a lane is reused for the
+        next dataset, prepareForNewLane() is called again, so workflows can save state (e.g. classifiers) that
+        gets invalidated by the new inputs and restore it in handleNewLanesAdded().  Each lane is added (or
+        reconfigured) and handed to handleNewLanesAdded() before the next one, just like a single lane, so
+        the state saved for one lane is never overwritten by the next.
 
-        By appending/removing the batch lane for EACH dataset we process, we trigger the workflow's usual
-        prepareForNewLane() and connectLane() logic, which ensures that we get a fresh new lane that's
-        ready to process data.
+        Graph setup and the export hooks of the DataExportApplet always run in this thread, in dataset order,
+        so each result only depends on its own input, no matter how many batch lanes are used.
 
         After each lane is processed, the given post-processing callback will be executed.
         signature: lane_postprocessing_callback(batch_lane_index)
@@ -91,6 +135,15 @@ class BatchProcessingApplet(Applet):
         export_to_array: If True do NOT export to disk as usual.
                          Instead, export the results to a list of arrays, which is returned.
                          If False, return a list of the filenames we produced to.
+
+        num_batch_lanes: How many datasets to export concurrently.
+                         Defaults to the 'batch_lanes' setting in the [batch processing] config section.
+
+        manifest_path: If given (and not export_to_array), each exported dataset is recorded in this file.
+                       (See BatchManifest.)
+
+        resume: If True, skip the datasets that the manifest records as already exported with the same
+                project and export settings, and whose files have not changed since.
         """
         results = []
 
@@ -103,49 +156,93 @@ class BatchProcessingApplet(Applet):
             # [ (role-1-path, role-2-path, ...),
             #   (role-1-path, role-2-path,...) ]
             datas_by_batch_index = list(zip(*list(role_data_dict.values())))
+            results = [None] * len(datas_by_batch_index)
+
+            # Per-dataset progress, for the overall progress
+            dataset_progress = [0.0] * len(datas_by_batch_index)
+
+            manifest = None
+            if manifest_path and not export_to_array:
+                manifest = BatchManifest(manifest_path, self._batch_parameters_hash(input_axes, sequence_axis))
+            elif resume:
+                logger.warning("No batch manifest available; can't resume.")
+
+            pending_dataset_indexes = []
+            for batch_dataset_index, role_input_datas in enumerate(datas_by_batch_index):
+                completed_output = None
+                if manifest and resume:
+                    completed_output = manifest.completed_output(role_input_datas)
+                if completed_output is None:
+                    pending_dataset_indexes.append(batch_dataset_index)
+                else:
+                    logger.info("Skipping {}: already exported to {}".format(role_input_datas, completed_output))
+                    results[batch_dataset_index] = completed_output
+                    dataset_progress[batch_dataset_index] = 1.0
+
+            if num_batch_lanes is None:
+                num_batch_lanes = ilastik_config.getint('batch processing', 'batch_lanes')
+            num_batch_lanes = min(max(1, num_batch_lanes), len(pending_dataset_indexes))
+
+            def make_progress_callback(batch_dataset_index):
+                def emit_progress(dataset_percent):
+                    dataset_progress[batch_dataset_index] = dataset_percent / 100.0
+                    overall_progress = sum(dataset_progress) / len(datas_by_batch_index)
+                    self.progressSignal(100 * overall_progress)
+                return emit_progress
 
             # Call customization hook
             self.dataExportApplet.prepare_for_entire_export()
 
-            batch_lane_index = len(self.dataSelectionApplet.topLevelOperator)
-            for batch_dataset_index, role_input_datas in enumerate(datas_by_batch_index):
-                # Add a lane to the end of the workflow for batch processing
-                # (Expanding OpDataSelection by one has the effect of expanding the whole workflow.)
-                self.dataSelectionApplet.topLevelOperator.addLane(
-                    batch_lane_index)
-                try:
+            first_batch_lane_index = len(self.dataSelectionApplet.topLevelOperator)
+            batch_lane_indexes = list(range(first_batch_lane_index, first_batch_lane_index + num_batch_lanes))
+            rounds = [ pending_dataset_indexes[start:start + num_batch_lanes]
+                       for start in range(0, len(pending_dataset_indexes), num_batch_lanes) ]
+            try:
+                read_ahead_req = None
+                for round_index, batch_dataset_indexes in enumerate(rounds):
                     # The above setup can take a long time for a big workflow.
                     # If the user has ALREADY cancelled, quit now instead of waiting for the first request to begin.
                     Request.raise_if_cancelled()
 
-                    def emit_progress(dataset_percent):
-                        overall_progress = (
-                            batch_dataset_index + dataset_percent / 100.0) / len(datas_by_batch_index)
-                        self.progressSignal(100 * overall_progress)
-
-                    # Now use the new lane to export the batch results for the current file.
-                    result = self._run_export_with_empty_batch_lane(role_input_datas,
-                                                                    batch_lane_index,
-                                                                    template_infos,
-                                                                    emit_progress,
-                                                                    export_to_array=export_to_array)
-                    if export_to_array:
-                        assert isinstance(result, numpy.ndarray)
-                    else:
-                        assert isinstance(result, str)
-                    results.append(result)
-                finally:
-                    # Remove the batch lane.  See docstring above for explanation.
-                    try:
-                        self.dataSelectionApplet.topLevelOperator.removeLane(
-                            batch_lane_index, batch_lane_index)
-                    except Request.CancellationException:
-                        log_exception(logger)
-                        # If you see this, something went wrong in a graph setup operation.
-                        raise RuntimeError(
-                            "Encountered an unexpected CancellationException while removing the batch lane.")
-                    assert len(
-                        self.dataSelectionApplet.topLevelOperator.DatasetGroup) == batch_lane_index
+                    if read_ahead_req is not None:
+                        read_ahead_req.wait()
+                    lanes_and_datas = [ (batch_lane_index, datas_by_batch_index[batch_dataset_index])
+                                        for batch_lane_index, batch_dataset_index
+                                        in zip(batch_lane_indexes, batch_dataset_indexes) ]
+                    self._configure_batch_lanes(lanes_and_datas, template_infos)
+
+                    read_ahead_req = None
+                    if round_index + 1 < len(rounds):
+                        next_datas = [ datas_by_batch_index[i] for i in rounds[round_index + 1] ]
+                        read_ahead_req = Request(partial(self._read_ahead, next_datas)).submit()
+
+                    round_results = self._export_batch_lanes(
+                        [ (batch_lane_index, make_progress_callback(batch_dataset_index))
+                          for batch_lane_index, batch_dataset_index
+                          in zip(batch_lane_indexes, batch_dataset_indexes) ],
+                        export_to_array)
+                    for batch_dataset_index, result in zip(batch_dataset_indexes, round_results):
+                        if export_to_array:
+                            assert isinstance(result, numpy.ndarray)
+                        else:
+                            assert isinstance(result, str)
+                        results[batch_dataset_index] = result
+                        if manifest:
+                            manifest.record(datas_by_batch_index[batch_dataset_index], result)
+            finally:
+                # Remove the batch lanes.  See docstring above for explanation.
+                try:
+                    for batch_lane_index in reversed(batch_lane_indexes):
+                        if len(self.dataSelectionApplet.topLevelOperator.DatasetGroup) > batch_lane_index:
+                            self.dataSelectionApplet.topLevelOperator.removeLane(
+                                batch_lane_index, batch_lane_index)
+                except Request.CancellationException:
+                    log_exception(logger)
+                    # If you see this, something went wrong in a graph setup operation.
+                    raise RuntimeError(
+                        "Encountered an unexpected CancellationException while removing the batch lane.")
+                assert len(
+                    self.dataSelectionApplet.topLevelOperator.DatasetGroup) == first_batch_lane_index
 
             # Call customization hook
             self.dataExportApplet.post_process_entire_export()
@@ -154,6 +251,114 @@ class BatchProcessingApplet(Applet):
         finally:
             self.progressSignal(100)
 
+    def _batch_parameters_hash(self, input_axes=None, sequence_axis=None):
+        """
+        Hash everything besides the input files that determines the batch results:
+        the project file and the export settings (which may be overridden on the command line).
+        The project file is identified by its path, modification time and size (instead of its contents,
+        which may be large).
+        """
+        sha = hashlib.sha1()
+        project_file = self.dataSelectionApplet.topLevelOperator.ProjectFile
+        if project_file.ready():
+            project_path = os.path.abspath(project_file.value.filename)
+            st = os.stat(project_path)
+            sha.update(repr((project_path, st.st_mtime, st.st_size)).encode('utf-8'))
+
+        opDataExport = self.dataExportApplet.topLevelOperator
+        export_slots = [ opDataExport.InputSelection, opDataExport.OutputFilenameFormat,
+                         opDataExport.OutputInternalPath, opDataExport.OutputFormat,
+                         opDataExport.ExportDtype, opDataExport.OutputAxisOrder,
+                         opDataExport.RegionStart, opDataExport.RegionStop,
+                         opDataExport.InputMin, opDataExport.InputMax,
+                         opDataExport.ExportMin, opDataExport.ExportMax ]
+        settings = [ (slot.name, slot.value if slot.ready() else None) for slot in export_slots ]
+        settings += [ ('input_axes', input_axes), ('sequence_axis', sequence_axis) ]
+        sha.update(repr(settings).encode('utf-8'))
+        return sha.hexdigest()
+
+    @staticmethod
+    def _read_ahead(role_input_datas_list):
+        """
+        Read the input files of the given datasets once, so that they are in the OS file cache
+        by the time their lanes are configured and exported.
+        (Only plain files are read; preconfigured DatasetInfo objects are skipped.)
+        """
+        for role_input_datas in role_input_datas_list:
+            for data_for_role in role_input_datas:
+                for filepath in input_filepaths(data_for_role):
+                    try:
+                        with open(filepath, 'rb') as f:
+                            while f.read(READ_AHEAD_CHUNK_BYTES):
+                                pass
+                    except (IOError, OSError):
+                        # Not our problem: the DataSelection will report it, if necessary.
+                        pass
+
+    def _configure_batch_lanes(self, lanes_and_datas, template_infos):
+        """
+        Configure the given batch lanes with their new input files.
+        Lanes that don't exist yet are added to the end of the workflow.
+
+        lanes_and_datas: A list of (batch_lane_index, role_input_datas) pairs.
+                         (See _configure_batch_lane())
+        """
+        workflow = self.workflow()
+        opDataSelection = self.dataSelectionApplet.topLevelOperator
+        for batch_lane_index, role_input_datas in lanes_and_datas:
+            if len(opDataSelection) > batch_lane_index:
+                # Setting the new inputs has the same effect on the workflow as adding a new lane.
+                workflow.prepareForNewLane(batch_lane_index)
+            else:
+                # Add a lane to the end of the workflow for batch processing
+                # (Expanding OpDataSelection by one has the effect of expanding the whole workflow,
+                #  including the call to prepareForNewLane().)
+                opDataSelection.addLane(batch_lane_index)
+            self._configure_batch_lane(role_input_datas, batch_lane_index, template_infos)
+
+            # A new lane was added.
+            # Give the workflow a chance to restore anything that was unecessarily invalidated (e.g. classifiers)
+            # before the next lane invalidates it again.
+            workflow.handleNewLanesAdded()
+
+        for batch_lane_index, _ in lanes_and_datas:
+            opDataExportBatchlaneView = self.dataExportApplet.topLevelOperator.getLane(batch_lane_index)
+            assert opDataExportBatchlaneView.ImageToExport.ready()
+            assert opDataExportBatchlaneView.ExportPath.ready()
+
+    def _export_batch_lanes(self, lanes_and_callbacks, export_to_array):
+        """
+        Export the results of the given (configured) batch lanes concurrently.
+
+        lanes_and_callbacks: A list of (batch_lane_index, progress_callback) pairs.
+
+        Returns the results in the same order as the lanes.
+        """
+        # Call customization hook
+        for batch_lane_index, _ in lanes_and_callbacks:
+            self.dataExportApplet.prepare_lane_for_export(batch_lane_index)
+
+        if len(lanes_and_callbacks) == 1:
+            batch_lane_index, progress_callback = lanes_and_callbacks[0]
+            results = [self._export_batch_lane(batch_lane_index, progress_callback, export_to_array)]
+        else:
+            reqs = [ Request(partial(self._export_batch_lane, batch_lane_index, progress_callback, export_to_array))
+                     for batch_lane_index, progress_callback in lanes_and_callbacks ]
+            try:
+                for req in reqs:
+                    req.submit()
+                results = [req.wait() for req in reqs]
+            except:
+                for req in reqs:
+                    req.cancel()
+                raise
+
+        # Call customization hook
+        for batch_lane_index, _ in lanes_and_callbacks:
+            self.dataExportApplet.post_process_lane_export(batch_lane_index)
+
+        return results
+
     def _get_template_dataset_infos(self, input_axes=None, sequence_axis=None):
         """
         Sometimes the default settings for an input file are not suitable (e.g. the axistags need to be changed).
@@ -195,10 +400,9 @@ class BatchProcessingApplet(Applet):
                 template_infos[role_index].sequenceAxis = sequence_axis
         return template_infos
 
-    def _run_export_with_empty_batch_lane(self, role_input_datas, batch_lane_index, template_infos, progress_callback,
-                                          export_to_array):
+    def _configure_batch_lane(self, role_input_datas, batch_lane_index, template_infos):
         """
-        Configure the fresh batch lane with the given input files, and export the results.
+        Configure the batch lane with the given input files.
 
         role_input_datas: A list of str or DatasetInfo, one item for each dataset-role.
                           (For example, a workflow might have two roles: Raw Data and Binary Segmentation.)
@@ -209,8 +413,6 @@ class BatchProcessingApplet(Applet):
                         Settings like axistags, etc. that cannot be automatically inferred
                         from the filepath will be copied from these template objects.
                         (See explanation in _get_template_dataset_infos(), above.)
-
-        progress_callback: Export progress for the current lane is reported via this callback.
         """
         assert role_input_datas[
             0], "At least one file must be provided for each dataset (the first role)."
@@ -238,32 +440,27 @@ class BatchProcessingApplet(Applet):
             # Apply to the data selection operator
             opDataSelectionBatchLaneView.DatasetGroup[role_index].setValue(info)
 
-        # Make sure nothing went wrong
+    def _export_batch_lane(self, batch_lane_index, progress_callback, export_to_array):
+        """
+        Export the results of the configured batch lane.
+
+        progress_callback: Export progress for the lane is reported via this callback.
+        """
         opDataExportBatchlaneView = self.dataExportApplet.topLevelOperator.getLane(
             batch_lane_index)
-        # New lanes were added.
-        # Give the workflow a chance to restore anything that was unecessarily invalidated (e.g. classifiers)
-        self.workflow().handleNewLanesAdded()
-
-        assert opDataExportBatchlaneView.ImageToExport.ready()
-        assert opDataExportBatchlaneView.ExportPath.ready()
 
-        # Call customization hook
-        self.dataExportApplet.prepare_lane_for_export(batch_lane_index)
-
-        # Finally, run the export
         opDataExportBatchlaneView.progressSignal.subscribe(progress_callback)
-
-        if export_to_array:
-            logger.info("Exporting to in-memory array.")
-            result = opDataExportBatchlaneView.run_export_to_array()
-        else:
-            logger.info("Exporting to {}".format(
-                opDataExportBatchlaneView.ExportPath.value))
-            opDataExportBatchlaneView.run_export()
-            result = opDataExportBatchlaneView.ExportPath.value
-
-        # Call customization hook
-        self.dataExportApplet.post_process_lane_export(batch_lane_index)
+        try:
+            if export_to_array:
+                logger.info("Exporting to in-memory array.")
+                result = opDataExportBatchlaneView.run_export_to_array()
+            else:
+                logger.info("Exporting to {}".format(
+                    opDataExportBatchlaneView.ExportPath.value))
+                opDataExportBatchlaneView.run_export()
+                result = opDataExportBatchlaneView.ExportPath.value
+        finally:
+            # The lane is reused for the next dataset
+            opDataExportBatchlaneView.progressSignal.unsubscribe(progress_callback)
 
         return result
@@ -51,6 +51,7 @@ from ilastik.shell.gui.iconMgr import ilastikIcons
 from ilastik.applets.labeling.labelingGui import LabelingGui
 from ilastik.applets.base.applet import ShellRequest
 from lazyflow.operators.opReorderAxes import OpReorderAxes
+from ilastik.applets.counting.opCounting import OpDensityIntegral
 from ilastik.applets.counting.countingGuiDotsInterface import DotCrosshairController,DotInterpreter
 from ilastik.applets.base.appletSerializer import SerialListSlot
 
@@ -245,7 +246,13 @@ class CountingGui(LabelingGui):
         self.density5d=OpReorderAxes(graph=self.op.graph, parent=self.op.parent) #
 
         self.density5d.Input.connect(self.op.Density)
-        self.boxController=BoxController(mainwin.editor,self.density5d.Output,self.labelingDrawerUi.boxListModel)
+
+        # Box counts are computed from summed-area tables of the density
+        self.densityIntegral=OpDensityIntegral(graph=self.op.graph, parent=self.op.parent)
+        self.densityIntegral.Input.connect(self.density5d.Output)
+
+        self.boxController=BoxController(mainwin.editor,self.density5d.Output,self.labelingDrawerUi.boxListModel,
+                                         densityIntegral=self.densityIntegral)
         self.boxInterpreter=BoxInterpreter(mainwin.editor.navInterpret,mainwin.editor.posModel,self.boxController,mainwin.centralWidget())
 
         self.navigationInterpreterDefault=self.editor.navInterpret
@@ -47,10 +47,13 @@ import vigra
 from lazyflow.operator import InputSlot
 from lazyflow.graph import Operator, OutputSlot, Graph
 from lazyflow.operators.generic import OpSubRegion
+from lazyflow.request import Request
 ##add tot hte pos model
 from ilastik.widgets.boxListModel import BoxLabel, BoxListModel
+from ilastik.utility.gui import ThreadRouter, threadRouted
 
 import warnings
+from functools import partial
 import threading
 
 import time
@@ -535,7 +538,8 @@ class RedRubberBand(QRubberBand):
 #===============================================================================
 
 class CoupledRectangleElement(object):
-    def __init__(self, x, y, h, w, inputSlot, editor=None, scene=None, parent=None, qcolor=QColor(0, 0, 255)):
+    def __init__(self, x, y, h, w, inputSlot, editor=None, scene=None, parent=None, qcolor=QColor(0, 0, 255),
+                 updateSums=None):
         '''
         Couples the functionality of the lazyflow operator OpSubRegion which gets a subregion of interest
         and the functionality of the resizable rectangle Item.
@@ -550,6 +554,8 @@ class CoupledRectangleElement(object):
         :param scene: the scene where to put the graphics item
         :param parent: the parent object if any
         :param qcolor: initial color of the rectangle
+        :param updateSums: (optional) function that updates the sums of all boxes at once (see BoxController).
+                           If given, it is called instead of summing the subregion.
         '''
         assert inputSlot.meta.getTaggedShape()['c'] == 1
 
@@ -561,6 +567,8 @@ class CoupledRectangleElement(object):
         self._opsub = OpSubRegion(graph=inputSlot.operator.graph, parent=inputSlot.operator.parent)
 
         self._inputSlot = inputSlot  # input slot which connect to the sub array
+        self._updateSums = updateSums
+        self.threadRouter = ThreadRouter(self._rectItem.Signaller)
 
         self.boxLabel = None  # a reference to the label in the labellist model
         self._initConnect()
@@ -569,7 +577,8 @@ class CoupledRectangleElement(object):
         # Operator changes
         self._opsub.Input.connect(self._inputSlot)
         self._opsub.Roi.setValue([self.getStart(), self.getStop()])
-        self._inputSlot.notifyDirty(self._updateTextWhenChanges)
+        if self._updateSums is None:
+            self._inputSlot.notifyDirty(self._updateTextWhenChanges)
 
         # Signaling when the rectangle is moved
         self._rectItem.Signaller.signalHasMoved.connect(self._updateTextWhenChanges)
@@ -588,19 +597,25 @@ class CoupledRectangleElement(object):
         # region get a wrong size
         # try:
         try:
-            subarray = self.getSubRegion()
-            value = 0
-            if subarray is not None:
-                value = subarray.sum()
-
-            self._rectItem.updateText(f'{value:.1f}')
-
-            if self.boxLabel is not None:
-                self.boxLabel.density = f'{value:.1f}'
+            if self._updateSums is not None:
+                self._updateSums()
+            else:
+                subarray = self.getSubRegion()
+                value = 0
+                if subarray is not None:
+                    value = subarray.sum()
+                self._showValue(value)
 
         except Exception as e:
             warnings.warn(f'Warning: invalid subregion. {e}', RuntimeWarning)
 
+    @threadRouted
+    def _showValue(self, value):
+        self._rectItem.updateText(f'{value:.1f}')
+
+        if self.boxLabel is not None:
+            self.boxLabel.density = f'{value:.1f}'
+
     def getOpsub(self):
         return self._opsub
 
@@ -608,7 +623,8 @@ class CoupledRectangleElement(object):
         return self._rectItem
 
     def disconnectInput(self):
-        self._inputSlot.unregisterDirty(self._updateTextWhenChanges)
+        if self._updateSums is None:
+            self._inputSlot.unregisterDirty(self._updateTextWhenChanges)
         self._opsub.Input.disconnect()
 
     def getStart(self):
@@ -866,13 +882,14 @@ class BoxController(QObject):
     viewBoxesChanged = pyqtSignal(dict)
 
 
-    def __init__(self,editor,connectionInput,boxListModel):
+    def __init__(self,editor,connectionInput,boxListModel,densityIntegral=None):
         '''
         Class which controls all boxes on the scene
 
         :param scene:
         :param connectionInput: The imput slot to which connect all the new boxes
         :param boxListModel:
+        :param densityIntegral: (optional) OpDensityIntegral of connectionInput, used to sum all boxes at once
 
         '''
 
@@ -883,7 +900,13 @@ class BoxController(QObject):
         self._setUpRandomColors()
         self.scene=scene
         self.connectionInput=connectionInput
+        self._densityIntegral=densityIntegral
         self._currentBoxesList=[]
+        # The sums are computed in the background, only the latest ones are shown
+        self._sumRequestCount=0
+        self.threadRouter=ThreadRouter(self)
+        if densityIntegral is not None:
+            densityIntegral.Output.notifyDirty(self.updateBoxSums)
         #self._currentActiveItem=[]
         #self.counter=1000
         self.currentColor=self._getNextBoxColor()
@@ -935,7 +958,8 @@ class BoxController(QObject):
         w=stop[0]-start[0]
         if h*w<9: return #too small
 
-        rect=CoupledRectangleElement(start[0],start[1],h,w,self.connectionInput,editor = self._editor, scene=self.scene,parent=self.scene.parent())
+        rect=CoupledRectangleElement(start[0],start[1],h,w,self.connectionInput,editor = self._editor, scene=self.scene,parent=self.scene.parent(),
+                                     updateSums=self.updateBoxSums if self._densityIntegral is not None else None)
         rect.setZValue(len(self._currentBoxesList))
         rect.setColor(self.currentColor)
         #self.counter-=1
@@ -962,6 +986,35 @@ class BoxController(QObject):
 
         self.currentColor=self._getNextBoxColor()
 
+    @threadRouted
+    def updateBoxSums(self, *args):
+        '''
+        Sum all boxes with a single request to the OpDensityIntegral, so that the blocks
+        they share are only computed once.  Summing may need to predict the blocks under
+        the boxes, so it doesn't block the gui.
+        '''
+        self._sumRequestCount += 1
+        rects = [rect for rect in self._currentBoxesList if rect._rectItem.scene()]
+        if not rects:
+            return
+        boxes = [(rect.getStart(), rect.getStop()) for rect in rects]
+        req = Request(partial(self._densityIntegral.boxSums, boxes))
+        req.notify_finished(partial(self._showBoxSums, self._sumRequestCount, rects))
+        req.notify_failed(self._handleSumFailure)
+        req.submit()
+
+    @threadRouted
+    def _showBoxSums(self, requestCount, rects, sums):
+        if requestCount != self._sumRequestCount:
+            # The boxes have changed since the sums were requested
+            return
+        for rect, value in zip(rects, sums):
+            if rect._rectItem.scene():
+                rect._showValue(value)
+
+    def _handleSumFailure(self, exc, exc_info):
+        warnings.warn(f'Warning: invalid subregion. {exc}', RuntimeWarning)
+
     def _fixedBoxesChanged(self, *args):
         boxes = {"rois" : [], "values" : []}
         for box, rect in zip(self.boxListModel._elements, self._currentBoxesList):
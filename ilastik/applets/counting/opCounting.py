@@ -22,6 +22,7 @@ from __future__ import division
 #Python
 from builtins import range
 from past.utils import old_div
+import collections
 import copy
 from functools import partial
 import itertools
@@ -53,6 +54,15 @@ from ilastik.applets.base.applet import DatasetConstraintError
 
 
 class OpVolumeOperator(Operator):
+    """
+    Reduce the whole volume to a single value, e.g. the sum of a density map.
+
+    The Function must be a reduction that can be applied hierarchically
+    (e.g. numpy.sum, numpy.max): it is applied to each block of the input,
+    and then to the array of block results.
+    The block results are cached, so if the input becomes dirty,
+    only the blocks that intersect the dirty roi are recomputed.
+    """
     name = "OpVolumeOperator"
     description = "Do Operations involving the whole volume"
 
@@ -63,6 +73,13 @@ class OpVolumeOperator(Operator):
     DefaultBlockSize = (128, 128, None)
     blockShape = InputSlot(value=DefaultBlockSize)
 
+    def __init__(self, *args, **kwargs):
+        super(OpVolumeOperator, self).__init__(*args, **kwargs)
+        self._blockResults = {} # block index -> result of Function for that block
+        self._fullBlockShape = None
+        self._generation = 0 # incremented whenever cached block results are discarded
+        self._lock = threading.Lock()
+
     def setupOutputs(self):
         testInput = numpy.ones((3,3))
         testFun = self.Function.value
@@ -71,59 +88,357 @@ class OpVolumeOperator(Operator):
         self.outputs["Output"].meta.dtype = testOutput.dtype
         self.outputs["Output"].meta.shape = (1,)
         self.outputs["Output"].setDirty((slice(0,1,None),))
-        self.cache = None
-        self._lock = threading.Lock()
 
+        # self.blockshape has None in the last dimension to indicate that it should not be
+        # handled block-wise. None is replaced with the image shape in the respective axis.
+        shape = self.Input.meta.shape
+        fullBlockShape = []
+        for u, v in zip(self.blockShape.value, shape):
+            if u is not None:
+                fullBlockShape.append(u)
+            else:
+                fullBlockShape.append(v)
+        fullBlockShape = numpy.array(fullBlockShape, dtype=int)
+
+        with self._lock:
+            if self._fullBlockShape is None or len(shape) != len(self._shape) or (shape != self._shape).any() \
+                    or (fullBlockShape != self._fullBlockShape).any():
+                self._blockResults = {}
+                self._generation += 1
+            self._shape = numpy.array(shape)
+            self._fullBlockShape = fullBlockShape
+
+    def _blockSlicing(self, blockIndex):
+        start = numpy.array(blockIndex) * self._fullBlockShape
+        stop = numpy.minimum(start + self._fullBlockShape, self._shape)
+        return roiToSlice(start, stop)
 
     def execute(self, slot, subindex, roi, result):
         with self._lock:
-            if self.cache is None:
-                shape = self.Input.meta.shape
-                # self.blockshape has None in the last dimension to indicate that it should not be
-                # handled block-wise. None is replaced with the image shape in the respective axis.
-                fullBlockShape = []
-                for u, v in zip(self.blockShape.value, shape):
-                    if u is not None:
-                        fullBlockShape.append(u)
-                    else:
-                        fullBlockShape.append(v)
-                fullBlockShape = numpy.array(fullBlockShape, dtype=numpy.float64)
-
-                #data = self.inputs["Input"][:].wait()
-                #split up requests into blocks
-
-                numBlocks = numpy.ceil(shape / fullBlockShape).astype("int")
-                blockCache = numpy.ndarray(shape = numpy.prod(numBlocks), dtype=self.Output.meta.dtype)
-                pool = RequestPool()
-                #blocks holds the different roi keys for each of the blocks
-                blocks = itertools.product(*[list(range(i)) for i in numBlocks])
-                blockKeys = []
-                for b in blocks:
-                    start = b * fullBlockShape
-                    stop = b * fullBlockShape + fullBlockShape
-                    stop = numpy.min(numpy.vstack((stop, shape)), axis=0)
-                    blockKey = roiToSlice(start, stop)
-                    blockKeys.append(blockKey)
-
-                fun = self.inputs["Function"].value
-                def predict_block(i):
-                    data = self.Input[blockKeys[i]].wait()
-                    blockCache[i] = fun(data)
-
-                for i,f in enumerate(blockCache):
-                    req = pool.request(partial(predict_block,i))
-
-                pool.wait()
-                pool.clean()
-
-                self.cache = [fun(blockCache)]
-            return self.cache
+            generation = self._generation
+            numBlocks = numpy.ceil(self._shape / self._fullBlockShape.astype(numpy.float64)).astype(int)
+            allBlocks = list(itertools.product(*[list(range(i)) for i in numBlocks]))
+            blockResults = dict(self._blockResults)
+
+        # Compute the blocks we don't have yet (in parallel)
+        fun = self.inputs["Function"].value
+        missingBlocks = [b for b in allBlocks if b not in blockResults]
+        newResults = {}
+        def reduce_block(blockIndex):
+            data = self.Input[self._blockSlicing(blockIndex)].wait()
+            newResults[blockIndex] = fun(data)
+
+        pool = RequestPool()
+        for blockIndex in missingBlocks:
+            pool.add(Request(partial(reduce_block, blockIndex)))
+        pool.wait()
+        pool.clean()
+
+        blockResults.update(newResults)
+        with self._lock:
+            # If anything was invalidated in the meantime, our new results may be outdated.
+            # (The output is dirty again, so we'll be asked again.)
+            if generation == self._generation:
+                self._blockResults.update(newResults)
+
+        blockCache = numpy.array([blockResults[b] for b in allBlocks], dtype=self.Output.meta.dtype)
+        result[0] = fun(blockCache)
+        return result
 
     def propagateDirty(self, slot, subindex, roi):
-        key = roi.toSlice()
-        if slot == self.Input or slot == self.Function:
-            self.outputs["Output"].setDirty( slice(None) )
-        self.cache = None
+        with self._lock:
+            self._generation += 1
+            if slot == self.Input and self._fullBlockShape is not None:
+                # Only discard the blocks that intersect the dirty roi
+                start = numpy.maximum(numpy.array(roi.start), 0)
+                stop = numpy.minimum(numpy.array(roi.stop), self._shape)
+                if (stop > start).all():
+                    firstBlock = start // self._fullBlockShape
+                    lastBlock = (stop - 1) // self._fullBlockShape
+                    for blockIndex in list(self._blockResults.keys()):
+                        if ((firstBlock <= blockIndex) & (blockIndex <= lastBlock)).all():
+                            del self._blockResults[blockIndex]
+            else:
+                self._blockResults = {}
+        self.outputs["Output"].setDirty( slice(None) )
+
+
+class OpDensityIntegral(Operator):
+    """
+    Keeps summed-area tables (integral images) for blocks of the Input (a density map),
+    so that the sum over any box can be computed from a few table lookups: boxSum().
+
+    Blocks are only computed once a box intersects them.  Blocks that are completely covered
+    by a box only contribute their total, which is looked up in a summed-area table of the
+    block totals, so a table is only needed for the partially covered blocks at the border
+    of a box.  The tables are dropped (least recently used first) when they use more than
+    MaxTableBytes.  Only the blocks that intersect a dirty roi are recomputed.
+    """
+    name = "OpDensityIntegral"
+
+    Input = InputSlot()
+    BlockShape = InputSlot(optional=True) # By default, blocks of about 256**2 pixels are used.
+    Output = OutputSlot() # The sum of the whole input
+
+    DefaultBlockPixels = 256 ** 2
+    MaxTableBytes = 256 * 2**20
+
+    def __init__(self, *args, **kwargs):
+        super(OpDensityIntegral, self).__init__(*args, **kwargs)
+        self._tables = collections.OrderedDict() # block index -> summed-area table of the block (least recently used first)
+        self._tableBytes = 0
+        self._totals = None # the sum of each block
+        self._known = None # whether the entry of _totals is up-to-date
+        self._totalsTable = None # summed-area table of _totals
+        self._pending = {} # (block index, with table) -> request that computes the block
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def setupOutputs(self):
+        self.Output.meta.dtype = numpy.float64
+        self.Output.meta.shape = (1,)
+
+        shape = numpy.array(self.Input.meta.shape)
+        if self.BlockShape.ready():
+            blockShape = numpy.array(self.BlockShape.value)
+        else:
+            blockShape = numpy.array(determineBlockShape(list(shape), self.DefaultBlockPixels))
+        blockShape = numpy.minimum(blockShape, shape)
+
+        with self._lock:
+            self._generation += 1
+            self._shape = shape
+            self._blockShape = blockShape
+            self._numBlocks = -(-shape // blockShape)
+            self._tables = collections.OrderedDict()
+            self._tableBytes = 0
+            self._totals = numpy.zeros(tuple(self._numBlocks), dtype=numpy.float64)
+            self._known = numpy.zeros(tuple(self._numBlocks), dtype=bool)
+            self._totalsTable = None
+            self._pending = {}
+
+    def _blockRoi(self, blockIndex):
+        start = numpy.array(blockIndex) * self._blockShape
+        stop = numpy.minimum(start + self._blockShape, self._shape)
+        return start, stop
+
+    def _dropTable(self, blockIndex):
+        table = self._tables.pop(blockIndex, None)
+        if table is not None:
+            self._tableBytes -= table.nbytes
+
+    def _computeBlock(self, blockIndex, withTable):
+        """
+        Returns the total of the given block, and its summed-area table if withTable (else None).
+        """
+        start, stop = self._blockRoi(blockIndex)
+        data = self.Input(start, stop).wait()
+        if withTable:
+            table = summedAreaTable(data)
+            return table[(-1,)*table.ndim], table
+        return data.sum(dtype=numpy.float64), None
+
+    def _blockData(self, blockIndices, tableIndices):
+        """
+        Makes sure that the totals of the given blocks are known, and returns the summed-area
+        tables of the blocks in tableIndices (a subset of blockIndices) and the summed-area
+        table of the block totals.  The missing blocks are computed in parallel; blocks that
+        are already being computed for another caller are waited for instead of computed again.
+        """
+        tableIndices = set(tableIndices)
+        tables = {}
+        requests = {}
+        created = []
+        with self._lock:
+            generation = self._generation
+            totals = self._totals
+            for blockIndex in tableIndices:
+                if blockIndex in self._tables:
+                    # Move it to the end (most recently used)
+                    tables[blockIndex] = self._tables.pop(blockIndex)
+                    self._tables[blockIndex] = tables[blockIndex]
+
+            for blockIndex in blockIndices:
+                withTable = blockIndex in tableIndices
+                if blockIndex in tables or (not withTable and self._known[blockIndex]):
+                    continue
+                # A table request provides the total, too
+                req = self._pending.get((blockIndex, True))
+                if req is None and not withTable:
+                    req = self._pending.get((blockIndex, False))
+                if req is None:
+                    req = Request(partial(self._computeBlock, blockIndex, withTable))
+                    self._pending[(blockIndex, withTable)] = req
+                    created.append(((blockIndex, withTable), req))
+                requests[blockIndex] = req
+
+        try:
+            for _, req in created:
+                req.submit()
+            results = dict((blockIndex, req.wait()) for blockIndex, req in requests.items())
+        finally:
+            with self._lock:
+                for key, req in created:
+                    if self._pending.get(key) is req:
+                        del self._pending[key]
+
+        for blockIndex, (total, table) in results.items():
+            if table is not None:
+                tables[blockIndex] = table
+
+        with self._lock:
+            # Only keep the results if nothing became dirty in the meantime
+            if generation == self._generation:
+                for blockIndex, (total, table) in results.items():
+                    self._totals[blockIndex] = total
+                    self._known[blockIndex] = True
+                    if table is not None and blockIndex not in self._tables:
+                        self._tables[blockIndex] = table
+                        self._tableBytes += table.nbytes
+                while self._tableBytes > self.MaxTableBytes:
+                    self._dropTable(next(iter(self._tables)))
+                if results or self._totalsTable is None:
+                    self._totalsTable = summedAreaTable(self._totals)
+                return tables, self._totalsTable
+            # The sums are outdated anyway (and the dirty notification is on its way),
+            # so just make them consistent with the blocks computed here.
+            totals = totals.copy()
+        for blockIndex, (total, _) in results.items():
+            totals[blockIndex] = total
+        return tables, summedAreaTable(totals)
+
+    def boxSum(self, start, stop):
+        """
+        The sum of the input within the box [start, stop).
+        """
+        return self.boxSums([(start, stop)])[0]
+
+    def boxSums(self, boxes):
+        """
+        The sums of the input within each of the given boxes [(start, stop), ...].
+        Only the blocks that intersect the boxes are computed, all of them in one go.
+        """
+        shape, blockShape, numBlocks = self._shape, self._blockShape, self._numBlocks
+
+        boxBlocks = []
+        blockIndices = set()
+        tableIndices = set()
+        for start, stop in boxes:
+            start = numpy.clip(numpy.array(start), 0, shape)
+            stop = numpy.clip(numpy.array(stop), start, shape)
+            if (stop <= start).any():
+                boxBlocks.append(None)
+                continue
+
+            # Intersecting blocks: [first, last]
+            first = start // blockShape
+            last = (stop - 1) // blockShape
+
+            # Blocks that are completely inside the box: [innerFirst, innerStop)
+            innerFirst = -(-start // blockShape)
+            innerStop = numpy.where(stop == shape, numBlocks, stop // blockShape)
+            innerStop = numpy.maximum(innerStop, innerFirst)
+
+            # Only the totals of the inner blocks are needed, so just look for the unknown ones.
+            inner = tuple(slice(a, b) for a, b in zip(innerFirst, innerStop))
+            missing = numpy.argwhere(~self._known[inner]) + innerFirst
+            blockIndices.update(tuple(int(i) for i in blockIndex) for blockIndex in missing)
+
+            borderBlocks = list(borderBlockIndices(first, last, innerFirst, innerStop))
+            blockIndices.update(borderBlocks)
+            tableIndices.update(borderBlocks)
+            boxBlocks.append((start, stop, innerFirst, innerStop, borderBlocks))
+
+        tables, totalsTable = self._blockData(sorted(blockIndices), sorted(tableIndices))
+
+        sums = []
+        for box in boxBlocks:
+            if box is None:
+                sums.append(0.0)
+                continue
+            start, stop, innerFirst, innerStop, borderBlocks = box
+            total = 0.0
+            if (innerStop > innerFirst).all():
+                total += tableSum(totalsTable, innerFirst, innerStop)
+            for blockIndex in borderBlocks:
+                blockStart, blockStop = self._blockRoi(blockIndex)
+                localStart = numpy.maximum(start, blockStart) - blockStart
+                localStop = numpy.minimum(stop, blockStop) - blockStart
+                total += tableSum(tables[blockIndex], localStart, localStop)
+            sums.append(total)
+        return sums
+
+    def execute(self, slot, subindex, roi, result):
+        allBlocks = list(numpy.ndindex(*self._numBlocks))
+        _, totalsTable = self._blockData(allBlocks, [])
+        result[0] = totalsTable[(-1,)*totalsTable.ndim]
+        return result
+
+    def propagateDirty(self, slot, subindex, roi):
+        with self._lock:
+            self._generation += 1
+            if slot == self.Input:
+                start = numpy.maximum(numpy.array(roi.start), 0)
+                stop = numpy.minimum(numpy.array(roi.stop), self._shape)
+                if (stop > start).all():
+                    first = start // self._blockShape
+                    last = (stop - 1) // self._blockShape
+                    self._known[tuple(slice(a, b+1) for a, b in zip(first, last))] = False
+                    for blockIndex in list(self._tables.keys()):
+                        if ((first <= blockIndex) & (blockIndex <= last)).all():
+                            self._dropTable(blockIndex)
+                    for key in list(self._pending.keys()):
+                        if ((first <= key[0]) & (key[0] <= last)).all():
+                            del self._pending[key]
+            else:
+                self._tables = collections.OrderedDict()
+                self._tableBytes = 0
+                self._known[...] = False
+                self._pending = {}
+        self.Output.setDirty(slice(None))
+
+
+def borderBlockIndices(first, last, innerFirst, innerStop):
+    """
+    The blocks in [first, last] that are not in [innerFirst, innerStop).
+    They are split into disjoint ranges: inside of the inner range for the axes before 'axis',
+    outside of it for 'axis'.
+    """
+    for axis in range(len(first)):
+        ranges = []
+        for a in range(len(first)):
+            if a < axis:
+                ranges.append([(innerFirst[a], innerStop[a])])
+            elif a == axis:
+                ranges.append([(first[a], innerFirst[a]), (innerStop[a], last[a]+1)])
+            else:
+                ranges.append([(first[a], last[a]+1)])
+
+        for blockRanges in itertools.product(*ranges):
+            for blockIndex in itertools.product(*[range(*r) for r in blockRanges]):
+                yield blockIndex
+
+def summedAreaTable(data):
+    """
+    The summed-area table of the given array, with an extra zero entry at the start of each axis:
+    table[i, j, ...] is the sum of data[:i, :j, ...].
+    """
+    table = numpy.zeros(tuple(numpy.array(data.shape) + 1), dtype=numpy.float64)
+    table[(slice(1, None),)*data.ndim] = data
+    for axis in range(data.ndim):
+        numpy.cumsum(table, axis=axis, out=table)
+    return table
+
+def tableSum(table, start, stop):
+    """
+    The sum of the data within [start, stop), from its summed-area table (see summedAreaTable()).
+    """
+    total = 0.0
+    for corner in itertools.product(*[(0, 1)]*len(start)):
+        index = tuple(stop[a] if c else start[a] for a, c in enumerate(corner))
+        sign = (-1) ** (len(start) - sum(corner))
+        total += sign * table[index]
+    return total
 
 
 # FIXME: this operator does _not_ calculate anything related to data - just
@@ -23,7 +23,7 @@ from contextlib import contextmanager
 
 import numpy as np
 
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer
 from PyQt5.QtGui import QColor, QPen, QIcon
 from PyQt5.QtWidgets import QWidget, QLabel, QDoubleSpinBox, QVBoxLayout, QHBoxLayout, \
                             QSpacerItem, QSizePolicy, QPushButton, QMessageBox, \
@@ -32,6 +32,7 @@ from PyQt5.QtWidgets import QWidget, QLabel, QDoubleSpinBox, QVBoxLayout, QHBoxL
 from ilastikrag.gui import FeatureSelectionDialog
 
 from ilastik.utility.gui import threadRouted
+from ilastik.utility.edgeLookup import EdgePenChanges
 from ilastik.shell.gui.iconMgr import ilastikIcons
 from ilastik.applets.layerViewer.layerViewerGui import LayerViewerGui
 
@@ -46,6 +47,9 @@ logger = logging.getLogger(__name__)
 
 class EdgeTrainingGui(LayerViewerGui):
 
+    # How long to wait after the last label change before the probabilities are updated
+    PROBABILITY_UPDATE_DELAY_MS = 300
+
     ###########################################
     ### AppletGuiInterface Concrete Methods ###
     ###########################################
@@ -57,6 +61,7 @@ class EdgeTrainingGui(LayerViewerGui):
         # Unsubscribe to all signals
         for fn in self.__cleanup_fns:
             fn()
+        self._probability_update_timer.stop()
 
         # Base class
         super( EdgeTrainingGui, self ).stopAndCleanUp()
@@ -257,21 +262,41 @@ class EdgeTrainingGui(LayerViewerGui):
             pen.setColor(color)
             self.probability_pen_table.append(pen)
 
+        # pens of the last update of the probability edge layer
+        self._probability_pen_changes = EdgePenChanges(self.probability_pen_table)
+
+        # Each label click makes the probabilities dirty (and retrains the classifier when they are requested).
+        # Wait until the user pauses labeling before we ask for the new probabilities.
+        self._probability_update_timer = QTimer(self)
+        self._probability_update_timer.setSingleShot(True)
+        self._probability_update_timer.setInterval(self.PROBABILITY_UPDATE_DELAY_MS)
+        self._probability_update_timer.timeout.connect( self.update_probability_edges )
+        self._probability_update_generation = 0
+
         # When the edge probabilities are dirty, update the probability edge layer pens
         op = self.topLevelOperatorView
-        cleanup_fn = op.EdgeProbabilitiesDict.notifyDirty( self.update_probability_edges, defer=True )
+        cleanup_fn = op.EdgeProbabilitiesDict.notifyDirty( self._schedule_probability_update, defer=True )
         self.__cleanup_fns.append( cleanup_fn )
 
+    @threadRouted
+    def _schedule_probability_update(self, *args):
+        # (Re)start the timer: rapid successive label changes result in a single update.
+        self._probability_update_timer.start()
+
     def update_probability_edges(self, *args):
+        self._probability_update_generation += 1
+        generation = self._probability_update_generation
+
         def _impl():
             op = self.topLevelOperatorView
             if not self.getLayerByName("Edge Probabilities"):
                 return
             edge_probs = op.EdgeProbabilitiesDict.value
-            new_pens = {}
-            for id_pair, probability in list(edge_probs.items()):
-                new_pens[id_pair] = self.probability_pen_table[int(probability * 100)]
-            self.apply_new_probability_edges(new_pens)
+            if generation != self._probability_update_generation:
+                # A newer update has been submitted in the meantime.
+                return
+            pen_indices = (np.asarray(edge_probs.values) * 100).astype(int)
+            self.apply_new_probability_edges(generation, edge_probs.edge_ids, pen_indices)
 
         # submit the worklaod in a request and return immediately
         req = Request(_impl).submit()
@@ -280,12 +305,21 @@ class EdgeTrainingGui(LayerViewerGui):
         self.parentApplet.appletStateUpdateRequested()
 
     @threadRouted
-    def apply_new_probability_edges(self, new_pens):
+    def apply_new_probability_edges(self, generation, edge_ids, pen_indices):
         # This function is threadRouted because you can't 
         # touch the layer colortable outside the main thread.
+        # (The pens are diffed here, too, so that the diffs are applied in the order they were made.)
+        if generation != self._probability_update_generation:
+            # Outdated: a newer update has been submitted in the meantime.
+            return
         superpixel_edge_layer = self.getLayerByName("Edge Probabilities")
         if superpixel_edge_layer:
-            superpixel_edge_layer.pen_table.overwrite(new_pens)
+            # Only hand the edges whose pen changed over to the layer
+            new_pens, overwrite = self._probability_pen_changes.changed_pens(edge_ids, pen_indices)
+            if overwrite:
+                superpixel_edge_layer.pen_table.overwrite(new_pens)
+            elif new_pens:
+                superpixel_edge_layer.pen_table.update(new_pens)
 
 
     @contextmanager
@@ -358,6 +392,7 @@ class EdgeTrainingGui(LayerViewerGui):
             layer.name = "Edge Probabilities" # Name is hard-coded in multiple places: grep before changing.
             layer.visible = False
             layer.opacity = 1.0
+            self._probability_pen_changes.reset() # new layer, set all pens
             self.update_probability_edges() # Initialize
 
             layer.contexts.append( self.create_prefetch_menu("Edge Probabilities") )
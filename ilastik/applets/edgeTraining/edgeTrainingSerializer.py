@@ -94,11 +94,17 @@ class SerialEdgeLabelsDictSlot(SerialSlot):
 
 class SerialCachedDataFrameSlot(SerialSlot):
     def __init__(self, slot, cache, inslot=None, name=None,
-                 default=None, depends=None, selfdepends=True):
+                 default=None, depends=None, selfdepends=True, feature_op=None):
+        """
+        feature_op: (optional) The multi-lane operator that computed the dataframe.
+                    If given, its lanes are seeded with the deserialized columns,
+                    so they don't have to be recomputed when more features are selected.
+        """
         super(SerialCachedDataFrameSlot, self).__init__(
             slot, inslot, name, None, default, depends, selfdepends
         )
         self.cache = cache
+        self.feature_op = feature_op
         if self.name is None:
             self.name = slot.name
         
@@ -136,6 +142,8 @@ class SerialCachedDataFrameSlot(SerialSlot):
             slot_index = slot.operator.index(slot)
             inner_op = self.cache.getLane( slot_index )
             inner_op.forceValue( dataframe )
+            if self.feature_op is not None:
+                self.feature_op.getLane( slot_index ).seed_feature_columns( dataframe )
         else:
             # Pair stored indexes with their keys,
             # e.g. [(0,'0'), (2, '2'), (3, '3')]
@@ -161,7 +169,8 @@ class EdgeTrainingSerializer(AppletSerializer):
                   SerialRagSlot(operator.Rag, operator.opRagCache, operator.Superpixels),
                   SerialCachedDataFrameSlot( operator.opEdgeFeaturesCache.Output,
                                              operator.opEdgeFeaturesCache,
-                                             name="EdgeFeatures" ),
+                                             name="EdgeFeatures",
+                                             feature_op=operator.opComputeEdgeFeatures ),
                   SerialClassifierSlot(operator.opClassifierCache.Output,
                                        operator.opClassifierCache)
                  ]
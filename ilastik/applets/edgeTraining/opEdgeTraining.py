@@ -10,6 +10,7 @@ import vigra
 import ilastikrag
 
 from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.request import Request, RequestPool, RequestLock
 from lazyflow.roi import roiToSlice
 from lazyflow.operators import OpValueCache, OpBlockedArrayCache
 from lazyflow.classifiers import ParallelVigraRfLazyflowClassifierFactory
@@ -17,6 +18,8 @@ from lazyflow.classifiers import ParallelVigraRfLazyflowClassifierFactory
 from ilastik.applets.base.applet import DatasetConstraintError
 from ilastik.utility.operatorSubView import OperatorSubView
 from ilastik.utility import OpMultiLaneWrapper
+from ilastik.utility.edgeLookup import EdgeLookup
+from ilastik.config import cfg as ilastik_config
 
 import logging
 logger = logging.getLogger(__name__)
@@ -224,27 +227,73 @@ class OpComputeEdgeFeatures(Operator):
     VoxelData = InputSlot()
     Rag = InputSlot()
     EdgeFeaturesDataFrame = OutputSlot() # Includes columns 'sp1' and 'sp2'
-     
+
+    def __init__(self, *args, **kwargs):
+        super(OpComputeEdgeFeatures, self).__init__(*args, **kwargs)
+        # (channel_name, feature_name) -> DataFrame with the (prefixed) columns of that feature
+        self._feature_columns = {}
+        # edge features loaded from the project file, see seed_feature_columns()
+        self._seeded_df = None
+        self._lock = RequestLock()
+
     def setupOutputs(self):
         assert self.VoxelData.meta.getAxisKeys()[-1] == 'c'
         self.EdgeFeaturesDataFrame.meta.shape = (1,)
         self.EdgeFeaturesDataFrame.meta.dtype = object
-         
+
+    def seed_feature_columns(self, edge_features_df):
+        """
+        Make the columns of a previously computed edge feature table (e.g. from the
+        project file) available, so that they are not recomputed.
+        """
+        with self._lock:
+            self._seeded_df = edge_features_df
+
+    def _cached_columns(self, channel_name, feature_name):
+        key = (channel_name, feature_name)
+        if key in self._feature_columns:
+            return self._feature_columns[key]
+        if self._seeded_df is not None:
+            columns = _feature_column_names(self._seeded_df.columns.values, channel_name + ' ' + feature_name)
+            if columns:
+                self._feature_columns[key] = self._seeded_df[columns]
+                return self._feature_columns[key]
+        return None
+
+    def _channel_memory_budget(self):
+        """Memory budget (in bytes) for channels that are computed at the same time, or 0 if unlimited."""
+        return ilastik_config.getint('edge training', 'edge_feature_memory_mb') * 2**20
+
     def execute(self, slot, subindex, roi, result):
         rag = self.Rag.value
         channel_feature_names = self.FeatureNames.value
 
-        edge_feature_dfs =[]
-        for c in range( self.VoxelData.meta.shape[-1] ):
-            channel_name = self.VoxelData.meta.channel_names[c]
-            if channel_name not in channel_feature_names:
-                continue
-            
-            feature_names = [decodeToStringIfBytes(f) for f in channel_feature_names[channel_name]]
-            if not feature_names:
-                # No features selected for this channel
-                continue
-
+        # Selected features per channel, and the ones we have to compute
+        selected = []
+        missing = {}
+        with self._lock:
+            for c in range( self.VoxelData.meta.shape[-1] ):
+                channel_name = self.VoxelData.meta.channel_names[c]
+                if channel_name not in channel_feature_names:
+                    continue
+
+                feature_names = [decodeToStringIfBytes(f) for f in channel_feature_names[channel_name]]
+                if not feature_names:
+                    # No features selected for this channel
+                    continue
+
+                selected.append((channel_name, feature_names))
+                uncached = [f for f in feature_names if self._cached_columns(channel_name, f) is None]
+                if uncached:
+                    missing[channel_name] = (c, uncached)
+
+        # Compute the missing columns, several channels in parallel (within the memory budget)
+        channel_bytes = np.prod(self.VoxelData.meta.shape[:-1]) * np.dtype(self.VoxelData.meta.dtype).itemsize
+        budget = self._channel_memory_budget()
+        channels_at_once = max(1, budget // max(channel_bytes, 1)) if budget > 0 else len(missing)
+        computed = {}
+
+        def compute_channel(channel_name, c, feature_names):
             voxel_data = self.VoxelData[...,c:c+1].wait()
             voxel_data = vigra.taggedView(voxel_data, self.VoxelData.meta.axistags)
             voxel_data = voxel_data[...,0] # drop channel
@@ -252,22 +301,130 @@ class OpComputeEdgeFeatures(Operator):
 
             #if np.isnan(edge_features_df.values).any():
             #    raise RuntimeError("Whoa, why are there NaN values in the feature matrix?")
-            
+
             edge_features_df = edge_features_df.iloc[:, 2:] # Discard columns [sp1, sp2]
-            
+
             # Prefix all column names with the channel name, to guarantee uniqueness
             # (Generally a nice feature, but also required for serialization.)
             edge_features_df.columns = [channel_name + ' ' + feature_name for feature_name in edge_features_df.columns.values]
-            edge_feature_dfs.append(edge_features_df)
+            computed[channel_name] = edge_features_df
+
+        missing_channels = list(missing.keys())
+        for batch_start in range(0, len(missing_channels), channels_at_once):
+            pool = RequestPool()
+            for channel_name in missing_channels[batch_start:batch_start + channels_at_once]:
+                pool.add( Request( partial(compute_channel, channel_name, *missing[channel_name]) ) )
+            pool.wait()
+
+        # The columns are always assembled in the order of the feature selection,
+        # whether they were just computed, cached or seeded, since the classifier
+        # is trained and applied on the feature matrix by position.
+        edge_feature_dfs = []
+        with self._lock:
+            for channel_name, feature_names in selected:
+                channel_df = computed.get(channel_name)
+                if channel_df is not None:
+                    self._cache_feature_columns(channel_name, missing[channel_name][1], channel_df)
+
+                for feature_name in feature_names:
+                    columns = self._cached_columns(channel_name, feature_name)
+                    if columns is not None:
+                        edge_feature_dfs.append(columns)
 
         # Could use join() or merge() here, but we know the rows are already in the right order, and concat() should be faster.
         all_edge_features_df = pd.DataFrame( rag.edge_ids, columns=['sp1', 'sp2'] )
         all_edge_features_df = pd.concat([all_edge_features_df] + edge_feature_dfs, axis=1, copy=False)
         result[0] = all_edge_features_df
- 
+
+    def _cache_feature_columns(self, channel_name, feature_names, channel_df):
+        for feature_name in feature_names:
+            columns = _feature_column_names(channel_df.columns.values, channel_name + ' ' + feature_name)
+            if columns:
+                self._feature_columns[(channel_name, feature_name)] = channel_df[columns]
+
     def propagateDirty(self, slot, subindex, roi):
+        with self._lock:
+            if slot is self.VoxelData:
+                # Only the columns of the dirty channels are outdated
+                dirty_channels = self.VoxelData.meta.channel_names[roi.start[-1]:roi.stop[-1]]
+                for key in list(self._feature_columns.keys()):
+                    if key[0] in dirty_channels:
+                        del self._feature_columns[key]
+                self._seeded_df = None
+            elif slot is self.Rag:
+                self._feature_columns = {}
+                self._seeded_df = None
         self.EdgeFeaturesDataFrame.setDirty()
-     
+
+
+def _feature_column_names(column_names, prefix):
+    """
+    The columns of a single feature: rag features are named after the feature,
+    with a suffix for multi-column features (e.g. quantiles).
+    """
+    return [name for name in column_names if name == prefix or name.startswith(prefix + '_')]
+
+
+class EdgeTrainingSet(object):
+    """
+    The training samples of a single lane: the feature rows and labels of all labeled edges.
+
+    Newly labeled edges are appended. The samples are only rebuilt from
+    scratch if existing labels were changed or removed.
+    """
+    def __init__(self, edge_features_df):
+        assert list(edge_features_df.columns[0:2]) == ['sp1', 'sp2']
+        self.edge_features_df = edge_features_df
+        self.feature_names = edge_features_df.columns[2:].values
+
+        # (sp1, sp2) -> row of the feature table
+        self._rows = EdgeLookup( edge_features_df[['sp1', 'sp2']].values, np.arange(len(edge_features_df)) )
+        self._labels_dict = {}
+
+        dtype = np.result_type(*edge_features_df.dtypes[2:]) if len(self.feature_names) else np.float32
+        self.features = np.zeros( (0, len(self.feature_names)), dtype=dtype )
+        self.labels = np.zeros( (0,), dtype=np.uint8 )
+
+    def aligned_features(self, feature_names):
+        """
+        The feature rows of the samples, with the columns in the order of the given feature names.
+        """
+        if list(self.feature_names) == list(feature_names):
+            return self.features
+        columns = pd.Index(self.feature_names).get_indexer(feature_names)
+        assert (columns != -1).all(), \
+            "Lane is missing features: {}".format( np.asarray(feature_names)[columns == -1] )
+        return self.features[:, columns]
+
+    def update(self, labels_dict):
+        """
+        Bring the samples up-to-date with the given labels dict ((sp1, sp2) -> label).
+        """
+        # Drop zero labels
+        labels_dict = { sp_ids: label for sp_ids, label in labels_dict.items() if label != 0 }
+
+        if any( labels_dict.get(sp_ids) != label for sp_ids, label in self._labels_dict.items() ):
+            # Labels were changed or removed: start over.
+            self._labels_dict = {}
+            self.features = self.features[:0]
+            self.labels = self.labels[:0]
+
+        new_labels = [ (sp_ids, label) for sp_ids, label in labels_dict.items() if sp_ids not in self._labels_dict ]
+        if not new_labels:
+            return
+        self._labels_dict.update( new_labels )
+
+        sp_ids = np.array( [sp_ids for sp_ids, _label in new_labels] ).reshape(-1, 2)
+        labels = np.array( [label for _sp_ids, label in new_labels], dtype=np.uint8 )
+
+        # Labels of edges that aren't in the feature table are ignored.
+        rows = self._rows.lookup( sp_ids, default=-1 )
+        known = (rows != -1)
+
+        new_features = self.edge_features_df.iloc[ rows[known], 2: ].values
+        self.features = np.concatenate( (self.features, new_features) )
+        self.labels = np.concatenate( (self.labels, labels[known]) )
+
 
 class OpTrainEdgeClassifier(Operator):
     EdgeLabelsDict = InputSlot(level=1)
@@ -275,55 +432,63 @@ class OpTrainEdgeClassifier(Operator):
     
     EdgeClassifier = OutputSlot()
 
+    def __init__(self, *args, **kwargs):
+        super(OpTrainEdgeClassifier, self).__init__(*args, **kwargs)
+        self._training_sets = {} # lane_index -> EdgeTrainingSet
+        self._lock = RequestLock()
+
     def setupOutputs(self):
         self.EdgeClassifier.meta.shape = (1,)
         self.EdgeClassifier.meta.dtype = object
         
     def execute(self, slot, subindex, roi, result):
-        all_features_and_labels_df = None
-
-        for lane_index, (labels_dict_slot, features_slot) in \
-                enumerate( zip(self.EdgeLabelsDict, self.EdgeFeaturesDataFrame) ):
-            logger.info("Retrieving features for lane {}...".format(lane_index))
-
-            labels_dict = labels_dict_slot.value.copy() # Copy now to avoid threading issues.
-            if not labels_dict:
-                continue
-
-            sp_columns = np.array(list(labels_dict.keys()))
-            edge_features_df = features_slot.value
-            assert list(edge_features_df.columns[0:2]) == ['sp1', 'sp2']
-
-            labels_df = pd.DataFrame(sp_columns, columns=['sp1', 'sp2'])
-            labels_df['label'] = list(labels_dict.values())
-
-            # Drop zero labels
-            labels_df = labels_df[labels_df['label'] != 0]
-            
-            # Merge in features
-            features_and_labels_df = pd.merge(edge_features_df, labels_df, how='right', on=['sp1', 'sp2'])
-            if all_features_and_labels_df is not None:
-                all_features_and_labels_df = all_features_and_labels_df.append(features_and_labels_df)
-            else:
-                all_features_and_labels_df = features_and_labels_df
-
-        if all_features_and_labels_df is None:
-            # No labels yet.
+        training_sets = []
+        with self._lock:
+            for lane_index, (labels_dict_slot, features_slot) in \
+                    enumerate( zip(self.EdgeLabelsDict, self.EdgeFeaturesDataFrame) ):
+                logger.info("Retrieving features for lane {}...".format(lane_index))
+
+                labels_dict = labels_dict_slot.value.copy() # Copy now to avoid threading issues.
+                if not labels_dict:
+                    self._training_sets.pop(lane_index, None)
+                    continue
+
+                # The training set is kept as long as the lane's feature table is the same (cached) object.
+                edge_features_df = features_slot.value
+                training_set = self._training_sets.get(lane_index)
+                if training_set is None or training_set.edge_features_df is not edge_features_df:
+                    training_set = self._training_sets[lane_index] = EdgeTrainingSet(edge_features_df)
+
+                training_set.update( labels_dict )
+                training_sets.append( training_set )
+
+            # Forget lanes that have been removed
+            for lane_index in list(self._training_sets.keys()):
+                if lane_index >= len(self.EdgeLabelsDict):
+                    del self._training_sets[lane_index]
+
+            if not training_sets:
+                # No labels yet.
+                result[0] = None
+                return
+
+            # The lanes' tables may have been built differently (e.g. loaded from the project file),
+            # so align their columns by name.  The classifier keeps these names for prediction.
+            feature_names = list(training_sets[0].feature_names)
+            feature_matrix = np.concatenate( [s.aligned_features(feature_names) for s in training_sets] )
+            labels = np.concatenate( [s.labels for s in training_sets] )
+
+        if len(labels) == 0:
+            # None of the labeled edges has features (yet).
             result[0] = None
             return
 
-        assert list(all_features_and_labels_df.columns[0:2]) == ['sp1', 'sp2']
-        assert all_features_and_labels_df.columns[-1] == 'label'
-
-        feature_matrix = all_features_and_labels_df.iloc[:, 2:-1].values # Omit 'sp1', 'sp2', and 'label'
-        labels = all_features_and_labels_df.iloc[:, -1].values
-
         logger.info("Training classifier with {} labels...".format( len(labels) ))
         # TODO: Allow factory to be configured via an input slot
         classifier_factory = ParallelVigraRfLazyflowClassifierFactory()
         classifier = classifier_factory.create_and_train( feature_matrix,
                                                           labels,
-                                                          feature_names=all_features_and_labels_df.columns[2:-1].values )
+                                                          feature_names=feature_names )
         assert set(classifier.known_classes).issubset(set([1,2]))
         result[0] = classifier
 
@@ -349,7 +514,12 @@ class OpPredictEdgeProbabilities(Operator):
             return
         
         logger.info("Predicting edge probabilities...")
-        feature_matrix = edge_features_df.iloc[:, 2:].values # Discard [sp1, sp2]
+        feature_names = getattr(classifier, 'feature_names', None)
+        if feature_names is not None and list(feature_names) != list(edge_features_df.columns[2:]):
+            # Same column order as in training
+            feature_matrix = edge_features_df[list(feature_names)].values
+        else:
+            feature_matrix = edge_features_df.iloc[:, 2:].values # Discard [sp1, sp2]
         assert feature_matrix.dtype == np.float32, "Unexpected feature dtype: {}".format( feature_matrix.dtype )
         probabilities = classifier.predict_probabilities(feature_matrix)[:,1]
         assert len(probabilities) == len(edge_features_df)
@@ -361,7 +531,8 @@ class OpPredictEdgeProbabilities(Operator):
 class OpEdgeProbabilitiesDict(Operator):
     """
     A little utility operator to combine a RAG's edge_ids
-    with an array of edge probabilities into a dict of id_pair -> probability 
+    with an array of edge probabilities into an EdgeLookup of id_pair -> probability
+    (a compact, read-only replacement for a dict, with vectorized queries)
     """
     Rag = InputSlot()
     EdgeProbabilities = InputSlot()
@@ -372,17 +543,13 @@ class OpEdgeProbabilitiesDict(Operator):
         self.EdgeProbabilitiesDict.meta.dtype = object
 
     def execute(self, slot, subindex, roi, result):
-        logger.info("Converting edge probabilities to dict...")
         rag = self.Rag.value
         edge_probabilities = self.EdgeProbabilities.value
         if edge_probabilities is None:
             # Edge probabilities are 'None' if they haven't been loaded into the cache yet.
             # Just return 0.0 for all probabilities
-            result[0] = { tuple(edge_id) : 0.0 for edge_id in rag.edge_ids }
-        else:
-            result[0] = dict(zip(map(tuple, rag.edge_ids), edge_probabilities))
-            
-        logger.info("...done")
+            edge_probabilities = np.zeros((len(rag.edge_ids),), dtype=np.float32)
+        result[0] = EdgeLookup(rag.edge_ids, edge_probabilities)
 
     def propagateDirty(self, slot, subindex, roi):
         self.EdgeProbabilitiesDict.setDirty()
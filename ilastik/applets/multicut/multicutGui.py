@@ -30,6 +30,7 @@ from PyQt5.QtWidgets import QWidget, QLabel, QDoubleSpinBox, QComboBox, QVBoxLay
                             QHBoxLayout, QSpacerItem, QSizePolicy, QPushButton
 
 from ilastik.utility.gui import threadRouted
+from ilastik.utility.edgeLookup import EdgePenChanges
 from volumina.pixelpipeline.datasources import LazyflowSource
 from volumina.layer import SegmentationEdgesLayer
 from volumina.utility import ShortcutManager, PreferencesManager
@@ -169,6 +170,10 @@ class MulticutGuiMixin(object):
             pen.setColor(color)
             self.probability_pen_table.append(pen)
 
+        # pens of the last update of the probability edge layer
+        self.__probability_pen_changes = EdgePenChanges(self.probability_pen_table)
+        self.__probability_update_generation = 0
+
         # When the edge probabilities are dirty, update the probability edge layer pens
         op = self.__topLevelOperatorView
         op.EdgeProbabilitiesDict.notifyDirty( self.__update_probability_edges )
@@ -176,25 +181,41 @@ class MulticutGuiMixin(object):
 
     # Configure the handler for updated probability maps
     # FIXME: Should we make a new Layer subclass that handles this colortable mapping for us?  Yes.
+    @threadRouted
     def __update_probability_edges(self, *args):
+        # This function is threadRouted, so the updates are numbered in the order they were requested.
+        self.__probability_update_generation += 1
+        generation = self.__probability_update_generation
+
         def _impl():
             op = self.__topLevelOperatorView
             if not self.superpixel_edge_layer:
                 return
             edge_probs = op.EdgeProbabilitiesDict.value
-            new_pens = {}
-            for id_pair, probability in list(edge_probs.items()):
-                new_pens[id_pair] = self.probability_pen_table[int(probability * 100)]
-            self.__apply_new_probability_edges(new_pens)
+            if generation != self.__probability_update_generation:
+                # A newer update has been submitted in the meantime.
+                return
+            pen_indices = (np.asarray(edge_probs.values) * 100).astype(int)
+            self.__apply_new_probability_edges(generation, edge_probs.edge_ids, pen_indices)
 
         # submit the worklaod in a request and return immediately
         Request(_impl).submit()
     
     @threadRouted
-    def __apply_new_probability_edges(self, new_pens):
+    def __apply_new_probability_edges(self, generation, edge_ids, pen_indices):
         # This function is threadRouted because you can't 
         # touch the layer colortable outside the main thread.
-        self.superpixel_edge_layer.pen_table.update(new_pens)
+        # (The pens are diffed here, too, so that the diffs are applied in the order they were made.)
+        if generation != self.__probability_update_generation or not self.superpixel_edge_layer:
+            # Outdated: a newer update has been submitted in the meantime.
+            return
+
+        # Only hand the edges whose pen changed over to the layer
+        new_pens, overwrite = self.__probability_pen_changes.changed_pens(edge_ids, pen_indices)
+        if overwrite:
+            self.superpixel_edge_layer.pen_table.overwrite(new_pens)
+        elif new_pens:
+            self.superpixel_edge_layer.pen_table.update(new_pens)
 
     
     def __init_disagreement_label_colortable(self):
@@ -222,10 +243,10 @@ class MulticutGuiMixin(object):
             if not self.disagreement_layer:
                 return
             
-            edge_disagreements = op.EdgeLabelDisagreementDict.value            
-            new_pens = {}
-            for id_pair, disagreement_label in list(edge_disagreements.items()):
-                new_pens[id_pair] = self.disagreement_pen_table[disagreement_label]
+            edge_disagreements = op.EdgeLabelDisagreementDict.value
+            pen_table = self.disagreement_pen_table
+            new_pens = dict(zip(edge_disagreements.keys(),
+                                [pen_table[label] for label in edge_disagreements.values.tolist()]))
             self.__apply_disagreement_edges(new_pens)
 
         # submit the worklaod in a request and return immediately
@@ -395,6 +416,7 @@ class MulticutGuiMixin(object):
             layer.visible = True
             layer.opacity = 1.0
             self.superpixel_edge_layer = layer
+            self.__probability_pen_changes.reset() # new layer, set all pens
             self.__update_probability_edges() # Initialize
             layers.append(layer)
             del layer
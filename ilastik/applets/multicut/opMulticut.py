@@ -9,10 +9,15 @@ if True:
 
     from lazyflow.graph import Operator, InputSlot, OutputSlot
     from lazyflow.operators import OpBlockedArrayCache, OpValueCache
+    from lazyflow.request import Request, RequestPool, RequestLock
+    from lazyflow.roi import determineBlockShape
     from lazyflow.utility import Timer
 
+    from ilastik.utility.edgeLookup import EdgeLookup
+
     import sys
     import subprocess
+    from functools import partial
 
     import logging
     logger = logging.getLogger(__name__)
@@ -92,7 +97,13 @@ if True:
             # Nifty isn't available at all
             NIFTY_SOLVER_NAMES = []
 
-    AVAILABLE_SOLVER_NAMES = NIFTY_SOLVER_NAMES + OPENGM_SOLVER_NAMES
+    # Blockwise decomposition of large problems, see solve_decomposed()
+    if NIFTY_SOLVER_NAMES:
+        DECOMPOSED_SOLVER_NAMES = ['Nifty_DecomposedFmGreedy']
+    else:
+        DECOMPOSED_SOLVER_NAMES = []
+
+    AVAILABLE_SOLVER_NAMES = NIFTY_SOLVER_NAMES + DECOMPOSED_SOLVER_NAMES + OPENGM_SOLVER_NAMES
 
     if not AVAILABLE_SOLVER_NAMES:
         raise ImportError("Can't import OpMulticut: No solver libraries detected!")
@@ -202,6 +213,10 @@ if True:
 
 
     class OpEdgeLabelDisagreementDict(Operator):
+        """
+        An EdgeLookup of id_pair -> edge label (taken from the node labels)
+        for the edges on which the node labels disagree with the edge probabilities.
+        """
         Rag = InputSlot()
         NodeLabels = InputSlot()
         EdgeProbabilities = InputSlot()
@@ -216,7 +231,7 @@ if True:
             node_labels = self.NodeLabels.value
             if node_labels is None:
                 # This can happen when the cache doesn't have data yet.
-                result[0] = {}
+                result[0] = EdgeLookup(np.zeros((0, 2), dtype=np.uint32), np.zeros((0,), dtype=np.uint8))
                 return
 
             rag = self.Rag.value
@@ -233,7 +248,7 @@ if True:
                                  edge_labels_from_probabilities)
             conflict_edge_ids = edge_ids[conflicts]
             conflict_labels = edge_labels_from_nodes[conflicts]
-            result[0] = dict(zip(map(tuple, conflict_edge_ids), conflict_labels))
+            result[0] = EdgeLookup(conflict_edge_ids, conflict_labels)
 
         def propagateDirty(self, slot, subindex, roi):
             self.EdgeLabelDisagreementDict.setDirty()
@@ -247,6 +262,12 @@ if True:
         EdgeProbabilities = InputSlot()
         NodeLabels = OutputSlot()  # 1D array, mapping superpixels to segment labels
 
+        def __init__(self, *args, **kwargs):
+            super(OpMulticutAgglomerator, self).__init__(*args, **kwargs)
+            # Solver state of the current RAG, kept between solves
+            self._session = None
+            self._session_lock = RequestLock()
+
         def setupOutputs(self):
             self.NodeLabels.meta.shape = (1,)
             self.NodeLabels.meta.dtype = object
@@ -261,9 +282,12 @@ if True:
                 result[0] = np.zeros((rag.max_sp + 1,), dtype=np.uint32)
                 return
 
-            with Timer() as timer:
-                node_labeling = self.agglomerate_with_multicut(
-                    rag, edge_probabilities, beta, solver_name)
+            with self._session_lock:
+                if self._session is None or self._session.rag is not rag:
+                    self._session = MulticutSession(rag)
+                with Timer() as timer:
+                    node_labeling = self.agglomerate_with_multicut(
+                        rag, edge_probabilities, beta, solver_name, self._session)
             logger.info("'{}' Multicut took {} seconds".format(
                 solver_name, timer.seconds()))
 
@@ -273,10 +297,12 @@ if True:
             result[0] = node_labeling
 
         def propagateDirty(self, slot, subindex, roi):
+            if slot is self.Rag:
+                self._session = None
             self.NodeLabels.setDirty()
 
         @classmethod
-        def agglomerate_with_multicut(cls, rag, edge_probabilities, beta, solver_name):
+        def agglomerate_with_multicut(cls, rag, edge_probabilities, beta, solver_name, session=None):
             """
             rag: ilastikrag.Rag
 
@@ -287,6 +313,9 @@ if True:
 
             solver_name: The multicut solver used. Format: library_solver (e.g. opengm_Exact, nifty_Exact)
 
+            session: optional MulticutSession of the rag from a previous solve, to re-use
+                     its graph and warm-start from its solution.
+
             Returns: An index array [0,1,...,N] indicating the new labels for the N nodes of the RAG.
             """
             #
@@ -296,33 +325,110 @@ if True:
             assert solver_name in AVAILABLE_SOLVER_NAMES, \
                 "'{}' is not a valid solver name.".format(solver_name)
 
+            if session is None:
+                session = MulticutSession(rag)
+            assert session.rag is rag
+
+            session.set_edge_probabilities(edge_probabilities)
+            return session.solve(beta, solver_name)
+
+
+    class MulticutSession(object):
+        """
+        The solver state of one RAG: the solver graph (built once), the
+        edge weights of the current edge probabilities and the last
+        solution.
+
+        A change of beta only shifts the edge weights, so it does not
+        recompute them from the probabilities, and the Fusion-Move solvers
+        are warm-started from the last solution instead of a greedy-additive
+        initialization.
+        """
+        def __init__(self, rag):
+            self.rag = rag
+
             # The Rag is allowed to contain non-consecutive superpixel labels,
             # but for OpenGM, we require node_count > max_id
             # Therefore, use max_sp, not num_sp
-            node_count = rag.max_sp + 1
+            self.node_count = rag.max_sp + 1
             if rag.num_sp != rag.max_sp + 1:
                 warnings.warn("Superpixel IDs are not consecutive. GM will contain excess variables to fill the gaps."
                               " (num_sp = {}, max_sp = {})".format(rag.num_sp, rag.max_sp))
-            #
-            # Solve
-            #
-            edge_weights = compute_edge_weights(
-                rag.edge_ids, edge_probabilities, beta)
-            assert edge_weights.shape == (rag.num_edges,)
+
+            self._nifty_graph = None
+            self._edge_probabilities = None
+            self._probability_weights = None
+            self.node_labels = None
+
+        @property
+        def nifty_graph(self):
+            if self._nifty_graph is None:
+                self._nifty_graph = nifty_graph(self.rag.edge_ids, self.node_count)
+            return self._nifty_graph
+
+        def set_edge_probabilities(self, edge_probabilities):
+            """
+            Update the edge probabilities (same order as rag.edge_ids).
+            The edge weights are only recomputed if they changed.
+            """
+            if self._edge_probabilities is edge_probabilities:
+                return
+            if self._edge_probabilities is not None and \
+                    np.array_equal(self._edge_probabilities, edge_probabilities):
+                return
+            self._edge_probabilities = edge_probabilities
+            # beta = 0.5 adds no offset
+            self._probability_weights = compute_edge_weights(
+                self.rag.edge_ids, edge_probabilities, 0.5)
+
+        def edge_weights(self, beta):
+            """
+            The edge weights of the current edge probabilities for the given beta.
+            Equivalent to compute_edge_weights(), without recomputing the probability terms.
+            """
+            assert self._probability_weights is not None, "No edge probabilities set"
+            edge_weights = self._probability_weights + np.log(old_div((1 - beta), (beta)))
+            edge_weights[self.rag.edge_ids[:, 0] == 0] = MINIMUM_ENERGY
+            return edge_weights
+
+        def solve(self, beta, solver_name):
+            """
+            Solve the multicut problem for the current edge probabilities.
+
+            Returns: An index array [0,1,...,N] indicating the new labels for the N nodes of the RAG.
+            """
+            edge_weights = self.edge_weights(beta)
+            assert edge_weights.shape == (self.rag.num_edges,)
 
             solver_library, solver_method = solver_name.split('_')
-            if solver_library == 'Nifty':
+            if solver_library == 'Nifty' and solver_method.startswith('Decomposed'):
+                mapping_index_array = solve_decomposed(
+                    self.rag.label_img, self.rag.edge_ids, edge_weights, self.node_count,
+                    solver_method[len('Decomposed'):])
+            elif solver_library == 'Nifty':
                 mapping_index_array = solve_with_nifty(
-                    rag.edge_ids, edge_weights, node_count, solver_method)
+                    self.rag.edge_ids, edge_weights, self.node_count, solver_method,
+                    graph=self.nifty_graph, initial_labels=self.node_labels)
             elif solver_library == 'Opengm':
                 mapping_index_array = solve_with_opengm(
-                    rag.edge_ids, edge_weights, node_count, solver_method)
+                    self.rag.edge_ids, edge_weights, self.node_count, solver_method)
             else:
                 raise RuntimeError(
                     "Unknown solver library: '{}'".format(solver_library))
 
+            self.node_labels = mapping_index_array
             return mapping_index_array
 
+        def resolve_with_beta(self, beta, solver_name):
+            """
+            Re-solve the problem of the last edge probabilities with a new beta.
+            """
+            return self.solve(beta, solver_name)
+
+
+    # Energy of edges touching label 0, see compute_edge_weights()
+    MINIMUM_ENERGY = -1000.0
+
 
     def compute_edge_weights(edge_ids, edge_probabilities, beta):
         """
@@ -352,13 +458,23 @@ if True:
         if edges_touching_zero.any():
             logger.warning(
                 "Volume contains label 0, which will be excluded from the segmentation.")
-            MINIMUM_ENERGY = -1000.0
             edge_weights[edges_touching_zero] = MINIMUM_ENERGY
 
         return edge_weights
 
 
-    def solve_with_nifty(edge_ids, edge_weights, node_count, solver_method):
+    def nifty_graph(edge_ids, node_count):
+        """
+        Create the nifty graph of the given edges.
+        """
+        # TODO: I don't know if this handles non-consecutive sp-ids properly
+        g = nifty.graph.UndirectedGraph(int(node_count))
+        g.insertEdges(edge_ids)
+        return g
+
+
+    def solve_with_nifty(edge_ids, edge_weights, node_count, solver_method, graph=None, initial_labels=None,
+                         number_of_threads=8):
         """
         Solve the given multicut problem with the 'Nifty' library and return an
         index array that maps node IDs to segment IDs.
@@ -372,11 +488,24 @@ if True:
                           If your superpixel IDs are not consecutive, node_count should be max_sp_id+1
 
         solver_method: One of 'ExactCplex', 'FmGreedy', etc.
+
+        graph: optional nifty graph of edge_ids (see nifty_graph()), to avoid rebuilding it.
+
+        initial_labels: optional node labeling (e.g. a previous solution) used as the
+                        starting point of the Fusion-Move solvers instead of the
+                        greedy-additive initialization.
+
+        number_of_threads: threads used by the Fusion-Move solvers
         """
-        # TODO: I don't know if this handles non-consecutive sp-ids properly
-        g = nifty.graph.UndirectedGraph(int(node_count))
-        g.insertEdges(edge_ids)
-        obj = nifty.graph.multicut.multicutObjective(g, edge_weights)
+        if graph is None:
+            graph = nifty_graph(edge_ids, node_count)
+        obj = nifty.graph.multicut.multicutObjective(graph, edge_weights)
+
+        def getInitialLabels():
+            if initial_labels is not None and len(initial_labels) == int(node_count):
+                return initial_labels.astype(np.uint64)
+            greedy = obj.greedyAdditiveFactory().create(obj)
+            return greedy.optimize()
 
         def getIlpFac(ilpSolver):
             return obj.multicutIlpFactory(
@@ -390,7 +519,7 @@ if True:
                 proposalGenerator=obj.watershedCcProposals(
                     sigma=1, numberOfSeeds=0.01),
                 numberOfIterations=500,
-                numberOfThreads=8,
+                numberOfThreads=number_of_threads,
                 stopIfNoImprovement=20
             )
 
@@ -403,18 +532,15 @@ if True:
             inf = getIlpFac('gurobi').create(obj)
 
         elif solver_method == 'FmCplex':
-            greedy = obj.greedyAdditiveFactory().create(obj)
-            ret = greedy.optimize()
+            ret = getInitialLabels()
             inf = getFmFac(getIlpFac('cplex')).create(obj)
 
         elif solver_method == 'FmGurobi':
-            greedy = obj.greedyAdditiveFactory().create(obj)
-            ret = greedy.optimize()
+            ret = getInitialLabels()
             inf = getFmFac(getIlpFac('gurobi')).create(obj)
 
         elif solver_method == 'FmGreedy':
-            greedy = obj.greedyAdditiveFactory().create(obj)
-            ret = greedy.optimize()
+            ret = getInitialLabels()
             inf = getFmFac(obj.greedyAdditiveFactory()).create(obj)
 
         else:
@@ -429,6 +555,118 @@ if True:
         return mapping_index_array
 
 
+    # Size of the blocks of the decomposed multicut (in voxels)
+    DECOMPOSITION_BLOCK_VOXELS = 256**3
+
+
+    def assign_nodes_to_blocks(label_img, node_count, block_shape):
+        """
+        Assign every node of the RAG to the first spatial block (in C order)
+        that contains any of its voxels.
+
+        label_img: superpixel volume, without channel axis
+
+        Returns: (node_blocks, block_count), where node_blocks is an array with the block
+                 index of every node ID (block_count for IDs that are not in the volume).
+        """
+        shape = label_img.shape
+        grid = tuple(-(-s // b) for s, b in zip(shape, block_shape))
+        block_count = int(np.prod(grid))
+
+        block_labels = [None] * block_count
+
+        def find_labels(block_index):
+            block_coord = np.unravel_index(block_index, grid)
+            slicing = tuple(slice(c * b, (c + 1) * b) for c, b in zip(block_coord, block_shape))
+            block_labels[block_index] = np.unique(np.asarray(label_img[slicing]))
+
+        pool = RequestPool()
+        for block_index in range(block_count):
+            pool.add(Request(partial(find_labels, block_index)))
+        pool.wait()
+
+        node_blocks = np.full((node_count,), block_count, dtype=np.int64)
+        for block_index, labels in enumerate(block_labels):
+            np.minimum.at(node_blocks, labels.astype(np.int64), block_index)
+        return node_blocks, block_count
+
+
+    def solve_decomposed(label_img, edge_ids, edge_weights, node_count, solver_method,
+                         block_shape=None):
+        """
+        Solve the given multicut problem by spatial decomposition and return an
+        index array that maps node IDs to segment IDs.
+
+        The nodes are split into spatial blocks of the superpixel volume. The
+        sub-problems of the edges inside each block are solved in parallel, and
+        the segments found in the blocks are the nodes of a reduced global problem
+        (with the summed weights of the edges between them), which is solved in a
+        final step. This is an approximation: segments of one block are never
+        split again by the global problem.
+
+        label_img: superpixel volume (without channel axis)
+
+        edge_ids, edge_weights, node_count: as in solve_with_nifty()
+
+        solver_method: the Nifty solver method of the sub-problems and the reduced problem,
+                       e.g. 'FmGreedy'
+
+        block_shape: shape of the spatial blocks, default: about DECOMPOSITION_BLOCK_VOXELS voxels
+        """
+        node_count = int(node_count)
+        if block_shape is None:
+            block_shape = determineBlockShape(label_img.shape, DECOMPOSITION_BLOCK_VOXELS)
+        node_blocks, block_count = assign_nodes_to_blocks(label_img, node_count, block_shape)
+
+        u_blocks = node_blocks[edge_ids[:, 0]]
+        v_blocks = node_blocks[edge_ids[:, 1]]
+        inner = (u_blocks == v_blocks)
+
+        # group the inner edges by block
+        inner_edges = np.flatnonzero(inner)
+        inner_edges = inner_edges[np.argsort(u_blocks[inner_edges], kind='mergesort')]
+        bounds = np.searchsorted(u_blocks[inner_edges], np.arange(block_count + 1))
+
+        # sub-problem solutions: node -> (block-local) segment
+        segments = np.arange(node_count, dtype=np.int64)
+
+        def solve_block(block_index):
+            edges = inner_edges[bounds[block_index]:bounds[block_index + 1]]
+            if len(edges) == 0:
+                return
+            nodes, local_edge_ids = np.unique(edge_ids[edges], return_inverse=True)
+            local_edge_ids = local_edge_ids.reshape(-1, 2)
+            local_labels = solve_with_nifty(local_edge_ids, edge_weights[edges], len(nodes),
+                                            solver_method, number_of_threads=1)
+            # segment ids: the smallest node ID of each segment (unique across blocks)
+            representative = np.full((local_labels.max() + 1,), node_count, dtype=np.int64)
+            np.minimum.at(representative, local_labels.astype(np.int64), nodes)
+            segments[nodes] = representative[local_labels]
+
+        pool = RequestPool()
+        for block_index in range(block_count):
+            pool.add(Request(partial(solve_block, block_index)))
+        pool.wait()
+
+        # reduced problem: one node per segment, summed weights of the edges between segments
+        segment_ids, reduced_nodes = np.unique(segments, return_inverse=True)
+        reduced_edges = np.sort(reduced_nodes[edge_ids], axis=1)
+        between = reduced_edges[:, 0] != reduced_edges[:, 1]
+        reduced_edges, reduced_edge_index = np.unique(
+            reduced_edges[between], axis=0, return_inverse=True)
+        reduced_weights = np.bincount(reduced_edge_index.reshape(-1), edge_weights[between],
+                                      minlength=len(reduced_edges))
+
+        if len(reduced_edges) == 0:
+            reduced_labels = np.arange(len(segment_ids), dtype=np.uint32)
+        else:
+            reduced_labels = solve_with_nifty(reduced_edges, reduced_weights, len(segment_ids),
+                                              solver_method)
+
+        mapping_index_array = reduced_labels[reduced_nodes].astype(np.uint32)
+        return mapping_index_array
+
+
     def solve_with_opengm(edge_ids, edge_weights, node_count, solver_method):
         """
         Solve the given multicut problem with OpenGM and return an
@@ -25,7 +25,6 @@ import numpy.lib.recfunctions as rfn
 import vigra
 import time
 import warnings
-import itertools
 from collections import defaultdict, OrderedDict
 from functools import partial
 
@@ -33,6 +32,7 @@ from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.stype import Opaque
 from lazyflow.rtype import List
 from lazyflow.operators import OpValueCache, OpSlicedBlockedArrayCache, OperatorWrapper, OpMultiArrayStacker
+from lazyflow.operators.opCache import ManagedBlockedCache
 from lazyflow.request import Request, RequestPool, RequestLock
 
 from lazyflow.classifiers import ParallelVigraRfLazyflowClassifierFactory, ParallelVigraRfLazyflowClassifier
@@ -44,6 +44,7 @@ from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectExtracti
 
 from ilastik.applets.base.applet import DatasetConstraintError
 from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
+from ilastik.config import cfg as ilastik_config
 
 import logging
 logger = logging.getLogger(__name__)
@@ -521,81 +522,58 @@ class OpObjectClassification(Operator, ExportingOperator, MultiLaneOperatorABC):
         data2D = False
         if mins_old.shape[1]==2:
             data2D = True
-        class bbox(object):
-            def __init__(self, minmaxs, axistags):
-                self.xmin = minmaxs[0][axistags.index('x')]
-                self.ymin = minmaxs[0][axistags.index('y')]
-                if not data2D:
-                    self.zmin = minmaxs[0][axistags.index('z')]
-                else:
-                    self.zmin = 0
-                self.xmax = minmaxs[1][axistags.index('x')]
-                self.ymax = minmaxs[1][axistags.index('y')]
-                if not data2D:
-                    self.zmax = minmaxs[1][axistags.index('z')]
-                else:
-                    self.zmax = 0
-                self.rad_x = 0.5*(self.xmax - self.xmin)
-                self.cent_x = self.xmin+self.rad_x
-                self.rad_y = 0.5*(self.ymax-self.ymin)
-                self.cent_y = self.ymin+self.rad_y
-                self.rad_z = 0.5*(self.zmax-self.zmin)
-                self.cent_z = self.zmin+self.rad_z
-
-            @staticmethod
-            def overlap(bbox_tuple):
-                this = bbox_tuple[0]
-                that = bbox_tuple[1]
-                over_x = this.rad_x+that.rad_x - (abs(this.cent_x-that.cent_x))
-                over_y = this.rad_y+that.rad_y - (abs(this.cent_y-that.cent_y))
-                over_z = this.rad_z+that.rad_z - (abs(this.cent_z-that.cent_z))
-                if not data2D:
-                    if over_x>0 and over_y>0 and over_z>0:
-                        return over_x*over_y*over_z
-                else:
-                    if over_x>0 and over_y>0:
-                        return over_x*over_y
-                return 0
+        spatial_axes = 'xy' if data2D else 'xyz'
+        columns = [axistags.index(k) for k in spatial_axes]
 
         nonzeros = numpy.nonzero(old_labels)[0]
-        bboxes_old = [bbox(x, axistags) for x in zip(mins_old[nonzeros], maxs_old[nonzeros])]
-        bboxes_new = [bbox(x, axistags) for x in zip(mins_new, maxs_new)]
+        mins_old = numpy.asarray(mins_old, dtype=numpy.float64)[nonzeros][:, columns]
+        maxs_old = numpy.asarray(maxs_old, dtype=numpy.float64)[nonzeros][:, columns]
 
         #remove background
         #FIXME: assuming background is 0 again
-        bboxes_new = bboxes_new[1:]
+        mins_new = numpy.asarray(mins_new, dtype=numpy.float64)[1:, columns]
+        maxs_new = numpy.asarray(maxs_new, dtype=numpy.float64)[1:, columns]
+
+        def centers(mins, maxs):
+            # (x, y, z) centers of the boxes, z is 0 for 2D data
+            cents = numpy.zeros((mins.shape[0], 3))
+            cents[:, :len(spatial_axes)] = mins + 0.5*(maxs - mins)
+            return [tuple(c) for c in cents]
 
-        double_for_loop = itertools.product(bboxes_old, bboxes_new)
-        overlaps = list(map(bbox.overlap, double_for_loop))
+        iold, inew, overlaps = bbox_overlaps(mins_old, maxs_old, mins_new, maxs_new)
 
-        overlaps = numpy.asarray(overlaps)
-        overlaps = overlaps.reshape((len(bboxes_old), len(bboxes_new)))
         new_labels = numpy.zeros((nobj_new,), dtype=numpy.uint32)
         old_labels_lost = dict()
         old_labels_lost["full"]=[]
         old_labels_lost["partial"]=[]
         new_labels_lost = dict()
         new_labels_lost["conflict"]=[]
-        for iobj in range(overlaps.shape[0]):
-            #take the object with maximum overlap
-            overlapsum = numpy.sum(overlaps[iobj, :])
-            if overlapsum==0:
-                old_labels_lost["full"].append((bboxes_old[iobj].cent_x, bboxes_old[iobj].cent_y, bboxes_old[iobj].cent_z))
-                continue
-            newindex = numpy.argmax(overlaps[iobj, :])
-            if overlapsum-overlaps[iobj,newindex]>0:
-                #this object overlaps with more than one new object
-                old_labels_lost["partial"].append((bboxes_old[iobj].cent_x, bboxes_old[iobj].cent_y, bboxes_old[iobj].cent_z))
 
-            overlaps[iobj, :] = 0
-            overlaps[iobj, newindex] = 1 #doesn't matter what number>0
+        #take the object with maximum overlap (the first one, if there are several)
+        overlapsum = numpy.bincount(iold, weights=overlaps, minlength=len(nonzeros))
+        order = numpy.lexsort((inew, -overlaps, iold))
+        first = numpy.ones(order.shape, dtype=bool)
+        first[1:] = iold[order][1:] != iold[order][:-1]
+        best = order[first]
+        matched_old = iold[best]
+        matched_new = inew[best]
+        maxoverlap = numpy.zeros((len(nonzeros),))
+        maxoverlap[matched_old] = overlaps[best]
+
+        old_centers = centers(mins_old, maxs_old)
+        for iobj in range(len(nonzeros)):
+            if overlapsum[iobj]==0:
+                old_labels_lost["full"].append(old_centers[iobj])
+            elif overlapsum[iobj]-maxoverlap[iobj]>0:
+                #this object overlaps with more than one new object
+                old_labels_lost["partial"].append(old_centers[iobj])
 
-        for iobj in range(overlaps.shape[1]):
-            labels = numpy.where(overlaps[:, iobj]>0)[0]
-            if labels.shape[0]==1:
-                new_labels[iobj+1]=old_labels[nonzeros[labels[0]]] #iobj+1 because of the background
-            elif labels.shape[0]>1:
-                new_labels_lost["conflict"].append((bboxes_new[iobj].cent_x, bboxes_new[iobj].cent_y, bboxes_new[iobj].cent_z))
+        nmatches = numpy.bincount(matched_new, minlength=mins_new.shape[0])
+        unique = nmatches[matched_new]==1
+        new_labels[matched_new[unique]+1]=old_labels[nonzeros[matched_old[unique]]] #+1 because of the background
+        new_centers = centers(mins_new, maxs_new)
+        for iobj in numpy.flatnonzero(nmatches>1):
+            new_labels_lost["conflict"].append(new_centers[iobj])
 
         new_labels = new_labels
         new_labels[0]=0 #FIXME: hardcoded background value again
@@ -828,6 +806,99 @@ class OpObjectClassification(Operator, ExportingOperator, MultiLaneOperatorABC):
         export_file.InsertionProgress.unsubscribe(progress_slot)
 
 
+def bbox_overlaps(mins_a, maxs_a, mins_b, maxs_b):
+    """Find all pairs of overlapping bounding boxes between two sets.
+
+    Boxes are given by their minimum and maximum coordinates, shape
+    (n, ndim). Two boxes overlap if min_a < max_b and min_b < max_a
+    along every axis. As in label transfer, the overlap is measured as
+    the product over all axes of (r_a + r_b - |c_a - c_b|), with box
+    centers c and radii r.
+
+    Candidate pairs are found through a regular grid: every box is
+    registered with all grid cells it touches, and only boxes that
+    share a cell are compared. This avoids looking at all n_a x n_b pairs.
+
+    :returns: (indices into a, indices into b, overlaps), one entry per
+        overlapping pair, sorted by index into a, then index into b
+
+    """
+    mins_a = numpy.asarray(mins_a, dtype=numpy.float64)
+    maxs_a = numpy.asarray(maxs_a, dtype=numpy.float64)
+    mins_b = numpy.asarray(mins_b, dtype=numpy.float64)
+    maxs_b = numpy.asarray(maxs_b, dtype=numpy.float64)
+    empty = (numpy.zeros((0,), dtype=numpy.intp), numpy.zeros((0,), dtype=numpy.intp), numpy.zeros((0,)))
+    if len(mins_a) == 0 or len(mins_b) == 0:
+        return empty
+
+    # the cell size follows the typical box size, so that each box touches only a few cells
+    extents = numpy.concatenate((maxs_a - mins_a, maxs_b - mins_b))
+    cell_size = numpy.maximum(numpy.median(extents, axis=0), 1.)
+    origin = numpy.minimum(mins_a.min(axis=0), mins_b.min(axis=0))
+    grid_shape = numpy.floor((numpy.maximum(maxs_a.max(axis=0), maxs_b.max(axis=0)) - origin) / cell_size).astype(numpy.int64) + 1
+
+    def cells(mins, maxs):
+        # all (box index, cell key) pairs
+        lo = numpy.floor((mins - origin) / cell_size).astype(numpy.int64)
+        hi = numpy.floor((maxs - origin) / cell_size).astype(numpy.int64)
+        counts = hi - lo + 1
+        ncells = numpy.prod(counts, axis=1)
+        boxes = numpy.repeat(numpy.arange(len(mins)), ncells)
+        local = numpy.arange(ncells.sum()) - numpy.repeat(numpy.cumsum(ncells) - ncells, ncells)
+        keys = numpy.zeros(boxes.shape, dtype=numpy.int64)
+        for d in range(mins.shape[1] - 1, -1, -1):
+            local, offset = numpy.divmod(local, counts[boxes, d])
+            keys += (lo[boxes, d] + offset) * int(numpy.prod(grid_shape[d+1:]))
+        return boxes, keys
+
+    boxes_a, keys_a = cells(mins_a, maxs_a)
+    boxes_b, keys_b = cells(mins_b, maxs_b)
+    order = numpy.argsort(keys_b, kind='mergesort')
+    boxes_b = boxes_b[order]
+    keys_b = keys_b[order]
+
+    # join on the cell key
+    first = numpy.searchsorted(keys_b, keys_a, side='left')
+    last = numpy.searchsorted(keys_b, keys_a, side='right')
+    nmatches = last - first
+    ia = numpy.repeat(boxes_a, nmatches)
+    ib = boxes_b[numpy.repeat(first - numpy.cumsum(nmatches) + nmatches, nmatches) + numpy.arange(nmatches.sum())]
+    if len(ia) == 0:
+        return empty
+
+    # boxes sharing several cells appear several times
+    pairs = numpy.unique(ia * len(mins_b) + ib)
+    ia, ib = numpy.divmod(pairs, len(mins_b))
+
+    # same measure as the center/radius formulation used for label transfer
+    rad_a = 0.5*(maxs_a[ia] - mins_a[ia])
+    rad_b = 0.5*(maxs_b[ib] - mins_b[ib])
+    over = rad_a + rad_b - numpy.abs((mins_a[ia] + rad_a) - (mins_b[ib] + rad_b))
+    positive = numpy.all(over > 0, axis=1)
+    return ia[positive], ib[positive], numpy.prod(over[positive], axis=1)
+
+
+def uncertainty_from_probabilities(prob):
+    """Uncertainty of each object's prediction, computed as one minus the
+    margin between the two most probable classes.
+
+    :param prob: numpy.ndarray of shape (nobjects, nclasses), the first
+        row is the background object
+    :returns: numpy.ndarray of shape (nobjects,), zero for the background
+
+    """
+    res = numpy.zeros((prob.shape[0],))
+    if prob.ndim < 2 or prob.shape[0] == 0 or prob.shape[1] <= 1:
+        return res
+    top2 = numpy.partition(prob, prob.shape[1] - 2, axis=1)[:, -2:]
+    if numpy.max(top2[:, 0]) <= 0:
+        # no object has a second class with nonzero probability
+        return res
+    res = 1 - (top2[:, 1] - top2[:, 0])
+    res[0] = 0
+    return res
+
+
 def _atleast_nd(a, ndim):
     """Like numpy.atleast_1d and friends, but supports arbitrary ndim,
     always puts extra dimensions last, and resizes.
@@ -1051,12 +1122,18 @@ class OpObjectTrain(Operator):
                                       'feats': bad_feats})
 
 
-class OpObjectPredict(Operator):
+class OpObjectPredict(Operator, ManagedBlockedCache):
     """Predicts object labels in a single image.
 
     Performs prediction on all objects in a time slice at once, and
     caches the result.
 
+    The per-time-step caches are managed by lazyflow's cache memory
+    manager, with one block per time step. At most
+    'max_cached_time_steps' time steps (see the ilastik config) are kept;
+    the least recently used ones are evicted and transparently
+    recomputed when they are requested again.
+
     """
     # WARNING: right now we predict and cache a whole time slice. We
     # expect this to be fast because there are relatively few objects
@@ -1079,6 +1156,78 @@ class OpObjectPredict(Operator):
     BadObjects = OutputSlot(stype=Opaque, rtype=List)
     UncertaintyEstimate = OutputSlot(stype=Opaque, rtype=List)
 
+    def __init__(self, *args, **kwargs):
+        super(OpObjectPredict, self).__init__(*args, **kwargs)
+        self.lock = RequestLock()
+        self._resetCaches()
+        self.registerWithMemoryManager()
+
+    def _resetCaches(self):
+        self.prob_cache = dict()
+        self.bad_objects = dict()
+        self.uncertainty_estimate = dict()
+        # time step -> last access time, least recently used first
+        self._last_access = OrderedDict()
+
+    def _touch(self, times):
+        """Mark the given time steps as used and evict the least recently
+        used ones beyond the configured limit. Call with self.lock held."""
+        now = time.time()
+        for t in times:
+            self._last_access.pop(t, None)
+            self._last_access[t] = now
+
+        max_cached = ilastik_config.getint('object classification', 'max_cached_time_steps')
+        if max_cached > 0:
+            while len(self._last_access) > max_cached:
+                t = next(iter(self._last_access))
+                if t in times:
+                    break
+                self._freeTimeStep(t)
+
+    def _freeTimeStep(self, t):
+        freed = 0
+        for cache in (self.prob_cache, self.bad_objects, self.uncertainty_estimate):
+            a = cache.pop(t, None)
+            if a is not None:
+                freed += numpy.asarray(a).nbytes
+        self._last_access.pop(t, None)
+        return freed
+
+    def usedMemory(self):
+        with self.lock:
+            return sum(numpy.asarray(a).nbytes
+                       for cache in (self.prob_cache, self.bad_objects, self.uncertainty_estimate)
+                       for a in cache.values())
+
+    def fractionOfUsedMemoryDirty(self):
+        # the caches are cleared as soon as they become dirty
+        return 0.0
+
+    def lastAccessTime(self):
+        with self.lock:
+            return max(list(self._last_access.values()) + [0.0])
+
+    def getBlockAccessTimes(self):
+        with self.lock:
+            return list(self._last_access.items())
+
+    def freeBlock(self, key):
+        with self.lock:
+            return self._freeTimeStep(key)
+
+    def freeMemory(self):
+        with self.lock:
+            return sum(self._freeTimeStep(t) for t in list(self._last_access.keys()))
+
+    def freeDirtyMemory(self):
+        return 0
+
+    def generateReport(self, report):
+        super(OpObjectPredict, self).generateReport(report)
+        with self.lock:
+            report.info = "{} cached time steps".format(len(self._last_access))
+
     def setupOutputs(self):
         self.Predictions.meta.shape = self.Features.meta.shape
         self.Predictions.meta.dtype = object
@@ -1110,10 +1259,8 @@ class OpObjectPredict(Operator):
                 oslot.meta.axistags = None
                 oslot.meta.mapping_dtype = numpy.float32
 
-        self.lock = RequestLock()
-        self.prob_cache = dict()
-        self.bad_objects = dict()
-        self.uncertainty_estimate = dict()
+        with self.lock:
+            self._resetCaches()
 
     def execute(self, slot, subindex, roi, result):
         assert slot in [self.Predictions,
@@ -1129,7 +1276,8 @@ class OpObjectPredict(Operator):
             times = list(range(self.Predictions.meta.shape[0]))
 
         if slot is self.CachedProbabilities:
-            return {t: self.prob_cache[t] for t in times if t in self.prob_cache}
+            with self.lock:
+                return {t: self.prob_cache[t] for t in times if t in self.prob_cache}
 
         classifier = self.Classifier.value
         if classifier is None:
@@ -1138,6 +1286,7 @@ class OpObjectPredict(Operator):
 
         feats = {}
         prob_predictions = {}
+        bad_objects = {}
 
         selected = self.SelectedFeatures([]).wait()
 
@@ -1151,6 +1300,9 @@ class OpObjectPredict(Operator):
         # Keep a list of times that are not in the cache
         with self.lock:
             times_not_cached = [t for t in times if t not in self.prob_cache]
+            # hold on to the cached frames, they might get evicted while we predict the others
+            cached_probs = {t: self.prob_cache[t] for t in times if t in self.prob_cache}
+            cached_bad_objects = {t: self.bad_objects[t] for t in times if t in self.bad_objects}
 
         # Initialize with a single value for the 'background object ' 
         if times_not_cached:  
@@ -1167,10 +1319,8 @@ class OpObjectPredict(Operator):
                   
             ftmatrix, _, col_names = make_feature_array({t:tmpfeats[t]}, selected)
             rows, cols = replace_missing(ftmatrix)
-            self.bad_objects[t] = numpy.zeros((ftmatrix.shape[0],))
-            self.bad_objects[t][rows] = 1
-            self.uncertainty_estimate[t] = numpy.zeros((ftmatrix.shape[0],))
-            self.uncertainty_estimate[t][rows] = 1
+            bad_objects[t] = numpy.zeros((ftmatrix.shape[0],))
+            bad_objects[t][rows] = 1
             feats[t] = ftmatrix
   
         # Are there any objects to predict?
@@ -1196,11 +1346,21 @@ class OpObjectPredict(Operator):
 
         with self.lock:
             for t in times:
-                if t not in self.prob_cache:
+                if t in self.prob_cache:
+                    continue
+                if t in cached_probs:
+                    # evicted in the meantime
+                    self.prob_cache[t] = cached_probs[t]
+                    if t in cached_bad_objects:
+                        self.bad_objects[t] = cached_bad_objects[t]
+                else:
                     # prob_predictions is a dict-of-arrays, indexed as follows:
                     # prob_predictions[t][object_index, class_index]
                     self.prob_cache[t] = prob_predictions[t]
                     self.prob_cache[t][0] = 0 # Background probability is always zero
+                    if t in bad_objects:
+                        self.bad_objects[t] = bad_objects[t]
+            self._touch(times)
 
             if slot == self.Probabilities:
                 return { t : self.prob_cache[t] for t in times }
@@ -1229,35 +1389,20 @@ class OpObjectPredict(Operator):
 
             elif slot == self.UncertaintyEstimate:
                 for t in times:
-
-                    prob = self.prob_cache[t]
-                    shape = numpy.shape(prob)
-                    res = numpy.zeros(shape=(shape[0]))
-                    if shape[1] <=1:
-                        self.uncertainty_estimate[t] = res
-                        return {t : self.uncertainty_estimate[t] for t in times}
-                    else:
-                        maxElt = numpy.argmax(self.prob_cache[t], axis=1)
-                        ones = numpy.zeros(shape)
-                        for i in range(shape[0]):
-                            ones[i,maxElt[i]] = 1
-                        probMinusMax = prob-numpy.multiply(prob,ones)
-                        if numpy.max(probMinusMax) <= 0:
-                            self.uncertainty_estimate[t] = numpy.zeros(shape=(shape[0]))
-                        else:
-                            secondElt = numpy.argmax(probMinusMax,axis=1)
-                            for i in range(shape[0]):
-                                res[i] = 1-(prob[i][maxElt[i]] - prob[i][secondElt[i]])
-                            self.uncertainty_estimate[t] = res
-                            self.uncertainty_estimate[t][0] = 0
+                    if t not in self.uncertainty_estimate:
+                        self.uncertainty_estimate[t] = uncertainty_from_probabilities(self.prob_cache[t])
                 return { t : self.uncertainty_estimate[t] for t in times }
             else:
                 assert False, "Unknown input slot"
 
     def propagateDirty(self, slot, subindex, roi):
-        self.prob_cache = {}
+        with self.lock:
+            self._resetCaches()
         if slot is self.InputProbabilities:
-            self.prob_cache = self.InputProbabilities([]).wait()
+            prob_cache = self.InputProbabilities([]).wait()
+            with self.lock:
+                self.prob_cache = prob_cache
+                self._touch(list(prob_cache.keys()))
         self.Predictions.setDirty(())
         self.Probabilities.setDirty(())
         self.UncertaintyEstimate.setDirty(())
@@ -1279,9 +1424,60 @@ class OpRelabelSegmentation(Operator):
     loggingName = __name__ + ".OpRelabelSegmentation"
     logger = logging.getLogger(loggingName)
 
+    def __init__(self, *args, **kwargs):
+        super(OpRelabelSegmentation, self).__init__(*args, **kwargs)
+        # per time step lookup tables: label -> mapped value
+        self._lookupTables = {}
+        self._lookupTablesGeneration = 0
+        self._lock = RequestLock()
+
     def setupOutputs(self):
         self.Output.meta.assignFrom(self.Image.meta)
         self.Output.meta.dtype = self.ObjectMap.meta.mapping_dtype
+        self._invalidateLookupTables()
+
+    def _invalidateLookupTables(self, times=None):
+        with self._lock:
+            self._lookupTablesGeneration += 1
+            if times is None:
+                self._lookupTables = {}
+            else:
+                for t in times:
+                    self._lookupTables.pop(t, None)
+
+    def _getLookupTable(self, t):
+        """The lookup table for time step t, covering every label in the
+        segmentation (according to the object count in Features).
+        None if there are no objects to paint."""
+        with self._lock:
+            if t in self._lookupTables:
+                return self._lookupTables[t]
+            generation = self._lookupTablesGeneration
+
+        tmap = self.ObjectMap([t]).wait()[t]
+        # FIXME: necessary because predictions are returned
+        # enclosed in a list.
+        if isinstance(tmap, list):
+            tmap = tmap[0]
+        tmap = numpy.asarray(tmap).squeeze()
+
+        if tmap.ndim == 0:
+            # no objects, nothing to paint
+            lut = None
+        else:
+            # Count has one row per label, including the background
+            nlabels = self.Features([t]).wait()[t][default_features_key]['Count'].shape[0]
+            if len(tmap) < nlabels:
+                lut = numpy.zeros((nlabels,), dtype=tmap.dtype)
+                lut[:len(tmap)] = tmap
+            else:
+                lut = tmap
+
+        with self._lock:
+            # don't store tables that became dirty while we were building them
+            if generation == self._lookupTablesGeneration:
+                self._lookupTables[t] = lut
+        return lut
 
     def execute(self, slot, subindex, roi, result):
         tStart = time.time()
@@ -1289,46 +1485,33 @@ class OpRelabelSegmentation(Operator):
         tIMG = time.time()
         img = self.Image(roi.start, roi.stop).wait()
         tIMG = 1000.0*(time.time()-tIMG)
-        
+
+        tMAP = 0.0
+        tWORK = 0.0
         for t in range(roi.start[0], roi.stop[0]):
             
-            tMAP = time.time()
-            map_ = self.ObjectMap([t]).wait()
-            tmap = map_[t]
-            # FIXME: necessary because predictions are returned
-            # enclosed in a list.
-            if isinstance(tmap, list):
-                tmap = tmap[0]
-            tmap = tmap.squeeze()
-            if tmap.ndim==0:
-                # no objects, nothing to paint
+            tLUT = time.time()
+            lut = self._getLookupTable(t)
+            tMAP += 1000.0*(time.time()-tLUT)
+
+            if lut is None:
                 result[t-roi.start[0]][:] = 0
-                return result
-            
-            tMAP = 1000.0*(time.time()-tMAP)
-            #FIXME: This should be cached (and reset when the input becomes dirty)")
-            tMAX = time.time()
-            idx = img.max()
-            
-            if len(tmap) <= idx:
-                newTmap = numpy.zeros((idx + 1,)) # And maybe this should be cached, too?
-                newTmap[:len(tmap)] = tmap[:]
-                tmap = newTmap
-            tMAX = 1000.0*(time.time()-tMAX)
-            
+                continue
+
             #do the work thing
-            tWORK = time.time()
-            result[t-roi.start[0]] = tmap[img[t-roi.start[0]]]
-            tWORK = 1000.0*(time.time()-tWORK)
+            tFRAME = time.time()
+            result[t-roi.start[0]] = lut[img[t-roi.start[0]]]
+            tWORK += 1000.0*(time.time()-tFRAME)
             
         if self.logger.getEffectiveLevel() >= logging.DEBUG:
             tStart = 1000.0*(time.time()-tStart)
-            self.logger.debug("took %f msec. (img: %f, wait ObjectMap: %f, do work: %f, max: %f)" % (tStart, tIMG, tMAP, tWORK, tMAX))
+            self.logger.debug("took %f msec. (img: %f, lookup tables: %f, do work: %f)" % (tStart, tIMG, tMAP, tWORK))
 
         return result
 
     def propagateDirty(self, slot, subindex, roi):
         if slot is self.Image:
+            self._invalidateLookupTables(list(range(roi.start[0], roi.stop[0])))
             self.Output.setDirty(roi)
 
         elif slot is self.ObjectMap or slot is self.Features:
@@ -1336,14 +1519,17 @@ class OpRelabelSegmentation(Operator):
             # setDirty with a (time, object) pair, while elsewhere we
             # call setDirty with ().
             if len(roi._l) == 0:
+                self._invalidateLookupTables()
                 self.Output.setDirty(slice(None))
             elif isinstance(roi._l[0], int):
+                self._invalidateLookupTables(roi._l)
                 for t in roi._l:
                     self.Output.setDirty(slice(t))
             else:
                 assert len(roi._l[0]) == 2
                 # for each dirty object, only set its bounding box dirty
                 ts = list(set(t for t, _ in roi._l))
+                self._invalidateLookupTables(ts)
                 feats = self.Features(ts).wait()
                 for t, obj in roi._l:
                     min_coords = feats[t][default_features_key]['Coord<Minimum>'][obj].astype(numpy.uint32)
@@ -1372,7 +1558,12 @@ class OpMultiRelabelSegmentation(Operator):
 
     def setupOutputs(self):
         nmaps = len(self.ObjectMaps)
-        for islot in self.ObjectMaps:
+        # keep the existing inner operators (and their lookup tables)
+        while len(self._innerOperators) > nmaps:
+            self.Output.resize(len(self._innerOperators) - 1)
+            op = self._innerOperators.pop()
+            op.cleanUp()
+        for islot in self.ObjectMaps[len(self._innerOperators):]:
             op = OpRelabelSegmentation(parent=self)
             op.Image.connect(self.Image)
             op.ObjectMap.connect(islot)
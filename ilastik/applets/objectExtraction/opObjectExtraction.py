@@ -34,7 +34,7 @@ from lazyflow.graph import Operator, InputSlot, OutputSlot, OperatorWrapper
 from lazyflow.request import Request, RequestPool
 from lazyflow.stype import Opaque
 from lazyflow.rtype import List, SubRegion
-from lazyflow.roi import roiToSlice, sliceToRoi
+from lazyflow.roi import roiToSlice, sliceToRoi, determineBlockShape, getIntersectingBlocks, getBlockBounds
 from lazyflow.operators import OpLabelVolume, OpCompressedCache, OpBlockedArrayCache
 from itertools import groupby, count
 
@@ -47,7 +47,10 @@ try:
 except:
     logger.warning('could not import pluginManager')
 
+from ilastik.config import cfg as ilastik_config
+
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.applets.objectExtraction.regionAccumulators import RegionFeatureAccumulator
 
 # These features are always calculated, but not used for prediction.
 # They are needed by our gui, or by downstream applets.
@@ -56,6 +59,10 @@ default_features = {'Coord<Minimum>':{}, 'Coord<Maximum>':{}, 'RegionCenter': {}
 # to distinguish them, they go in their own category with this name
 default_features_key = 'Default features'
 
+# upper bound on the number of voxels cropped at once for a batch of
+# objects with equally shaped bounding boxes (see group_by_extent)
+local_features_batch_voxels = 2**24
+
 
 def max_margin(d, default=(0, 0, 0)):
     """find any parameter named 'margin' in the nested feature
@@ -111,6 +118,33 @@ def make_bboxes(binary_bbox, margin):
     return passed, context
 
 
+def group_by_extent(starts, stops, max_voxels=None):
+    """Group objects by the shape of their bounding boxes.
+
+    Yields arrays of object indices. All objects in one group have the
+    same bounding box shape, and no group holds more than max_voxels
+    voxels in total (single objects may exceed it).
+
+    >>> starts = numpy.array([[0, 0, 0], [5, 5, 0], [2, 0, 0]])
+    >>> stops = numpy.array([[2, 2, 1], [7, 7, 1], [5, 2, 1]])
+    >>> [list(g) for g in group_by_extent(starts, stops)]
+    [[0, 1], [2]]
+
+    """
+    if max_voxels is None:
+        max_voxels = local_features_batch_voxels
+    shapes = numpy.asarray(stops) - numpy.asarray(starts)
+    if shapes.shape[0] == 0:
+        return
+    # lexsort is stable, so each group is in ascending object order
+    order = numpy.lexsort(shapes.T[::-1])
+    changes = numpy.any(numpy.diff(shapes[order], axis=0) != 0, axis=1)
+    for group in numpy.split(order, numpy.flatnonzero(changes) + 1):
+        batch_size = max(1, max_voxels // int(numpy.prod(shapes[group[0]])))
+        for i in range(0, len(group), batch_size):
+            yield group[i:i+batch_size]
+
+
 class OpCachedRegionFeatures(Operator):
     """Caches the region features computed by OpRegionFeatures."""
     RawImage = InputSlot()
@@ -483,6 +517,11 @@ class OpRegionFeatures(Operator):
         assert t_ind < len(self.RawVolume.meta.shape)
 
         def compute_features_for_time_slice(res_t_ind, t):
+            if self._use_blockwise():
+                # Volume does not fit into the memory budget
+                result[res_t_ind] = self._extract_blockwise(t_ind, t)
+                return
+
             # Process entire spatial volume
             s = [slice(None) for i in range(len(self.RawVolume.meta.shape))]
             s[t_ind] = slice(t, t+1)
@@ -520,6 +559,116 @@ class OpRegionFeatures(Operator):
         pool.wait()
         return result
 
+    def _memory_budget(self):
+        """Memory budget (in bytes) for a single time slice, or 0 if unlimited."""
+        return ilastik_config.getint('object extraction', 'max_time_slice_mb') * 2**20
+
+    def _use_blockwise(self):
+        budget = self._memory_budget()
+        if budget <= 0:
+            return False
+        tagged_shape = self.RawVolume.meta.getTaggedShape()
+        nvoxels = numpy.prod([tagged_shape[k] for k in 'xyz'])
+        nbytes = nvoxels * (tagged_shape['c'] * numpy.dtype(self.RawVolume.meta.dtype).itemsize +
+                            numpy.dtype(self.LabelVolume.meta.dtype).itemsize)
+        return nbytes > budget
+
+    def _extract_blockwise(self, t_ind, t):
+        """Compute the features of one time slice block by block.
+
+        Only features that can be accumulated per block are supported
+        (see RegionFeatureAccumulator). The blocks are computed in parallel,
+        a bounded number at a time, and the block size is chosen so that
+        these stay within the memory budget set by the 'max_time_slice_mb'
+        option.
+
+        """
+        feature_names = deepcopy(self.Features([]).wait())
+        feature_names = self._augmentFeatureNames(feature_names)
+
+        standard_features = {}
+        unsupported = []
+        for plugin_name, feature_dict in feature_names.items():
+            if plugin_name == default_features_key:
+                continue
+            for name, params in feature_dict.items():
+                if plugin_name != "Standard Object Features" or 'margin' in params or \
+                   name.replace(' ', '') not in RegionFeatureAccumulator.supported_features:
+                    unsupported.append(name)
+                else:
+                    standard_features[name.replace(' ', '')] = params
+        if unsupported:
+            raise DatasetConstraintError("Object Extraction",
+                                         "The volume is too large to compute all features at once, "
+                                         "and the following features cannot be computed blockwise: {}"
+                                         "".format(", ".join(sorted(unsupported))))
+
+        tagged_shape = self.RawVolume.meta.getTaggedShape()
+        axiskeys = list(tagged_shape.keys())
+        c_ind = axiskeys.index('c')
+        nchannels = tagged_shape['c']
+        ndim = 3 if tagged_shape['z'] > 1 else 2
+
+        # rough upper bound of the bytes needed per voxel by the accumulators
+        bytes_per_voxel = 8 * (4 * nchannels + 2 * ndim + 4)
+        max_pending = 2 * max(1, Request.global_thread_pool.num_workers)
+        block_tagged_shape = collections.OrderedDict(tagged_shape)
+        block_tagged_shape['t'] = 1
+        block_tagged_shape['c'] = 1
+        block_shape = list(determineBlockShape(list(block_tagged_shape.values()),
+                                               max(1, self._memory_budget() // (bytes_per_voxel * max_pending))))
+        block_shape[c_ind] = nchannels
+
+        shape = self.RawVolume.meta.shape
+        slice_start = [0] * len(shape)
+        slice_stop = list(shape)
+        slice_start[t_ind] = t
+        slice_stop[t_ind] = t + 1
+        block_starts = getIntersectingBlocks(block_shape, (slice_start, slice_stop))
+
+        label_channels = self.LabelVolume.meta.getTaggedShape()['c']
+
+        def accumulate_block(block_start, histogram_range):
+            start, stop = getBlockBounds(shape, block_shape, block_start)
+            label_stop = list(stop)
+            label_stop[c_ind] = label_channels
+
+            raw_req = self.RawVolume(start, stop)
+            label_req = self.LabelVolume(start, label_stop)
+            raw_req.submit()
+            label_req.submit()
+
+            raw = vigra.taggedView(raw_req.wait(), axistags=self.RawVolume.meta.axistags)
+            labels = vigra.taggedView(label_req.wait(), axistags=self.LabelVolume.meta.axistags)
+            raw = raw.withAxes('x', 'y', 'z', 'c')
+            labels = labels.withAxes('x', 'y', 'z', 'c')[..., 0]
+
+            offset = [start[axiskeys.index(k)] for k in 'xyz']
+            return RegionFeatureAccumulator.from_block(raw, labels, offset, ndim, histogram_range)
+
+        def accumulate(histogram_range):
+            # Submit the blocks in order, but keep no more than max_pending around,
+            # and merge each one as soon as it's done.
+            acc = RegionFeatureAccumulator(nchannels, ndim, histogram_range)
+            pending = collections.deque()
+            for block_start in block_starts:
+                pending.append(Request(partial(accumulate_block, block_start, histogram_range)).submit())
+                if len(pending) >= max_pending:
+                    acc.merge(pending.popleft().wait())
+            while pending:
+                acc.merge(pending.popleft().wait())
+            return acc
+
+        acc = accumulate(None)
+        if 'Histogram' in standard_features:
+            # histograms need the intensity range of the whole image, which requires a second pass
+            acc = accumulate((acc.image_min[0], acc.image_max[0]))
+
+        global_features = {"Standard Object Features": acc.features(list(standard_features.keys()))}
+        extrafeats = self._split_default_features(feature_names, global_features)
+        nobj = extrafeats["Count"].shape[0]
+        return self._merge_features(global_features, {}, extrafeats, nobj)
+
     def compute_extent(self, i, image, mincoords, maxcoords, axes, margin):
         """Make a slicing to extract object i from the image."""
         #find the bounding box (margin is always 'xyz' order)
@@ -546,6 +695,75 @@ class OpRegionFeatures(Operator):
 
         return result
 
+    def compute_extents(self, image, mincoords, maxcoords, axes, margin):
+        """Vectorized version of compute_extent for all objects at once.
+
+        Returns two (nobj, 3) arrays with the start and stop of every
+        bounding box, in the same order as the slicing of compute_extent.
+
+        """
+        nobj = mincoords.shape[0]
+        starts = numpy.zeros((nobj, 3), dtype=numpy.int64)
+        stops = numpy.ones((nobj, 3), dtype=numpy.int64)
+
+        spatial = [axes.x, axes.y]
+        if mincoords.shape[1] > axes.z:
+            spatial.append(axes.z)
+        for a in spatial:
+            starts[:, a] = numpy.maximum(mincoords[:, a] - margin[a], 0)
+            stops[:, a] = numpy.minimum(maxcoords[:, a] + 1 + margin[a], image.shape[a])
+        return starts, stops
+
+    def compute_bbox_stacks(self, image, labels, starts, stops, object_ids, axes):
+        """Crop the bounding boxes of several equally shaped objects at once.
+
+        Returns (raw bounding boxes, binary bounding boxes), stacked along
+        a new first axis. Entry i is equivalent to what compute_rawbbox and
+        the binarized labels[extent] give for object object_ids[i].
+
+        """
+        # The spatial axes, in the order of the label volume (which has no channel axis)
+        ndim = labels.ndim
+        shape = stops[object_ids[0]] - starts[object_ids[0]]
+        index = []
+        for d in range(ndim):
+            offsets = numpy.arange(shape[d]).reshape([1] + [shape[d] if k == d else 1 for k in range(ndim)])
+            index.append(starts[object_ids, d].reshape((-1,) + (1,)*ndim) + offsets)
+
+        label_stack = numpy.asarray(labels)[tuple(index)]
+        #it's +1 here, because the background has label 0
+        binary_bboxes = label_stack == (object_ids + 1).reshape((-1,) + (1,)*ndim)
+
+        key = list(index)
+        key.insert(axes.c, slice(None))
+        # advanced indexing puts the channel axis last, restore the original order
+        rawbboxes = numpy.asarray(image)[tuple(key)]
+        rawbboxes = numpy.rollaxis(rawbboxes, rawbboxes.ndim - 1, axes.c + 1)
+        return rawbboxes, binary_bboxes
+
+    def _compute_local_features(self, image, labels, starts, stops, object_ids, feature_names, axes):
+        """Compute the local features of the given objects.
+
+        Returns a nested dictionary, where dict[plugin_name][feature_name]
+        is a list with one entry per object in object_ids (None for
+        objects the plugin did not return this feature for).
+
+        """
+        result = collections.defaultdict(dict)
+        for group in group_by_extent(starts[object_ids], stops[object_ids]):
+            group_ids = object_ids[group]
+            logger.debug("processing {} objects of bounding box shape {}".format(
+                len(group_ids), tuple(stops[group_ids[0]] - starts[group_ids[0]])))
+            rawbboxes, binary_bboxes = self.compute_bbox_stacks(image, labels, starts, stops, group_ids, axes)
+            for plugin_name, feature_dict in feature_names.items():
+                plugin = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
+                feats = plugin.plugin_object.compute_local_batch(rawbboxes, binary_bboxes, feature_dict, axes)
+                for key, values in feats.items():
+                    column = result[plugin_name].setdefault(key, [None] * len(object_ids))
+                    for i, value in zip(group, values):
+                        column[i] = value
+        return result
+
     def compute_rawbbox(self, image, extent, axes):
         """essentially returns image[extent], preserving all channels."""
         key = copy(extent)
@@ -613,37 +831,14 @@ class OpRegionFeatures(Operator):
 
         pool.wait()
 
-        extrafeats = {}
-        for feat_key in default_features:
-            try:
-                sel = feature_names["Standard Object Features"][feat_key]["selected"]
-            except KeyError:
-                # we don't always set this property to True, sometimes it's just not there. The only important
-                # thing is that it's not False
-                sel = True
-            if not sel:
-                # This feature has not been selected by the user. Remove it from the computed dict into a special dict
-                # for default features
-                feature = global_features["Standard Object Features"].pop(feat_key)
-            else:
-                feature = global_features["Standard Object Features"][feat_key]
-            extrafeats[feat_key] = feature
-
-        extrafeats = dict((k.replace(' ', ''), v)
-                          for k, v in extrafeats.items())
+        extrafeats = self._split_default_features(feature_names, global_features)
         
         mincoords = extrafeats["Coord<Minimum>"].astype(int)
         maxcoords = extrafeats["Coord<Maximum>"].astype(int)
         nobj = mincoords.shape[0]
         
-        # local features: loop over all objects
-        def dictextend(a, b):
-            for key in b:
-                a[key].append(b[key])
-            return a
-        
-
-        local_features = collections.defaultdict(lambda: collections.defaultdict(list))
+        # local features: dict[plugin_name][feature_name] is a list with one entry per object
+        local_features = collections.defaultdict(dict)
         margin = max_margin(feature_names)
         has_local_features = {}
         for plugin_name, feature_dict in feature_names.items():
@@ -656,18 +851,33 @@ class OpRegionFeatures(Operator):
                             
         if numpy.any(margin) > 0:
             #starting from 0, we stripped 0th background object in global computation
-            for i in range(0, nobj):
-                logger.debug("processing object {}".format(i))
-                extent = self.compute_extent(i, image, mincoords, maxcoords, axes, margin)
-                rawbbox = self.compute_rawbbox(image, extent, axes)
-                #it's i+1 here, because the background has label 0
-                binary_bbox = numpy.where(labels[tuple(extent)] == i+1, 1, 0).astype(numpy.bool)
-                for plugin_name, feature_dict in feature_names.items():
-                    if not has_local_features[plugin_name]:
-                        continue
-                    plugin = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
-                    feats = plugin.plugin_object.compute_local(rawbbox, binary_bbox, feature_dict, axes)
-                    local_features[plugin_name] = dictextend(local_features[plugin_name], feats)
+            starts, stops = self.compute_extents(image, mincoords, maxcoords, axes, margin)
+            local_feature_names = dict((plugin_name, feature_dict)
+                                       for plugin_name, feature_dict in feature_names.items()
+                                       if has_local_features[plugin_name])
+
+            # split the objects into contiguous chunks and process them in parallel
+            chunk_size = ilastik_config.getint('object extraction', 'local_features_chunk_size')
+            if chunk_size <= 0:
+                chunk_size = max(nobj, 1)
+            chunks = [numpy.arange(first, min(first + chunk_size, nobj)) for first in range(0, nobj, chunk_size)]
+            chunk_features = [None] * len(chunks)
+
+            def compute_for_one_chunk(chunk_index, object_ids):
+                chunk_features[chunk_index] = self._compute_local_features(
+                    image, labels, starts, stops, object_ids, local_feature_names, axes)
+
+            pool = RequestPool()
+            for chunk_index, object_ids in enumerate(chunks):
+                pool.add(Request(partial(compute_for_one_chunk, chunk_index, object_ids)))
+            pool.wait()
+
+            # merge the chunks in object order
+            for object_ids, feats in zip(chunks, chunk_features):
+                for plugin_name, pfeats in feats.items():
+                    for key, values in pfeats.items():
+                        column = local_features[plugin_name].setdefault(key, [None] * nobj)
+                        column[object_ids[0]:object_ids[-1] + 1] = values
 
         logger.debug("computing done, removing failures")
         # remove local features that failed
@@ -680,8 +890,37 @@ class OpRegionFeatures(Operator):
                     logger.warning('feature {} failed'.format(key))
                     del pfeats[key]
 
-        # merge the global and local features
         logger.debug("removed failed, merging")
+        return self._merge_features(global_features, local_features, extrafeats, nobj)
+
+    def _split_default_features(self, feature_names, global_features):
+        """Collect the default features from the standard plugin results.
+
+        Default features the user did not select are removed from
+        global_features.
+
+        """
+        extrafeats = {}
+        for feat_key in default_features:
+            try:
+                sel = feature_names["Standard Object Features"][feat_key]["selected"]
+            except KeyError:
+                # we don't always set this property to True, sometimes it's just not there. The only important
+                # thing is that it's not False
+                sel = True
+            if not sel:
+                # This feature has not been selected by the user. Remove it from the computed dict into a special dict
+                # for default features
+                feature = global_features["Standard Object Features"].pop(feat_key)
+            else:
+                feature = global_features["Standard Object Features"][feat_key]
+            extrafeats[feat_key] = feature
+
+        return dict((k.replace(' ', ''), v)
+                    for k, v in extrafeats.items())
+
+    def _merge_features(self, global_features, local_features, extrafeats, nobj):
+        # merge the global and local features
         all_features = {}
         plugin_names = set(global_features.keys()) | set(local_features.keys())
         for name in plugin_names:
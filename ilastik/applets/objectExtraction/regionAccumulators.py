@@ -0,0 +1,217 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2017, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+from __future__ import division
+from builtins import range
+
+import numpy
+
+
+class RegionFeatureAccumulator(object):
+    """Mergeable per-label accumulators for region features that can be
+    computed block by block.
+
+    Every block of a label image produces a partial accumulator (see
+    from_block()), which is merged into the running total with merge().
+    Labels are assumed to be consistent across blocks, so objects that
+    cross block borders are stitched simply by their label.
+
+    The final values (see features()) follow the conventions of the
+    "Standard Object Features" plugin: one row per label, without the
+    background (label 0), coordinates in xyz order.
+
+    """
+    # feature names as used by vigra (without spaces)
+    supported_features = set(['Count', 'Sum', 'Mean', 'Variance',
+                              'Minimum', 'Maximum', 'RegionCenter',
+                              'Coord<Minimum>', 'Coord<Maximum>', 'Histogram'])
+
+    def __init__(self, nchannels, ndim, histogram_range=None, bin_count=64):
+        """
+        :param nchannels: number of channels of the raw image
+        :param ndim: number of spatial dimensions reported in coordinate features
+        :param histogram_range: (min, max) of the histogram of the first channel,
+            or None to not accumulate histograms
+        :param bin_count: number of histogram bins
+        """
+        self.nchannels = nchannels
+        self.ndim = ndim
+        self.histogram_range = histogram_range
+        self.bin_count = bin_count
+
+        self.count = numpy.zeros((0,), dtype=numpy.float64)
+        self.mean = numpy.zeros((0, nchannels), dtype=numpy.float64)
+        self.m2 = numpy.zeros((0, nchannels), dtype=numpy.float64)
+        self.minimum = numpy.zeros((0, nchannels), dtype=numpy.float64)
+        self.maximum = numpy.zeros((0, nchannels), dtype=numpy.float64)
+        self.coord_sum = numpy.zeros((0, ndim), dtype=numpy.float64)
+        self.coord_min = numpy.zeros((0, ndim), dtype=numpy.float64)
+        self.coord_max = numpy.zeros((0, ndim), dtype=numpy.float64)
+        self.histogram = numpy.zeros((0, bin_count), dtype=numpy.float64)
+
+        # intensity range of the whole image, per channel
+        self.image_min = numpy.full((nchannels,), numpy.inf)
+        self.image_max = numpy.full((nchannels,), -numpy.inf)
+
+    @property
+    def nlabels(self):
+        """Number of labels seen so far, including the background."""
+        return self.count.shape[0]
+
+    def _grow(self, nlabels):
+        n = nlabels - self.nlabels
+        if n <= 0:
+            return
+
+        def pad(a, fill):
+            return numpy.concatenate((a, numpy.full((n,) + a.shape[1:], fill, dtype=a.dtype)))
+
+        self.count = pad(self.count, 0)
+        self.mean = pad(self.mean, 0)
+        self.m2 = pad(self.m2, 0)
+        self.minimum = pad(self.minimum, numpy.inf)
+        self.maximum = pad(self.maximum, -numpy.inf)
+        self.coord_sum = pad(self.coord_sum, 0)
+        self.coord_min = pad(self.coord_min, numpy.inf)
+        self.coord_max = pad(self.coord_max, -numpy.inf)
+        self.histogram = pad(self.histogram, 0)
+
+    @classmethod
+    def from_block(cls, raw, labels, offset, ndim, histogram_range=None, bin_count=64):
+        """Accumulate a single block.
+
+        :param raw: numpy.ndarray with axes xyzc
+        :param labels: numpy.ndarray with axes xyz
+        :param offset: xyz coordinates of the block start in the whole image
+        :param ndim: number of spatial dimensions reported in coordinate features
+        """
+        nchannels = raw.shape[-1]
+        acc = cls(nchannels, ndim, histogram_range, bin_count)
+
+        labels = numpy.asarray(labels).reshape(-1).astype(numpy.intp)
+        if labels.size == 0:
+            return acc
+        values = numpy.asarray(raw).reshape(-1, nchannels).astype(numpy.float64)
+        acc._grow(int(labels.max()) + 1)
+        nlabels = acc.nlabels
+
+        acc.image_min = values.min(axis=0)
+        acc.image_max = values.max(axis=0)
+
+        acc.count = numpy.bincount(labels, minlength=nlabels).astype(numpy.float64)
+        present = numpy.flatnonzero(acc.count)
+        counts = acc.count[present].reshape(-1, 1)
+
+        sums = numpy.column_stack([numpy.bincount(labels, values[:, c], minlength=nlabels)
+                                   for c in range(nchannels)])
+        acc.mean[present] = sums[present] / counts
+        centered = values - acc.mean[labels]
+        acc.m2 = numpy.column_stack([numpy.bincount(labels, centered[:, c] ** 2, minlength=nlabels)
+                                     for c in range(nchannels)])
+
+        # labels are contiguous after sorting, so minima and maxima are segment reductions
+        order = numpy.argsort(labels, kind='mergesort')
+        segments = numpy.searchsorted(labels[order], present)
+        sorted_values = values[order]
+        acc.minimum[present] = numpy.minimum.reduceat(sorted_values, segments, axis=0)
+        acc.maximum[present] = numpy.maximum.reduceat(sorted_values, segments, axis=0)
+        del sorted_values
+
+        block_shape = raw.shape[:-1]
+        for d in range(ndim):
+            shape = [1] * len(block_shape)
+            shape[d] = block_shape[d]
+            coords = numpy.arange(offset[d], offset[d] + block_shape[d]).reshape(shape)
+            coords = numpy.broadcast_to(coords, block_shape).reshape(-1)
+            acc.coord_sum[:, d] = numpy.bincount(labels, coords, minlength=nlabels)
+            sorted_coords = coords[order]
+            acc.coord_min[present, d] = numpy.minimum.reduceat(sorted_coords, segments)
+            acc.coord_max[present, d] = numpy.maximum.reduceat(sorted_coords, segments)
+
+        if histogram_range is not None:
+            lo, hi = histogram_range
+            scale = bin_count / (hi - lo) if hi > lo else 0.
+            bins = ((values[:, 0] - lo) * scale).astype(numpy.intp)
+            numpy.clip(bins, 0, bin_count - 1, out=bins)
+            acc.histogram = numpy.bincount(labels * bin_count + bins,
+                                           minlength=nlabels * bin_count).reshape(nlabels, bin_count).astype(numpy.float64)
+        return acc
+
+    def merge(self, other):
+        """Merge the partial accumulator other into this one."""
+        nlabels = max(self.nlabels, other.nlabels)
+        self._grow(nlabels)
+        other._grow(nlabels)
+
+        # pairwise update of mean and sum of squared deviations (Chan et al.)
+        na = self.count.reshape(-1, 1)
+        nb = other.count.reshape(-1, 1)
+        total = na + nb
+        weight = numpy.zeros_like(total)
+        numpy.divide(nb, total, out=weight, where=total > 0)
+        delta = other.mean - self.mean
+        self.m2 = self.m2 + other.m2 + delta ** 2 * na * weight
+        self.mean = self.mean + delta * weight
+        self.count = total.reshape(-1)
+
+        numpy.minimum(self.minimum, other.minimum, out=self.minimum)
+        numpy.maximum(self.maximum, other.maximum, out=self.maximum)
+        self.coord_sum += other.coord_sum
+        numpy.minimum(self.coord_min, other.coord_min, out=self.coord_min)
+        numpy.maximum(self.coord_max, other.coord_max, out=self.coord_max)
+        self.histogram += other.histogram
+        numpy.minimum(self.image_min, other.image_min, out=self.image_min)
+        numpy.maximum(self.image_max, other.image_max, out=self.image_max)
+        return self
+
+    def features(self, names):
+        """Return the accumulated features.
+
+        :param names: which features to return (see supported_features)
+        :returns: a dictionary with one entry per feature. dict[feature_name]
+            is a numpy.ndarray with ndim=2 and shape[0] == number of objects
+
+        """
+        count = self.count[1:].reshape(-1, 1)
+        present = count[:, 0] > 0
+
+        def per_object(values):
+            result = numpy.zeros(values.shape, dtype=numpy.float64)
+            numpy.divide(values, count, out=result, where=count > 0)
+            return result
+
+        def for_present(values):
+            result = numpy.zeros(values.shape, dtype=numpy.float64)
+            result[present] = values[present]
+            return result
+
+        available = {
+            'Count': lambda: count.copy(),
+            'Sum': lambda: self.mean[1:] * count,
+            'Mean': lambda: self.mean[1:].copy(),
+            'Variance': lambda: per_object(self.m2[1:]),
+            'Minimum': lambda: for_present(self.minimum[1:]),
+            'Maximum': lambda: for_present(self.maximum[1:]),
+            'RegionCenter': lambda: per_object(self.coord_sum[1:]),
+            'Coord<Minimum>': lambda: for_present(self.coord_min[1:]),
+            'Coord<Maximum>': lambda: for_present(self.coord_max[1:]),
+            'Histogram': lambda: self.histogram[1:].copy(),
+        }
+        return dict((name, available[name]()) for name in names)
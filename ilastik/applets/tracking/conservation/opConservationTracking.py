@@ -19,7 +19,7 @@ from lazyflow.roi import sliceToRoi
 from .opRelabeledMergerFeatureExtraction import OpRelabeledMergerFeatureExtraction
 
 from functools import partial
-from lazyflow.request import Request, RequestPool
+from lazyflow.request import Request, RequestPool, RequestLock
 
 from hytra.core.jsongraph import getMappingsBetweenUUIDsAndTraxels, getMergersDetectionsLinksDivisions, getMergersPerTimestep, getLinksPerTimestep, getDetectionsPerTimestep, getDivisionsPerTimestep
 from hytra.core.ilastikhypothesesgraph import IlastikHypothesesGraph
@@ -45,6 +45,64 @@ except ImportError:
     except ImportError:
         logger.warning("Could not find any ILP solver")
 
+def traxel_table(feats, x_range, y_range, z_range, size_range):
+    """Columnar traxel table of a single time step.
+
+    Objects whose bounding box lies outside of the field of view or whose
+    size is outside of size_range are filtered out.
+
+    :param feats: the default features of one time step (with background row)
+    :returns: dict with the label ids of the remaining objects ('ids'),
+        their centers ('com'), bounding boxes ('lower', 'upper') as (n, 3)
+        arrays (z = 0 for 2d data), sizes ('count') and the ids of the
+        filtered objects ('filtered')
+    """
+    rc = np.asarray(feats['RegionCenter'], dtype=np.float64)
+    lower = np.asarray(feats['Coord<Minimum>'], dtype=np.float64)
+    upper = np.asarray(feats['Coord<Maximum>'], dtype=np.float64)
+    ct = np.asarray(feats['Count'], dtype=np.float64)
+    if rc.size:
+        rc = rc[1:, ...]
+        lower = lower[1:, ...]
+        upper = upper[1:, ...]
+    if ct.size:
+        ct = ct[1:, ...]
+
+    nobj = rc.shape[0]
+    ndim = rc.shape[1] if rc.ndim == 2 else 0
+    if nobj and ndim not in (2, 3):
+        raise DatasetConstraintError("Tracking", "The RegionCenter feature must have dimensionality 2 or 3.")
+
+    def xyz(a):
+        # for 2d data, set z-coordinate to 0
+        result = np.zeros((nobj, 3), dtype=np.float64)
+        if nobj:
+            result[:, :ndim] = a.reshape(nobj, ndim)
+        return result
+
+    rc, lower, upper = xyz(rc), xyz(lower), xyz(upper)
+    size = ct.reshape(nobj, -1)[:, 0] if nobj else np.zeros((0,))
+
+    outside = np.zeros((nobj,), dtype=bool)
+    for d, (start, stop) in enumerate((x_range, y_range, z_range)):
+        outside |= (upper[:, d] < start) | (lower[:, d] >= stop)
+    outside |= (size < size_range[0]) | (size >= size_range[1])
+    keep = ~outside
+
+    ids = np.arange(1, nobj + 1)
+    return {'ids': ids[keep],
+            'com': rc[keep],
+            'lower': lower[keep],
+            'upper': upper[keep],
+            'count': size[keep],
+            'filtered': ids[outside]}
+
+
+def clip_probabilities(prob):
+    """Clip probabilities to [1e-7, 0.99999999], as expected by the solvers."""
+    return np.clip(prob, 0.0000001, 0.99999999)
+
+
 class OpConservationTracking(Operator):
     LabelImage = InputSlot()
     ObjectFeatures = InputSlot(stype=Opaque, rtype=List)
@@ -727,136 +785,78 @@ class OpConservationTracking(Operator):
         logger.info("filling traxelstore")
 
         filtered_labels = {}
-        total_count = 0
-        empty_frame = False
+        traxelsPerFrame = {}
         numTimeStep = len(list(feats.keys()))
-        countT = 0
+        progress = {'frames': 0}
+        progressLock = RequestLock()
 
         stepStr = "Creating traxel store"
         self.progressVisitor.showState(stepStr+"                              ")
 
-        for t in list(feats.keys()):
-            countT +=1
-            self.progressVisitor.showProgress(old_div(countT,float(numTimeStep)))
-
-            rc = feats[t][default_features_key]['RegionCenter']
-            lower = feats[t][default_features_key]['Coord<Minimum>']
-            upper = feats[t][default_features_key]['Coord<Maximum>']
-            if rc.size:
-                rc = rc[1:, ...]
-                lower = lower[1:, ...]
-                upper = upper[1:, ...]
-
-            ct = feats[t][default_features_key]['Count']
-            if ct.size:
-                ct = ct[1:, ...]
-
-            logger.debug("at timestep {}, {} traxels found".format(t, rc.shape[0]))
-            count = 0
-            filtered_labels_at = []
-            for idx in range(rc.shape[0]):
+        def fillFrame(t):
+            table = traxel_table(feats[t][default_features_key], x_range, y_range, z_range, size_range)
+            if with_div:
+                # divProbs starts from 0 (background), the table ids from 1
+                table['divProb'] = clip_probabilities(
+                    np.asarray([divProbs[t][i][1] for i in table['ids']], dtype=np.float64))
+            if with_classifier_prior:
+                table['detProb'] = [clip_probabilities(np.asarray(detProbs[t][i], dtype=np.float64))
+                                    for i in table['ids']]
+
+            traxels = {}
+            for row, idx in enumerate(table['ids']):
                 traxel = Traxel()
-
-                # for 2d data, set z-coordinate to 0:
-                if len(rc[idx]) == 2:
-                    x, y = rc[idx]
-                    z = 0
-                    x_lower, y_lower = lower[idx]
-                    x_upper, y_upper = upper[idx]
-                    z_lower = 0
-                    z_upper = 0
-                elif len(rc[idx]) == 3:
-                    x, y, z = rc[idx]
-                    x_lower, y_lower, z_lower = lower[idx]
-                    x_upper, y_upper, z_upper = upper[idx]
-                else:
-                    raise DatasetConstraintError ("Tracking", "The RegionCenter feature must have dimensionality 2 or 3.")
-
-                size = ct[idx]
-
-                if (x_upper < x_range[0]  or x_lower >= x_range[1] or
-                            y_upper < y_range[0] or y_lower >= y_range[1] or
-                            z_upper < z_range[0] or z_lower >= z_range[1] or
-                            size < size_range[0] or size >= size_range[1]):
-                    filtered_labels_at.append(int(idx + 1))
-                    continue
-                else:
-                    count += 1
-
-                traxel.Id = int(idx + 1)
+                traxel.Id = int(idx)
                 traxel.Timestep = int(t)
                 traxel.set_x_scale(x_scale)
                 traxel.set_y_scale(y_scale)
                 traxel.set_z_scale(z_scale)
 
                 # Expects always 3 coordinates, z=0 for 2d data
-                traxel.add_feature_array("com", 3)
-                for i, v in enumerate([x, y, z]):
-                    traxel.set_feature_value('com', i, float(v))
-
-                traxel.add_feature_array("CoordMinimum", 3)
-                for i, v in enumerate(lower[idx]):
-                    traxel.set_feature_value("CoordMinimum", i, float(v))
-                traxel.add_feature_array("CoordMaximum", 3)
-                for i, v in enumerate(upper[idx]):
-                    traxel.set_feature_value("CoordMaximum", i, float(v))
+                for name, column in (('com', 'com'), ('CoordMinimum', 'lower'), ('CoordMaximum', 'upper')):
+                    traxel.add_feature_array(name, 3)
+                    traxel.Features[name][:] = table[column][row]
 
                 if with_div:
+                    prob = table['divProb'][row]
                     traxel.add_feature_array("divProb", 2)
-                    # idx+1 because rc and ct start from 1, divProbs starts from 0
-                    prob = float(divProbs[t][idx + 1][1])
-                    prob = float(prob)
-                    if prob < 0.0000001:
-                        prob = 0.0000001
-                    if prob > 0.99999999:
-                        prob = 0.99999999
-                    traxel.set_feature_value("divProb", 0, 1.0 - prob)
-                    traxel.set_feature_value("divProb", 1, prob)
+                    traxel.Features["divProb"][:] = (1.0 - prob, prob)
 
                 if with_classifier_prior:
-                    traxel.add_feature_array("detProb", len(detProbs[t][idx + 1]))
-                    for i, v in enumerate(detProbs[t][idx + 1]):
-                        val = float(v)
-                        if val < 0.0000001:
-                            val = 0.0000001
-                        if val > 0.99999999:
-                            val = 0.99999999
-                        traxel.set_feature_value("detProb", i, float(val))
+                    traxel.add_feature_array("detProb", len(table['detProb'][row]))
+                    traxel.Features["detProb"][:] = table['detProb'][row]
 
                 # FIXME: check whether it is 2d or 3d data!
                 if with_local_centers:
-                    traxel.add_feature_array("localCentersX", len(localCenters[t][idx + 1]))
-                    traxel.add_feature_array("localCentersY", len(localCenters[t][idx + 1]))
-                    traxel.add_feature_array("localCentersZ", len(localCenters[t][idx + 1]))
-
-                    for i, v in enumerate(localCenters[t][idx + 1]):
-                        traxel.set_feature_value("localCentersX", i, float(v[0]))
-                        traxel.set_feature_value("localCentersY", i, float(v[1]))
-                        traxel.set_feature_value("localCentersZ", i, float(v[2]))
+                    centers = np.asarray(localCenters[t][idx], dtype=np.float64).reshape(-1, 3)
+                    for i, name in enumerate(("localCentersX", "localCentersY", "localCentersZ")):
+                        traxel.add_feature_array(name, len(centers))
+                        traxel.Features[name][:] = centers[:, i]
 
                 traxel.add_feature_array("count", 1)
-                traxel.set_feature_value("count", 0, float(size))
-
-                if (x_upper < x_range[0]  or x_lower >= x_range[1] or
-                            y_upper < y_range[0] or y_lower >= y_range[1] or
-                            z_upper < z_range[0] or z_lower >= z_range[1] or
-                            size < size_range[0] or size >= size_range[1]):
-                    logger.info("Omitting traxel with ID: {} {}".format(traxel.Id,t))
-                    print("Omitting traxel with ID: {} {}".format(traxel.Id,t))
-                else:
-                    logger.debug("Adding traxel with ID: {}  {}".format(traxel.Id,t))
-                    traxelstore.TraxelsPerFrame.setdefault(int(t), {})[int(idx + 1)] = traxel
+                traxel.Features["count"][0] = table['count'][row]
+                traxels[int(idx)] = traxel
 
-            if len(filtered_labels_at) > 0:
-                filtered_labels[str(int(t) - time_range[0])] = filtered_labels_at
+            logger.debug("at timestep {}, {} traxels found, {} passed filter".format(
+                t, len(table['ids']) + len(table['filtered']), len(table['ids'])))
+            if len(table['ids']) == 0:
+                logger.info('Found empty frames for time {}'.format(t))
 
-            logger.debug("at timestep {}, {} traxels passed filter".format(t, count))
+            with progressLock:
+                if traxels:
+                    traxelsPerFrame[int(t)] = traxels
+                if len(table['filtered']) > 0:
+                    filtered_labels[str(int(t) - time_range[0])] = [int(i) for i in table['filtered']]
+                progress['frames'] += 1
+                self.progressVisitor.showProgress(old_div(progress['frames'], float(numTimeStep)))
 
-            if count == 0:
-                empty_frame = True
-                logger.info('Found empty frames for time {}'.format(t))
+        pool = RequestPool()
+        for t in list(feats.keys()):
+            pool.add(Request(partial(fillFrame, t)))
+        pool.wait()
 
-            total_count += count
+        for t in sorted(traxelsPerFrame.keys()):
+            traxelstore.TraxelsPerFrame[t] = traxelsPerFrame[t]
 
         self.parent.parent.trackingApplet.progressSignal(100)
         self.FilteredLabels.setValue(filtered_labels, check_changed=True)
@@ -1,12 +1,14 @@
 
 from collections import OrderedDict
+from functools import partial
 import numpy as np
 
 from wsdt import wsDtSegmentation
 
 from lazyflow.utility import OrderedSignal
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.roi import roiToSlice, sliceToRoi
+from lazyflow.request import Request, RequestPool, RequestLock
+from lazyflow.roi import roiToSlice, sliceToRoi, getIntersectingBlocks, getBlockBounds, getIntersection
 from lazyflow.operators import OpBlockedArrayCache, OpValueCache
 from lazyflow.operators.generic import OpPixelOperator, OpSingleChannelSelector
 
@@ -27,6 +29,12 @@ class OpWsdt(Operator):
     GroupSeeds = InputSlot(value=False)
     PreserveMembranePmaps = InputSlot(value=False)
 
+    # Blockwise mode (optional): Shape of the blocks (spatial axes only, without channel).
+    # Each block is segmented separately (including a halo), in parallel,
+    # and the block results are stitched into consistent superpixel ids.
+    BlockShape = InputSlot(optional=True)
+    BlockHalo = InputSlot(value=16)
+
     EnableDebugOutputs = InputSlot(value=False)
     
     Superpixels = OutputSlot()
@@ -36,6 +44,10 @@ class OpWsdt(Operator):
         self.debug_results = None
         self.watershed_completed = OrderedSignal()
 
+        # Blockwise mode: block_start -> lut (block labels -> global superpixel ids)
+        self._block_luts = None
+        self._blockwise_lock = RequestLock()
+
         self._opSelectedInput = OpSumChannels( parent=self )
         self._opSelectedInput.ChannelSelections.connect( self.ChannelSelections )
         self._opSelectedInput.Input.connect( self.Input )
@@ -56,10 +68,24 @@ class OpWsdt(Operator):
         if self.EnableDebugOutputs.value:
             self.debug_results = OrderedDict()
 
+        if self._block_shape() is not None:
+            assert len(self._block_shape()) == len(self.Input.meta.shape)-1, \
+                "BlockShape must have one entry per spatial axis, got {}".format( self._block_shape() )
+
+    def _block_shape(self):
+        if not self.BlockShape.ready() or self.BlockShape.value is None:
+            return None
+        return tuple(map(int, self.BlockShape.value))
+
     def execute(self, slot, subindex, roi, result):
         assert slot is self.Superpixels, \
             "Unknown or unconnected output slot: {}".format( slot )
 
+        if self._block_shape() is not None:
+            self._execute_blockwise(roi, result)
+            self.watershed_completed()
+            return
+
         pmap = self._opSelectedInput.Output(roi.start, roi.stop).wait()
 
         if self.debug_results:
@@ -76,11 +102,204 @@ class OpWsdt(Operator):
                                           out=result[...,0] )
         
         self.watershed_completed()
-        
+
+    def _execute_blockwise(self, roi, result):
+        block_luts = self._stitch_blocks()
+
+        shape = self.Superpixels.meta.shape[:-1]
+        block_shape = self._block_shape()
+        spatial_roi = (tuple(roi.start[:-1]), tuple(roi.stop[:-1]))
+
+        def render_block(block_start):
+            block_start = tuple(block_start)
+            # The block labels are not kept after stitching (they would add up to the whole volume),
+            # so the block is segmented again.  The watershed is deterministic, so the lut still applies.
+            block_labels = self._compute_block(block_start)['core_labels']
+
+            block_roi = getBlockBounds(shape, block_shape, block_start)
+            intersection = getIntersection(block_roi, spatial_roi)
+            block_slicing = roiToSlice(*(np.subtract(intersection, block_start)))
+            result_slicing = roiToSlice(*(np.subtract(intersection, spatial_roi[0])))
+            result[result_slicing + (0,)] = block_luts[block_start][block_labels[block_slicing]]
+
+        pool = RequestPool()
+        for block_start in getIntersectingBlocks(block_shape, spatial_roi):
+            pool.add( Request( partial(render_block, block_start) ) )
+        pool.wait()
+
+    def _compute_block(self, block_start):
+        """
+        Run the watershed on a single block, enlarged by the halo.
+
+        Returns a dict with the labels of the block itself ('core_labels'), the number of
+        labels ('max_label'), and the labels on the block faces, which are used for stitching:
+        'lower_faces' (first slice of the block along each axis) and 'upper_faces'
+        (first slice of the next block along each axis, segmented as part of this block's halo).
+        The faces are copies, so they don't keep the whole block in memory.
+        """
+        shape = self.Superpixels.meta.shape[:-1]
+        halo = int(self.BlockHalo.value)
+        block_start, block_stop = getBlockBounds(shape, self._block_shape(), block_start)
+        halo_start = np.maximum(np.subtract(block_start, halo), 0)
+        halo_stop = np.minimum(np.add(block_stop, halo), shape)
+
+        pmap = self._opSelectedInput.Output( tuple(halo_start) + (0,), tuple(halo_stop) + (1,) ).wait()
+        ws, max_label = wsDtSegmentation( pmap[...,0],
+                                          self.Pmin.value,
+                                          self.MinMembraneSize.value,
+                                          self.MinSegmentSize.value,
+                                          self.SigmaMinima.value,
+                                          self.SigmaWeights.value,
+                                          self.GroupSeeds.value,
+                                          self.PreserveMembranePmaps.value )
+        ws = np.asarray(ws)
+
+        core_start = np.subtract(block_start, halo_start)
+        core_stop = np.subtract(block_stop, halo_start)
+        core_labels = ws[roiToSlice(core_start, core_stop)]
+
+        lower_faces = {}
+        upper_faces = {}
+        for axis in range(len(shape)):
+            if block_start[axis] > 0:
+                face = [slice(None)] * len(shape)
+                face[axis] = 0
+                lower_faces[axis] = core_labels[tuple(face)].copy()
+            if block_stop[axis] < shape[axis] and halo > 0:
+                face = list(roiToSlice(core_start, core_stop))
+                face[axis] = core_stop[axis]
+                upper_faces[axis] = ws[tuple(face)].copy()
+
+        return { 'core_labels': core_labels,
+                 'max_label': int(max_label),
+                 'lower_faces': lower_faces,
+                 'upper_faces': upper_faces }
+
+    def _stitch_blocks(self):
+        """
+        Segment all blocks (in parallel) and determine the global superpixel id of each block label.
+        Labels of neighboring blocks are merged if they match on the face between the blocks.
+        Only the block faces and label counts are kept, so memory use doesn't scale with the volume.
+        """
+        with self._blockwise_lock:
+            if self._block_luts is not None:
+                return self._block_luts
+
+            shape = self.Superpixels.meta.shape[:-1]
+            block_shape = self._block_shape()
+            block_starts = list(map(tuple, getIntersectingBlocks(block_shape, ((0,)*len(shape), shape))))
+
+            blocks = {}
+            def segment_block(block_start):
+                block = self._compute_block(block_start)
+                # Only the labels that occur within the block itself (not just in its halo) get an id.
+                core_labels = block.pop('core_labels')
+                block['core_label_ids'] = np.unique( core_labels )
+                blocks[block_start] = block
+
+            pool = RequestPool()
+            for block_start in block_starts:
+                pool.add( Request( partial(segment_block, block_start) ) )
+            pool.wait()
+
+            # Block labels are made unique by offsetting them
+            offsets = {}
+            num_labels = 0
+            for block_start in block_starts:
+                offsets[block_start] = num_labels
+                num_labels += blocks[block_start]['max_label']
+
+            merge_pairs = []
+            for block_start in block_starts:
+                block = blocks[block_start]
+                for axis, upper_face in block['upper_faces'].items():
+                    neighbor_start = list(block_start)
+                    neighbor_start[axis] += block_shape[axis]
+                    neighbor_start = tuple(neighbor_start)
+                    labels, neighbor_labels = matching_face_labels( upper_face, blocks[neighbor_start]['lower_faces'][axis] )
+                    merge_pairs.append( (labels + offsets[block_start], neighbor_labels + offsets[neighbor_start]) )
+
+            occurring = np.zeros( num_labels+1, dtype=bool )
+            for block_start in block_starts:
+                labels = blocks[block_start]['core_label_ids']
+                occurring[ labels[labels != 0] + offsets[block_start] ] = True
+
+            global_ids = merged_label_ids( num_labels, merge_pairs, occurring )
+
+            self._block_luts = {}
+            for block_start in block_starts:
+                offset = offsets[block_start]
+                lut = global_ids[offset:offset + blocks[block_start]['max_label'] + 1].copy()
+                lut[0] = 0
+                self._block_luts[block_start] = lut
+
+            return self._block_luts
+
     def propagateDirty(self, slot, subindex, roi):
         if slot is not self.EnableDebugOutputs:
+            with self._blockwise_lock:
+                self._block_luts = None
             self.Superpixels.setDirty()
 
+
+def matching_face_labels(labels_a, labels_b):
+    """
+    Given the labels of two segmentations of the same face,
+    find the label pairs that cover most (more than half) of each other's area.
+
+    Returns two arrays: the matching labels of a, and of b.
+    """
+    labels_a = np.asarray(labels_a, dtype=np.uint64).ravel()
+    labels_b = np.asarray(labels_b, dtype=np.uint64).ravel()
+
+    ids_a, areas_a = np.unique(labels_a, return_counts=True)
+    ids_b, areas_b = np.unique(labels_b, return_counts=True)
+
+    pairs, overlaps = np.unique( (labels_a << np.uint64(32)) | labels_b, return_counts=True )
+    pairs_a = pairs >> np.uint64(32)
+    pairs_b = pairs & np.uint64(0xFFFFFFFF)
+
+    matching = (2*overlaps > areas_a[np.searchsorted(ids_a, pairs_a)]) \
+             & (2*overlaps > areas_b[np.searchsorted(ids_b, pairs_b)]) \
+             & (pairs_a != 0) & (pairs_b != 0)
+    return pairs_a[matching].astype(np.int64), pairs_b[matching].astype(np.int64)
+
+
+def merged_label_ids(num_labels, merge_pairs, occurring=None):
+    """
+    Merge labels 1..num_labels according to the given pairs of label arrays (union-find)
+    and assign consecutive ids, starting at 1, to the merged labels.
+    If given, only merged labels that contain an occurring label (bool array, indexed by label) are numbered.
+
+    Returns the new id of each label, as uint32 array (with label 0 -> 0).
+    """
+    parents = np.arange(num_labels+1)
+
+    def find(label):
+        root = label
+        while parents[root] != root:
+            root = parents[root]
+        while parents[label] != root:
+            parents[label], label = root, parents[label]
+        return root
+
+    for labels_a, labels_b in merge_pairs:
+        for label_a, label_b in zip(labels_a.tolist(), labels_b.tolist()):
+            root_a, root_b = find(label_a), find(label_b)
+            if root_a != root_b:
+                parents[max(root_a, root_b)] = min(root_a, root_b)
+
+    # Flatten, then make consecutive
+    roots = parents
+    while (roots[roots] != roots).any():
+        roots = roots[roots]
+    if occurring is None:
+        occurring = np.ones( num_labels+1, dtype=bool )
+    occurring = occurring.copy()
+    occurring[0] = True
+    used_roots = np.unique( roots[occurring] )
+    return np.searchsorted( used_roots, roots ).astype(np.uint32)
+
 class OpCachedWsdt(Operator):
     RawData = InputSlot(optional=True) # Used by the GUI for display only
     FreezeCache = InputSlot(value=True)
@@ -97,6 +316,9 @@ class OpCachedWsdt(Operator):
     GroupSeeds = InputSlot(value=False)
     PreserveMembranePmaps = InputSlot(value=False)
 
+    BlockShape = InputSlot(optional=True)
+    BlockHalo = InputSlot(value=16)
+
     EnableDebugOutputs = InputSlot(value=False)
     
     Superpixels = OutputSlot()
@@ -128,6 +350,8 @@ class OpCachedWsdt(Operator):
         self._opWsdt.SigmaWeights.connect( self.SigmaWeights )
         self._opWsdt.GroupSeeds.connect( self.GroupSeeds )
         self._opWsdt.PreserveMembranePmaps.connect( self.PreserveMembranePmaps )
+        self._opWsdt.BlockShape.connect( self.BlockShape )
+        self._opWsdt.BlockHalo.connect( self.BlockHalo )
         self._opWsdt.EnableDebugOutputs.connect( self.EnableDebugOutputs )
         
         self._opCache = OpBlockedArrayCache( parent=self )
@@ -148,6 +372,13 @@ class OpCachedWsdt(Operator):
     def setupOutputs(self):
         self._opThreshold.Function.setValue( lambda a: (a >= self.Pmin.value).astype(np.uint8) )
 
+        # In blockwise mode, cache the superpixels block by block
+        if self.BlockShape.ready() and self.BlockShape.value is not None:
+            self._opCache.BlockShape.setValue( tuple(map(int, self.BlockShape.value)) + (1,) )
+        else:
+            # Back to whole-volume mode: the cache chooses its block shape itself again
+            self._opCache.BlockShape.disconnect()
+
     @property
     def debug_results(self):
         return self._opWsdt.debug_results
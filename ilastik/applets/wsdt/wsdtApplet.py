@@ -46,7 +46,9 @@ class WsdtApplet( StandardApplet ):
                  'SigmaMinima',
                  'SigmaWeights',
                  'GroupSeeds',
-                 'PreserveMembranePmaps' ]
+                 'PreserveMembranePmaps',
+                 'BlockShape',
+                 'BlockHalo' ]
 
     @property
     def singleLaneGuiClass(self):
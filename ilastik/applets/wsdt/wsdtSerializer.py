@@ -30,6 +30,8 @@ class WsdtSerializer(AppletSerializer):
                   SerialSlot(operator.SigmaWeights), 
                   SerialSlot(operator.GroupSeeds),
                   SerialSlot(operator.PreserveMembranePmaps),
+                  SerialSlot(operator.BlockShape),
+                  SerialSlot(operator.BlockHalo),
                   SerialBlockSlot(operator.Superpixels,
                                   operator.SuperpixelCacheInput,
                                   operator.CleanBlocks,
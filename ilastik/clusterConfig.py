@@ -41,6 +41,12 @@ ClusterConfigFields = \
     "node_output_decompression_cmd" : FormattedField( requiredFields=["compressed_file", "uncompressed_file"]),
     "task_progress_update_command" : FormattedField( requiredFields=["progress"] ),
     "task_launch_server" : str,
+    "task_executor" : str, # "command" (default): launch command_format for each task, "local": run the tasks in a local process pool
+    "local_num_workers" : AutoEval(int),
+    "task_max_retries" : AutoEval(int),
+    "task_scheduler" : str, # "static" (default): one task per block, "queue": workers pull blocks from a shared queue
+    "queue_num_workers" : AutoEval(int),
+    "task_stale_claim_secs" : AutoEval(int),
     "output_log_directory" : str,
     "server_working_directory" : str,
     "command_format" : FormattedField( requiredFields=["task_args"], optionalFields=["task_name"] ),
@@ -22,7 +22,10 @@ from __future__ import division
 from past.utils import old_div
 import os
 import copy
+import time
+import signal
 import subprocess
+import multiprocessing
 import collections
 import hashlib
 import functools
@@ -42,6 +45,166 @@ from ilastik.workflow import Workflow
 import logging
 logger = logging.getLogger(__name__)
 
+#: How often the local executor checks on its tasks
+LOCAL_TASK_POLL_INTERVAL_SECS = 1.0
+
+#: How often a failed block is relaunched by the local executor, unless the config specifies task_max_retries
+DEFAULT_TASK_MAX_RETRIES = 2
+
+#: How long a block claim may go without a heartbeat before another worker takes the block over,
+#: unless the config specifies task_stale_claim_secs
+DEFAULT_STALE_CLAIM_SECS = 10*60
+
+def blockClaimDirectory( descriptionFilePath ):
+    """
+    The directory in which the workers of a blockwise fileset claim their blocks (see BlockClaimQueue).
+    """
+    return os.path.splitext( descriptionFilePath )[0] + "_block_claims"
+
+class BlockClaimQueue(object):
+    """
+    A queue of the blocks of a BlockwiseFileset, shared by all workers via the filesystem.
+
+    Workers pull the next block when they are done with the previous one, so fast workers
+    take over the work of slow ones.  A worker claims a block by atomically creating a claim file
+    for it, and keeps the claim alive via heartbeat() while it works on the block.
+    Completion is tracked via the usual BLOCK_AVAILABLE block status, so blocks that were finished
+    in a previous run are never claimed again.
+
+    If the claim of an unfinished block isn't refreshed for staleClaimSecs (e.g. because its worker
+    died or hangs), the block is re-executed by the next worker that runs out of unclaimed blocks.
+    Claim files are numbered by generation (<block>.<gen>.claim): a stale claim is taken over by
+    exclusively creating the file of the next generation, so only one worker can win the takeover.
+    The block belongs to the worker holding the highest generation, and workers must check
+    ownsBlock() before they write anything for it, since a hung worker may wake up after its
+    block was taken over.
+    """
+    def __init__(self, claimDirectory, blockwiseFileset, workerName, staleClaimSecs=None):
+        self._claimDirectory = claimDirectory
+        self._blockwiseFileset = blockwiseFileset
+        self._workerName = workerName
+        self._staleClaimSecs = staleClaimSecs or DEFAULT_STALE_CLAIM_SECS
+        self._blockRois = [ ( tuple(roi[0]), tuple(roi[1]) ) for roi in blockwiseFileset.getAllBlockRois() ]
+        self._currentRoi = None
+        self._currentGeneration = None
+        if not os.path.exists( claimDirectory ):
+            try:
+                os.makedirs( claimDirectory )
+            except OSError:
+                # Another worker was faster
+                pass
+
+    def _blockName(self, roi):
+        return "_".join( map(str, roi[0]) )
+
+    def _claimFilePath(self, roi, generation):
+        return os.path.join( self._claimDirectory, "{}.{}.claim".format( self._blockName(roi), generation ) )
+
+    def _latestGeneration(self, roi):
+        """
+        Return the highest claim generation of the given block, or None if it isn't claimed.
+        """
+        prefix = self._blockName(roi) + "."
+        generations = []
+        for filename in os.listdir( self._claimDirectory ):
+            if filename.startswith( prefix ) and filename.endswith( ".claim" ):
+                try:
+                    generations.append( int( filename[len(prefix):-len(".claim")] ) )
+                except ValueError:
+                    pass
+        return max( generations ) if generations else None
+
+    def _isBlockDone(self, roi):
+        return self._blockwiseFileset.getBlockStatus( roi[0] ) == BlockwiseFileset.BLOCK_AVAILABLE
+
+    def _tryClaim(self, roi, generation):
+        try:
+            fd = os.open( self._claimFilePath(roi, generation), os.O_CREAT | os.O_EXCL | os.O_WRONLY )
+        except OSError:
+            # Another worker was faster
+            return False
+        with os.fdopen( fd, 'w' ) as f:
+            f.write( self._workerName )
+        self._currentRoi = roi
+        self._currentGeneration = generation
+        return True
+
+    def claimNext(self):
+        """
+        Claim the next unfinished block and return its roi.
+        Return None if there is nothing left to do (all unfinished blocks are claimed by live workers).
+        """
+        unfinished_rois = [ roi for roi in self._blockRois if not self._isBlockDone(roi) ]
+        claimed_rois = []
+        for roi in unfinished_rois:
+            generation = self._latestGeneration(roi)
+            if generation is not None:
+                claimed_rois.append( (roi, generation) )
+            elif self._tryClaim(roi, 0):
+                return roi
+
+        # Everything is claimed.  Take over the block with the oldest stale claim, if any.
+        now = time.time()
+        stale_rois = []
+        for roi, generation in claimed_rois:
+            try:
+                age = now - os.path.getmtime( self._claimFilePath(roi, generation) )
+            except OSError:
+                # Released (or taken over) in the meantime
+                continue
+            if age > self._staleClaimSecs and not self._isBlockDone(roi):
+                stale_rois.append( (age, roi, generation) )
+        for _, roi, generation in sorted( stale_rois, reverse=True ):
+            # Only one worker can create the next generation.
+            if self._tryClaim(roi, generation+1):
+                logger.info( "Taking over stalled block: {}".format( roi ) )
+                return roi
+        return None
+
+    def ownsBlock(self, roi):
+        """
+        Return True if this worker still holds the claim of the given block,
+        i.e. it wasn't taken over by another worker in the meantime.
+        """
+        roi = ( tuple(roi[0]), tuple(roi[1]) )
+        if roi != self._currentRoi:
+            return False
+        return self._latestGeneration(roi) == self._currentGeneration
+
+    def heartbeat(self, *args):
+        """
+        Keep the claim of the current block alive.
+        (Can be subscribed to a progress signal.)
+        """
+        roi = self._currentRoi
+        if roi is not None:
+            try:
+                os.utime( self._claimFilePath(roi, self._currentGeneration), None )
+            except OSError:
+                pass
+
+    def release(self, roi):
+        """
+        Give up the claim of the given block (whether it was finished or not).
+        """
+        roi = ( tuple(roi[0]), tuple(roi[1]) )
+        if self._currentRoi == roi:
+            try:
+                os.remove( self._claimFilePath(roi, self._currentGeneration) )
+            except OSError:
+                pass
+            self._currentRoi = None
+            self._currentGeneration = None
+
+    @classmethod
+    def clearClaims(cls, claimDirectory):
+        """
+        Remove all claims.  Only safe if no workers are running.
+        """
+        if os.path.exists( claimDirectory ):
+            for filename in os.listdir( claimDirectory ):
+                os.remove( os.path.join( claimDirectory, filename ) )
+
 class OpTaskWorker(Operator):
     Input = InputSlot()
     RoiString = InputSlot(stype='string')
@@ -56,6 +219,12 @@ class OpTaskWorker(Operator):
         self.progressSignal = OrderedSignal()
         self._primaryBlockwiseFileset = None
 
+        # Set by queue workers (see BlockClaimQueue), so that a block that was taken over
+        # by another worker in the meantime isn't written twice.
+        self.blockClaimQueue = None
+        self._blockRoi = None
+        self._claimLost = False
+
     def setupOutputs(self):
         self.ReturnCode.meta.dtype = bool
         self.ReturnCode.meta.shape = (1,)
@@ -97,6 +266,8 @@ class OpTaskWorker(Operator):
         assert (blockwiseFileset.getEntireBlockRoi( roi.start )[1] == roi.stop).all(), "Each task must execute exactly one full block.  ({},{}) is not a valid block roi.".format( roi.start, roi.stop )
         assert self.Input.ready()
 
+        self._blockRoi = (roi.start, roi.stop)
+        self._claimLost = False
         with Timer() as computeTimer:
             # Stream the data out to disk.
             request_blockshape = self._primaryBlockwiseFileset.description.sub_block_shape # Could be None.  That's okay.
@@ -106,7 +277,8 @@ class OpTaskWorker(Operator):
             streamer.execute()
 
             # Now the block is ready.  Update the status.
-            blockwiseFileset.setBlockStatus( roi.start, BlockwiseFileset.BLOCK_AVAILABLE )
+            if self._ownsBlock():
+                blockwiseFileset.setBlockStatus( roi.start, BlockwiseFileset.BLOCK_AVAILABLE )
 
         logger.info( "Finished task in {} seconds".format( computeTimer.seconds() ) )
         result[0] = True
@@ -115,7 +287,19 @@ class OpTaskWorker(Operator):
     def propagateDirty(self, slot, subindex, roi):
         self.ReturnCode.setDirty( slice(None) )
         
+    def _ownsBlock(self):
+        if self.blockClaimQueue is None:
+            return True
+        if not self._claimLost and not self.blockClaimQueue.ownsBlock( self._blockRoi ):
+            logger.warning( "Block {} was taken over by another worker, discarding the results of this worker."
+                            .format( self._blockRoi ) )
+            self._claimLost = True
+        return not self._claimLost
+
     def _handlePrimaryResultBlock(self, roi, result):
+        if not self._ownsBlock():
+            return
+
         # First write the primary
         self._primaryBlockwiseFileset.writeData(roi, result)
 
@@ -140,7 +324,12 @@ class OpClusterize(Operator):
         taskName = None
         command = None
         subregion = None
-        
+        progressFilePath = None
+
+    def __init__(self, *args, **kwargs):
+        super( OpClusterize, self ).__init__( *args, **kwargs )
+        self.progressSignal = OrderedSignal()
+
     def setupOutputs(self):
         self.ReturnCode.meta.dtype = bool
         self.ReturnCode.meta.shape = (1,)
@@ -171,6 +360,25 @@ class OpClusterize(Operator):
                 del taskInfos[roi]
 
             absWorkDir, _ = getPathVariants(self._config.server_working_directory, os.path.split( configFilePath )[0] )
+
+            blockRois = None
+            if self._config.task_scheduler == "queue":
+                # Instead of one task per block, launch workers that pull the blocks from a shared queue.
+                blockRois = list(taskInfos.keys())
+                if self._config.task_executor == "local":
+                    numWorkers = self._getNumLocalWorkers()
+                else:
+                    numWorkers = self._config.queue_num_workers or len(blockRois)
+                taskInfos = self._prepareQueueWorkerTaskInfos( min( numWorkers, len(blockRois) ) )
+
+            if self._config.task_executor == "local":
+                # Run the tasks in a process pool on this machine and wait for them.
+                if blockRois is None:
+                    result[0] = self._executeTasksLocally( taskInfos, blockwiseFileset, absWorkDir )
+                else:
+                    result[0] = self._executeQueueWorkersLocally( taskInfos, blockwiseFileset, blockRois, absWorkDir )
+                return result
+
             if self._config.task_launch_server == "localhost":
                 def localCommand( cmd ):
                     cwd = os.getcwd()
@@ -206,36 +414,249 @@ class OpClusterize(Operator):
         taskInfos = collections.OrderedDict()
         for roiIndex, roi in enumerate(roiList):
             roi = ( tuple(roi[0]), tuple(roi[1]) )
-            taskInfo = OpClusterize.TaskInfo()
-            taskInfo.subregion = SubRegion( None, start=roi[0], stop=roi[1] )
-            
+            subregion = SubRegion( None, start=roi[0], stop=roi[1] )
             taskName = "J{:02}".format(roiIndex)
-
-            commandArgs = []
-            commandArgs.append( "--option_config_file=" + self.ConfigFilePath.value )
-            commandArgs.append( "--project=" + self.ProjectFilePath.value )
-            commandArgs.append( "--_node_work_=\"" + Roi.dumps( taskInfo.subregion ) + "\"" )
-            commandArgs.append( "--process_name={}".format(taskName)  )
-            commandArgs.append( "--output_description_file={}".format( self.OutputDatasetDescription.value )  )
-
-            # Check the command format string: We need to know where to put our args...
-            commandFormat = self._config.command_format
-            assert commandFormat.find("{task_args}") != -1
-
-            # Output log directory might be a relative path (relative to config file)
-            absLogDir, _ = getPathVariants(self._config.output_log_directory, os.path.split( self.ConfigFilePath.value )[0] )
-            if not os.path.exists(absLogDir):
-                os.makedirs(absLogDir)
-            taskOutputLogFilename = taskName + ".log"
-            taskOutputLogPath = os.path.join( absLogDir, taskOutputLogFilename )
-            
-            allArgs = " " + " ".join(commandArgs) + " "
-            taskInfo.taskName = taskName
-            taskInfo.command = commandFormat.format( task_args=allArgs, task_name=taskName, task_output_file=taskOutputLogPath )
+            nodeArgs = [ "--_node_work_=\"" + Roi.dumps( subregion ) + "\"" ]
+            taskInfo = self._prepareTaskInfo( taskName, nodeArgs )
+            taskInfo.subregion = subregion
             taskInfos[roi] = taskInfo
 
         return taskInfos
 
+    def _prepareQueueWorkerTaskInfos(self, numWorkers):
+        """
+        Prepare the tasks for workers that process blocks from the shared BlockClaimQueue until none are left.
+        """
+        logger.info( "Launching {} queue workers.".format( numWorkers ) )
+
+        taskInfos = collections.OrderedDict()
+        for workerIndex in range(numWorkers):
+            taskName = "W{:02}".format(workerIndex)
+            taskInfos[taskName] = self._prepareTaskInfo( taskName, [ "--_node_queue_" ] )
+        return taskInfos
+
+    def _prepareTaskInfo(self, taskName, nodeArgs):
+        taskInfo = OpClusterize.TaskInfo()
+
+        commandArgs = []
+        commandArgs.append( "--option_config_file=" + self.ConfigFilePath.value )
+        commandArgs.append( "--project=" + self.ProjectFilePath.value )
+        commandArgs += nodeArgs
+        commandArgs.append( "--process_name={}".format(taskName)  )
+        commandArgs.append( "--output_description_file={}".format( self.OutputDatasetDescription.value )  )
+
+        # Check the command format string: We need to know where to put our args...
+        commandFormat = self._config.command_format
+        assert commandFormat.find("{task_args}") != -1
+
+        # Output log directory might be a relative path (relative to config file)
+        absLogDir, _ = getPathVariants(self._config.output_log_directory, os.path.split( self.ConfigFilePath.value )[0] )
+        if not os.path.exists(absLogDir):
+            os.makedirs(absLogDir)
+        taskOutputLogFilename = taskName + ".log"
+        taskOutputLogPath = os.path.join( absLogDir, taskOutputLogFilename )
+
+        if self._config.task_executor == "local":
+            # The local executor collects the progress of its tasks from these files.
+            taskInfo.progressFilePath = os.path.join( absLogDir, taskName + ".progress" )
+            commandArgs.append( "--_progress_file_={}".format( taskInfo.progressFilePath ) )
+
+        allArgs = " " + " ".join(commandArgs) + " "
+        taskInfo.taskName = taskName
+        taskInfo.command = commandFormat.format( task_args=allArgs, task_name=taskName, task_output_file=taskOutputLogPath )
+        return taskInfo
+
+    def _getNumLocalWorkers(self):
+        numWorkers = self._config.local_num_workers
+        if numWorkers is None:
+            numWorkers = max( 1, multiprocessing.cpu_count() // (self._config.task_threadpool_size or 1) )
+        return numWorkers
+
+    def _getTaskEnvironment(self):
+        env = dict( os.environ )
+        if self._config.task_threadpool_size is not None:
+            env["LAZYFLOW_THREADS"] = str(self._config.task_threadpool_size)
+        if self._config.task_total_ram_mb is not None:
+            env["LAZYFLOW_TOTAL_RAM_MB"] = str(self._config.task_total_ram_mb)
+        return env
+
+    def _launchLocalTask(self, taskInfo, absWorkDir, env):
+        self._writeTaskProgress( taskInfo, 0 )
+        logger.info( "Launching local task: " + taskInfo.command )
+        # Start the task in its own process group, so the whole group can be killed.
+        return subprocess.Popen( taskInfo.command, shell=True, cwd=absWorkDir, env=env,
+                                 preexec_fn=os.setsid )
+
+    def _executeTasksLocally(self, taskInfos, blockwiseFileset, absWorkDir):
+        """
+        Run the node tasks on this machine, with up to config.local_num_workers tasks at a time.
+        (Each task is a separate process, with the usual task_threadpool_size and task_total_ram_mb budgets.)
+
+        A task fails if its command returns an error, it exceeds task_timeout_secs,
+        or it didn't mark its block as available.  Failed tasks are relaunched up to task_max_retries times.
+
+        The overall progress of the tasks is reported via self.progressSignal.
+
+        Returns True if all blocks were completed.
+        """
+        config = self._config
+        numWorkers = self._getNumLocalWorkers()
+        maxRetries = config.task_max_retries
+        if maxRetries is None:
+            maxRetries = DEFAULT_TASK_MAX_RETRIES
+        env = self._getTaskEnvironment()
+
+        logger.info( "Running {} tasks locally with {} workers".format( len(taskInfos), numWorkers ) )
+
+        pending = collections.deque( taskInfos.keys() )
+        running = collections.OrderedDict() # roi -> (process, start time)
+        attempts = collections.Counter()
+        progress = collections.OrderedDict( (roi, 0) for roi in taskInfos.keys() )
+        failed_rois = []
+        try:
+            while pending or running:
+                while pending and len(running) < numWorkers:
+                    roi = pending.popleft()
+                    attempts[roi] += 1
+                    running[roi] = (self._launchLocalTask( taskInfos[roi], absWorkDir, env ), time.time())
+
+                time.sleep( LOCAL_TASK_POLL_INTERVAL_SECS )
+
+                for roi, (process, startTime) in list(running.items()):
+                    taskInfo = taskInfos[roi]
+                    if process.poll() is None:
+                        if config.task_timeout_secs and time.time() - startTime > config.task_timeout_secs:
+                            logger.warning( "Task {} timed out after {} seconds".format( taskInfo.taskName, config.task_timeout_secs ) )
+                            self._killTask( process )
+                        else:
+                            progress[roi] = self._readTaskProgress( taskInfo )
+                            continue
+
+                    del running[roi]
+                    if process.returncode == 0 \
+                    and blockwiseFileset.getBlockStatus(roi[0]) == BlockwiseFileset.BLOCK_AVAILABLE:
+                        progress[roi] = 100
+                    elif attempts[roi] <= maxRetries:
+                        logger.warning( "Task {} failed with return code {}. Relaunching (attempt {} of {})"
+                                        .format( taskInfo.taskName, process.returncode, attempts[roi]+1, maxRetries+1 ) )
+                        progress[roi] = 0
+                        pending.append( roi )
+                    else:
+                        logger.error( "Task {} failed {} times. Giving up on roi: {}".format( taskInfo.taskName, attempts[roi], roi ) )
+                        progress[roi] = 100
+                        failed_rois.append( roi )
+
+                if progress:
+                    self.progressSignal( old_div( sum(progress.values()), len(progress) ) )
+        finally:
+            for process, _ in list(running.values()):
+                self._killTask( process )
+
+        if failed_rois:
+            logger.error( "{} of {} tasks failed.".format( len(failed_rois), len(taskInfos) ) )
+        return not failed_rois
+
+    def _executeQueueWorkersLocally(self, workerInfos, blockwiseFileset, blockRois, absWorkDir):
+        """
+        Run the queue workers on this machine, all at once, and wait for them.
+
+        The progress is the fraction of blocks that are marked available.
+        Workers that report no progress for task_stale_claim_secs are considered hung and killed.
+        If the workers exit with unfinished blocks left (e.g. because a worker crashed),
+        all claims are cleared and the workers are relaunched, up to task_max_retries times.
+
+        Returns True if all blocks were completed.
+        """
+        config = self._config
+        maxRetries = config.task_max_retries
+        if maxRetries is None:
+            maxRetries = DEFAULT_TASK_MAX_RETRIES
+        env = self._getTaskEnvironment()
+        claimDirectory = blockClaimDirectory( self.OutputDatasetDescription.value )
+        staleSecs = config.task_stale_claim_secs or DEFAULT_STALE_CLAIM_SECS
+
+        def unfinished_rois():
+            return [ roi for roi in blockRois
+                     if blockwiseFileset.getBlockStatus(roi[0]) != BlockwiseFileset.BLOCK_AVAILABLE ]
+
+        remaining_rois = unfinished_rois()
+        for attempt in range( maxRetries+1 ):
+            if not remaining_rois:
+                break
+            if attempt > 0:
+                logger.warning( "{} blocks are unfinished. Relaunching workers (attempt {} of {})"
+                                .format( len(remaining_rois), attempt+1, maxRetries+1 ) )
+
+            # No workers are running, so any claims left over are stale.
+            BlockClaimQueue.clearClaims( claimDirectory )
+
+            numWorkers = min( len(workerInfos), len(remaining_rois) )
+            running = collections.OrderedDict()
+            startTime = time.time()
+            try:
+                for taskInfo in list(workerInfos.values())[:numWorkers]:
+                    running[taskInfo.taskName] = self._launchLocalTask( taskInfo, absWorkDir, env )
+
+                while running:
+                    time.sleep( LOCAL_TASK_POLL_INTERVAL_SECS )
+                    for taskName, process in list(running.items()):
+                        if process.poll() is not None:
+                            if process.returncode != 0:
+                                logger.warning( "Worker {} failed with return code {}".format( taskName, process.returncode ) )
+                            del running[taskName]
+                        elif self._secondsSinceProgress( workerInfos[taskName], startTime ) > staleSecs:
+                            # Its block has been taken over by another worker by now.
+                            logger.warning( "Worker {} made no progress for {} seconds. Killing it.".format( taskName, staleSecs ) )
+                            self._killTask( process )
+                            del running[taskName]
+
+                    remaining_rois = unfinished_rois()
+                    self.progressSignal( 100 * (len(blockRois) - len(remaining_rois)) // len(blockRois) )
+            finally:
+                for process in list(running.values()):
+                    self._killTask( process )
+
+            remaining_rois = unfinished_rois()
+
+        if remaining_rois:
+            logger.error( "{} of {} blocks could not be completed.".format( len(remaining_rois), len(blockRois) ) )
+        return not remaining_rois
+
+    @classmethod
+    def _killTask(cls, process):
+        try:
+            os.killpg( process.pid, signal.SIGKILL )
+        except OSError:
+            # Already finished
+            pass
+        process.wait()
+
+    @classmethod
+    def _secondsSinceProgress(cls, taskInfo, startTime):
+        lastProgressTime = startTime
+        try:
+            lastProgressTime = max( lastProgressTime, os.path.getmtime( taskInfo.progressFilePath ) )
+        except (OSError, TypeError):
+            pass
+        return time.time() - lastProgressTime
+
+    @classmethod
+    def _writeTaskProgress(cls, taskInfo, progress):
+        if taskInfo.progressFilePath is not None:
+            with open( taskInfo.progressFilePath, 'w' ) as f:
+                f.write( str(progress) )
+
+    @classmethod
+    def _readTaskProgress(cls, taskInfo):
+        """
+        Read the progress the task reported via its progress file (see --_progress_file_ in the node arguments).
+        """
+        try:
+            with open( taskInfo.progressFilePath, 'r' ) as f:
+                return min( 100, max( 0, int( f.read() ) ) )
+        except (IOError, OSError, TypeError, ValueError):
+            return 0
+
     def _prepareDestination(self):
         """
         - If the result file doesn't exist yet, create it (and the dataset)
@@ -298,6 +719,7 @@ class OpClusterize(Operator):
             # (Just in case some were left over from a previous run.)
             for roi in list(taskInfos.keys()):
                 blockwiseFileset.setBlockStatus( roi[0], BlockwiseFileset.BLOCK_NOT_AVAILABLE )
+            BlockClaimQueue.clearClaims( blockClaimDirectory( self.OutputDatasetDescription.value ) )
 
         return blockwiseFileset, taskInfos
 
@@ -43,6 +43,19 @@ plugin_directories: ~/.ilastik/plugins,
 threads: -1
 total_ram_mb: 0
 
+[object extraction]
+local_features_chunk_size: 2000
+max_time_slice_mb: 0
+
+[object classification]
+max_cached_time_steps: 0
+
+[edge training]
+edge_feature_memory_mb: 4096
+
+[batch processing]
+batch_lanes: 1
+
 [ipc raw tcp]
 autostart: false
 autoaccept: true
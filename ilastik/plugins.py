@@ -25,9 +25,11 @@ from yapsy.IPlugin import IPlugin
 from yapsy.PluginManager import PluginManager
 
 import os
+import collections
 from collections import namedtuple
 from functools import partial
 import numpy
+import vigra
 
 # these directories are searched for plugins
 plugin_paths = cfg.get('ilastik', 'plugin_directories')
@@ -94,6 +96,38 @@ class ObjectFeaturesPlugin(IPlugin):
         """
         return dict()
 
+    def compute_local_batch(self, images, binary_bboxes, features, axes):
+        """Calculate features on a stack of objects with equally shaped
+        bounding boxes.
+
+        The default implementation falls back to calling compute_local()
+        on every object (if the plugin has one). Plugins that can process
+        the whole stack at once should override this.
+
+        :param images: np.ndarray - stack of expanded bounding boxes,
+            images[i] has the same layout as the image passed to compute_local()
+        :param binary_bboxes: np.ndarray, dtype=bool - stack of binarized
+            label bounding boxes, one per entry in images
+        :param features: which features to compute
+        :param axes: axis tags of a single object, i.e. of images[i]
+
+        :returns: a dictionary with one entry per feature.
+            dict[feature_name] is a sequence with one numpy.ndarray
+            (ndim=1) per object
+
+        """
+        if type(self).compute_local is ObjectFeaturesPlugin.compute_local:
+            # No local features (e.g. the convex hull features), don't visit the objects
+            return dict()
+        axistags = vigra.defaultAxistags(''.join(sorted('xyzc', key=lambda k: getattr(axes, k))))
+        results = collections.defaultdict(lambda: [None] * len(images))
+        for i in range(len(images)):
+            image = vigra.taggedView(images[i], axistags=axistags)
+            feats = self.compute_local(image, binary_bboxes[i], features, axes)
+            for key, value in feats.items():
+                results[key][i] = value
+        return dict(results)
+
     def fill_properties(self, feature_dict):
         """
         For every feature in the feature dictionary, fill in its properties,
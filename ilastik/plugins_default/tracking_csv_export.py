@@ -1,9 +1,143 @@
 from builtins import range
 import os.path
+import collections
 import numpy as np
 from ilastik.plugins import TrackingExportFormatPlugin
 import vigra
 
+trackingHeaders = ['frame', 'labelimageId', 'trackId', 'lineageId', 'parentTrackId', 'mergerLabelId']
+excludedFeatures = ['Histogram']
+
+
+def featureColumns(frameFeatures, getFeatureNameTranslation):
+    """
+    Determine the feature columns of the table from the features of one frame
+
+    :param frameFeatures: dict of structure {category: {featureName: values}}
+    :param getFeatureNameTranslation: function (category, feature) -> long feature name
+    :returns: list of (category, feature, column, header, dtype) tuples,
+        where column is None for 1d features
+    """
+    # the feature categories can contain 'Default features' and 'Standard Object Features',
+    # which actually reference the same features. Hence we block all of the one group from the other to prevent duplicates.
+    categories = list(frameFeatures.keys())
+    blockedFeatures = dict([(c, []) for c in categories])
+    defaultFeatStr = 'Default features'
+    standardObjFeatStr = 'Standard Object Features'
+
+    if defaultFeatStr in categories and standardObjFeatStr in categories:
+        for feature in list(frameFeatures[defaultFeatStr].keys()):
+            blockedFeatures[standardObjFeatStr].append(feature)
+
+    def columnType(featureName):
+        if 'Number_of' in featureName or 'Bounding_Box' in featureName or featureName == 'Size_in_pixels':
+            return np.int64
+        else:
+            return np.float64
+
+    columns = []
+    for category in categories:
+        for feature in sorted(list(frameFeatures[category].keys())):
+            if feature not in excludedFeatures and feature not in blockedFeatures[category]:
+                featureName = getFeatureNameTranslation(category, feature).replace(' ', '_')
+                values = np.asarray(frameFeatures[category][feature])
+                if values.ndim == 2:
+                    for column in range(values.shape[1]):
+                        singleFeatureValueName = '{f}_{c}'.format(f=featureName, c=column)
+                        columns.append((category, feature, column, singleFeatureValueName, columnType(singleFeatureValueName)))
+                elif values.ndim == 1:
+                    columns.append((category, feature, None, featureName, columnType(featureName)))
+                elif values.ndim == 0:
+                    pass # ignoring "global" features
+                else:
+                    raise ValueError(f"Found feature matrix {feature} that has a dimensionality of > 2, cannot handle that yet")
+    return columns
+
+
+def csvFormat(header, columnDtype):
+    """
+    The CSV format of a feature column: object centers are written as integers, too
+    (as they always were), although they are floats in the typed table.
+    """
+    if columnDtype == np.int64 or 'Center_of' in header:
+        return '%d'
+    return '%f'
+
+
+def trackingColumnsPerFrame(graph):
+    """
+    Collect the tracking information of all nodes of the graph, grouped by frame
+
+    :returns: dict frame -> numpy.ndarray of shape (nodes, 5) with the columns
+        labelimageId, trackId, lineageId, parentTrackId, mergerLabelId, sorted by label
+    """
+    rows = collections.defaultdict(list)
+    for node in graph.nodes_iter():
+        frame, label = node
+        attributes = graph.node[node]
+        trackId = attributes['trackId']
+        lineageId = attributes['lineageId']
+
+        if trackId is None:
+            trackId = -1
+        if lineageId is None:
+            lineageId = -1
+
+        # insert parent of a division
+        try:
+            parentTrackId = graph.node[attributes['parent']]['trackId']
+        except KeyError:
+            parentTrackId = 0
+
+        # insert merger
+        mergerValue = attributes.get('mergerValue')
+        if not isinstance(mergerValue, int):
+            mergerValue = 0
+
+        rows[frame].append((label, trackId, lineageId, parentTrackId, mergerValue))
+
+    result = {}
+    for frame, frameRows in rows.items():
+        frameRows = np.array(frameRows, dtype=np.int64)
+        result[frame] = frameRows[np.argsort(frameRows[:, 0], kind='mergesort')]
+    return result
+
+
+def frameTables(graph, features, columns):
+    """
+    Generate the table frame by frame, in the order of the frames
+
+    :param columns: the feature columns as returned by featureColumns()
+    :returns: generator of (frame, table), where table is a structured numpy.ndarray
+        with one row per object and one typed field per column
+    """
+    dtype = [(header, np.int64) for header in trackingHeaders]
+    dtype += [(header, columnDtype) for _, _, _, header, columnDtype in columns]
+    trackingColumns = trackingColumnsPerFrame(graph)
+
+    for frame in sorted(trackingColumns.keys()):
+        tracking = trackingColumns[frame]
+        labels = tracking[:, 0]
+        table = np.zeros((len(labels),), dtype=dtype)
+        table['frame'] = frame
+        for i, header in enumerate(trackingHeaders[1:]):
+            table[header] = tracking[:, i]
+
+        for category, feature, column, header, _ in columns:
+            values = np.asarray(features[frame][category][feature])
+            if column is None:
+                table[header] = values[labels]
+                continue
+
+            # objects (e.g. resolved mergers) might not have all features
+            if 'SquaredDistances' in feature:
+                table[header] = 9999
+            if values.ndim == 2 and column < values.shape[1]:
+                valid = labels < values.shape[0]
+                table[header][valid] = values[labels[valid], column]
+        yield frame, table
+
+
 class TrackingCSVExportFormatPlugin(TrackingExportFormatPlugin):
     """CSV export"""
 
@@ -17,6 +151,8 @@ class TrackingCSVExportFormatPlugin(TrackingExportFormatPlugin):
         """
         Export the features of all objects together with their tracking information into a table
 
+        The table is written frame by frame, so only the rows of a single frame are kept in memory.
+
         :param filename: string of the FILE where to save the resulting CSV file
         :param hypothesesGraph: hytra.core.hypothesesgraph.HypothesesGraph filled with a solution
         :param pluginExportContext: instance of ilastik.plugins.PluginExportContext containing:
@@ -26,108 +162,18 @@ class TrackingCSVExportFormatPlugin(TrackingExportFormatPlugin):
         """
         features = pluginExportContext.objectFeaturesSlot([]).wait()  # this is a dict of structure: {frame: {category: {featureNames}}}
         graph = hypothesesGraph._graph
-        headers = ['frame', 'labelimageId', 'trackId', 'lineageId', 'parentTrackId', 'mergerLabelId']
-        formats = ['%d'] * len(headers)
-        excludedFeatures = ['Histogram']
 
-        def appendFormat(featureName):
-            if 'Number_of' in featureName or 'Center_of' in featureName or 'Bounding_Box' in featureName or featureName == 'Size_in_pixels':
-                formats.append('%d')
-            else:
-                formats.append('%f')
-
-        # check which features are present and construct table of the appropriate size
+        # check which features are present
         frame, _ = next(graph.nodes_iter())
+        columns = featureColumns(features[frame], self._getFeatureNameTranslation)
 
-        # the feature categories can contain 'Default features' and 'Standard Object Features',
-        # which actually reference the same features. Hence we block all of the one group from the other to prevent duplicates.
-        categories = list(features[frame].keys())
-        blockedFeatures = dict([(c, []) for c in categories])
-        defaultFeatStr = 'Default features'
-        standardObjFeatStr = 'Standard Object Features'
-
-        if defaultFeatStr in categories and standardObjFeatStr in categories:
-            for feature in list(features[frame][defaultFeatStr].keys()):
-                blockedFeatures[standardObjFeatStr].append(feature)
-
-        for category in categories:
-            for feature in sorted(list(features[frame][category].keys())):
-                if feature not in excludedFeatures and feature not in blockedFeatures[category]:
-                    featureName = self._getFeatureNameTranslation(category, feature).replace(' ', '_')
-                    ndim = (np.asarray(features[frame][category][feature])).ndim
-                    if ndim == 2:
-                        for column in range(np.asarray(features[frame][category][feature]).shape[1]):
-                            singleFeatureValueName = '{f}_{c}'.format(f=featureName, c=column)
-                            headers.append(singleFeatureValueName)
-                            appendFormat(singleFeatureValueName)
-                    elif ndim == 1:
-                        headers.append(featureName)
-                        appendFormat(featureName)
-                    elif ndim == 0:
-                        pass # ignoring "global" features
-                    else:
-                        raise ValueError(f"Found feature matrix {feature} that has a dimensionality of > 2, cannot handle that yet")
-
-        table = np.zeros([graph.number_of_nodes(), len(headers)])
-
-        for rowIdx, node in enumerate(graph.nodes_iter()):
-            frame, label = node
-            trackId = graph.node[node]['trackId']
-            lineageId = graph.node[node]['lineageId']
-
-            if trackId is None:
-                trackId = -1
-            if lineageId is None:
-                lineageId = -1
-
-            table[rowIdx, 0] = frame
-            table[rowIdx, 1] = label
-            table[rowIdx, 2] = trackId
-            table[rowIdx, 3] = lineageId
-
-            # insert parent of a division
-            try:
-                table[rowIdx, 4] = graph.node[graph.node[node]['parent']]['trackId']
-            except KeyError:
-                table[rowIdx, 4] = 0
-
-            # insert merger
-            try:
-                if isinstance(graph.node[node]['mergerValue'], int):
-                    table[rowIdx, 5] = graph.node[node]['mergerValue']
-                else:
-                    table[rowIdx, 5] = 0
-            except KeyError:
-                table[rowIdx, 5] = 0
-            colIdx = 6
-
-            for category in categories:
-                for feature in sorted(list(features[frame][category].keys())):
-
-                    if feature not in excludedFeatures and feature not in blockedFeatures[category]:
-                        ndim = (np.asarray(features[frame][category][feature])).ndim
-                        if ndim == 2:
-                            for column in range(np.asarray(features[frame][category][feature]).shape[1]):
-                                try:
-                                    table[rowIdx, colIdx] = features[frame][category][feature][label, column]
-                                except IndexError:
-                                    if 'SquaredDistances' in feature:
-                                        table[rowIdx, colIdx] = 9999
-                                    else:
-                                        table[rowIdx, colIdx] = 0
-                                colIdx += 1
-                        elif ndim == 1:
-                            table[rowIdx, colIdx] = features[frame][category][feature][label]
-                            colIdx += 1
-                        elif ndim == 0:
-                            pass # ignoring "global" features
-                        else:
-                            raise ValueError(f"Found feature matrix {feature} that has a dimensionality of > 2, cannot handle that yet")
-
-        # sort table by frame, then labelImage
-        table = table[np.lexsort(table[:, :2].transpose()[::-1])]
-
-        headerLine = ','.join(headers)
-        np.savetxt(filename + '.csv', table, header=headerLine, delimiter=',', comments='', fmt=formats)
+        headers = trackingHeaders + [header for _, _, _, header, _ in columns]
+        formats = ['%d'] * len(trackingHeaders)
+        formats += [csvFormat(header, columnDtype) for _, _, _, header, columnDtype in columns]
+
+        with open(filename + '.csv', 'w') as f:
+            f.write(','.join(headers) + '\n')
+            for _, table in frameTables(graph, features, columns):
+                np.savetxt(f, table, delimiter=',', fmt=formats)
 
         return True
@@ -0,0 +1,55 @@
+import os.path
+from ilastik.plugins import TrackingExportFormatPlugin
+from ilastik.plugins_default import tracking_csv_export
+
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    logger.warning("Could not load pyarrow. Parquet export plugin not loaded.")
+else:
+
+    class TrackingParquetExportFormatPlugin(TrackingExportFormatPlugin):
+        """Parquet export"""
+
+        exportsToFile = True
+
+        def checkFilesExist(self, filename):
+            ''' Check whether the files we want to export are already present '''
+            return os.path.exists(filename + '.parquet')
+
+        def export(self, filename, hypothesesGraph, pluginExportContext):
+            """
+            Export the features of all objects together with their tracking information into a
+            Parquet table with the same columns as the CSV-Table export, one row group per frame
+
+            :param filename: string of the FILE where to save the resulting Parquet file
+            :param hypothesesGraph: hytra.core.hypothesesgraph.HypothesesGraph filled with a solution
+            :param pluginExportContext: instance of ilastik.plugins.PluginExportContext containing:
+                objectFeaturesSlot (required here) as well as labelImageSlot, rawImageSlot, additionalPluginArgumentsSlot
+
+            :returns: True on success, False otherwise
+            """
+            features = pluginExportContext.objectFeaturesSlot([]).wait()  # this is a dict of structure: {frame: {category: {featureNames}}}
+            graph = hypothesesGraph._graph
+
+            # check which features are present
+            frame, _ = next(graph.nodes_iter())
+            columns = tracking_csv_export.featureColumns(features[frame], self._getFeatureNameTranslation)
+
+            fields = [(header, pyarrow.int64()) for header in tracking_csv_export.trackingHeaders]
+            fields += [(header, pyarrow.from_numpy_dtype(columnDtype)) for _, _, _, header, columnDtype in columns]
+            schema = pyarrow.schema(fields)
+
+            writer = pyarrow.parquet.ParquetWriter(filename + '.parquet', schema)
+            try:
+                for _, table in tracking_csv_export.frameTables(graph, features, columns):
+                    arrays = [pyarrow.array(table[name]) for name in schema.names]
+                    writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+            finally:
+                writer.close()
+
+            return True
@@ -23,6 +23,7 @@ import ilastik.applets.objectExtraction.opObjectExtraction
 #from ilastik.applets.objectExtraction.opObjectExtraction import make_bboxes, max_margin
 import vigra
 import numpy as np
+import collections
 from lazyflow.request import Request, RequestPool
 
 def cleanup_key(k):
@@ -241,3 +242,45 @@ class VigraObjFeats(ObjectFeaturesPlugin):
             result = self._do_4d(image, label, featurenames, axes)
             results.append(self.update_keys(result, suffix=suffix))
         return self.combine_dicts(results)
+
+    def compute_local_batch(self, images, binary_bboxes, feature_dict, axes):
+        """Like compute_local, for a stack of equally shaped objects.
+
+        The objects are tiled along the x axis into one image, in which
+        object i has the label i+1, so the features of all objects are
+        computed by a single vigra call per label image.
+
+        """
+        featurenames = list(feature_dict.keys())
+        local = [x+self.local_suffix for x in self.local_features]
+        featurenames = list(set(featurenames) & set(local))
+        featurenames = [x.split(' ')[0] for x in featurenames]
+        if "Histogram" in featurenames:
+            # The histogram range is taken from the whole image,
+            # so the tiled image would give different histograms.
+            return super(VigraObjFeats, self).compute_local_batch(images, binary_bboxes, feature_dict, axes)
+
+        nobj = len(images)
+        axistags = vigra.defaultAxistags(''.join(sorted('xyzc', key=lambda k: getattr(axes, k))))
+        # The labels have no channel axis
+        label_x = axes.x - int(axes.c < axes.x)
+        tiled_image = vigra.taggedView(np.concatenate(list(images), axis=axes.x), axistags=axistags)
+
+        margin = ilastik.applets.objectExtraction.opObjectExtraction.max_margin({'': feature_dict})
+        tiled_labels = [[], []]
+        for i in range(nobj):
+            passed, excl = ilastik.applets.objectExtraction.opObjectExtraction.make_bboxes(binary_bboxes[i], margin)
+            for tiles, label in zip(tiled_labels, [excl, passed]):
+                tiles.append(np.asarray(label, dtype=np.uint32) * (i+1))
+
+        results = collections.defaultdict(lambda: [None] * nobj)
+        for tiles, suffix in zip(tiled_labels, self.local_out_suffixes):
+            result = self._do_4d(tiled_image, np.concatenate(tiles, axis=label_x), featurenames, axes)
+            for key, value in self.update_keys(result, suffix=suffix).items():
+                # Objects at the end without any pixels in this label image get no row from vigra
+                if value.shape[0] < nobj:
+                    padding = np.zeros((nobj - value.shape[0],) + value.shape[1:], dtype=value.dtype)
+                    value = np.concatenate([value, padding])
+                for i in range(nobj):
+                    results[key][i] = value[i:i+1]
+        return dict(results)
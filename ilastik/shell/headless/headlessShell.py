@@ -32,8 +32,9 @@ class HeadlessShell(object):
     For now, this class is just a stand-in for the GUI shell (used when running from the command line).
     """
 
-    def __init__(self, workflow_cmdline_args=None):
+    def __init__(self, workflow_cmdline_args=None, lazy_project_load=False):
         self._workflow_cmdline_args = workflow_cmdline_args or []
+        self._lazy_project_load = lazy_project_load
         self.projectManager = None
 
     @property
@@ -113,7 +114,8 @@ class HeadlessShell(object):
                                                   workflow_class,
                                                   headless=True,
                                                   workflow_cmdline_args=self._workflow_cmdline_args,
-                                                  project_creation_args=project_creation_args )
+                                                  project_creation_args=project_creation_args,
+                                                  lazy_load=self._lazy_project_load )
             self.projectManager._loadProject(hdf5File, projectFilePath, readOnly)
 
         except ProjectManager.FileMissingError:
@@ -199,7 +199,7 @@ class ProjectManager(object):
     ## Public methods
     #########################    
 
-    def __init__(self, shell, workflowClass, headless=False, workflow_cmdline_args=None, project_creation_args=None):
+    def __init__(self, shell, workflowClass, headless=False, workflow_cmdline_args=None, project_creation_args=None, lazy_load=False):
         """
         Constructor.
         
@@ -207,6 +207,8 @@ class ProjectManager(object):
         :param headless: A bool that is passed to the workflow constructor, 
                          indicating whether or not the workflow should be opened in 'headless' mode.
         :param workflow_cmdline_args: A list of strings from the command-line to configure the workflow.
+        :param lazy_load: If True, large items of the project (e.g. label blocks) are only read from
+                          the project file once they are first used.
         """
         # Init
         self.closed = True
@@ -221,6 +223,7 @@ class ProjectManager(object):
         self._workflow_cmdline_args = workflow_cmdline_args or []
         self._project_creation_args = project_creation_args or []
         self._headless = headless
+        self._lazyLoad = lazy_load
         
         #the workflow class has to be specified at this point
         assert workflowClass is not None
@@ -429,9 +432,11 @@ class ProjectManager(object):
                     for serializer in aplt.dataSerializers:
                         assert serializer.base_initialized, "AppletSerializer subclasses must call AppletSerializer.__init__ upon construction."
                         serializer.ignoreDirty = True
+                        serializer.lazyLoad = self._lazyLoad
 
                         serializer.deserializeFromHdf5(self.currentProjectFile, projectFilePath, self._headless)
 
+                        serializer.lazyLoad = False
                         serializer.ignoreDirty = False
                 logger.debug('Deserializing applet "{}" took {} seconds'.format( aplt.name, timer.seconds() ))
             
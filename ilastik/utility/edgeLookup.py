@@ -0,0 +1,159 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2017, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+from builtins import zip
+import numpy as np
+
+
+def edge_keys(edge_ids):
+    """
+    Combine the id pairs of edges (shape=(N, 2), superpixel ids < 2**32)
+    into single uint64 keys. The order of the two ids does not matter.
+    """
+    edge_ids = np.asarray(edge_ids, dtype=np.uint64).reshape(-1, 2)
+    lower = edge_ids.min(axis=1)
+    upper = edge_ids.max(axis=1)
+    return (lower << np.uint64(32)) | upper
+
+
+class EdgeLookup(object):
+    """
+    A compact, read-only mapping of edge id pairs to values, stored as
+    sorted uint64 keys and a value array.
+
+    Supports vectorized queries (lookup()) as well as the read-only part
+    of the dict interface, with (sp1, sp2) tuples as keys.
+    """
+    def __init__(self, edge_ids, values):
+        """
+        :param edge_ids: array of id pairs, shape=(N, 2)
+        :param values: array of values, same order as edge_ids
+        """
+        edge_ids = np.asarray(edge_ids).reshape(-1, 2)
+        values = np.asarray(values)
+        assert len(values) == len(edge_ids)
+
+        keys = edge_keys(edge_ids)
+        if len(keys) > 1 and not (keys[1:] > keys[:-1]).all():
+            order = np.argsort(keys, kind='mergesort')
+            keys, edge_ids, values = keys[order], edge_ids[order], values[order]
+        self._keys = keys
+        self.edge_ids = edge_ids
+        self.values = values
+
+    def _find(self, edge_ids):
+        keys = edge_keys(edge_ids)
+        positions = np.searchsorted(self._keys, keys)
+        positions = np.minimum(positions, max(len(self._keys) - 1, 0))
+        if len(self._keys) == 0:
+            return positions, np.zeros(keys.shape, dtype=bool)
+        return positions, self._keys[positions] == keys
+
+    def lookup(self, edge_ids, default=0):
+        """
+        Values of many edges at once.
+
+        :param edge_ids: array of id pairs, shape=(M, 2)
+        :param default: value of edges that are not in the lookup
+        :returns: array of values, shape=(M,)
+        """
+        positions, found = self._find(edge_ids)
+        if len(self._keys) == 0:
+            return np.full(found.shape, default)
+        result = self.values[positions]
+        if not found.all():
+            result = np.where(found, result, default)
+        return result
+
+    def contains(self, edge_ids):
+        """
+        :returns: bool array, True for the edges that are in the lookup
+        """
+        return self._find(edge_ids)[1]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __getitem__(self, id_pair):
+        positions, found = self._find([id_pair])
+        if not found[0]:
+            raise KeyError(id_pair)
+        return self.values[positions[0]]
+
+    def get(self, id_pair, default=None):
+        try:
+            return self[id_pair]
+        except KeyError:
+            return default
+
+    def __contains__(self, id_pair):
+        return bool(self.contains([id_pair])[0])
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [tuple(id_pair) for id_pair in self.edge_ids.tolist()]
+
+    def items(self):
+        return list(zip(self.keys(), self.values.tolist()))
+
+
+class EdgePenChanges(object):
+    """
+    Remembers which pens were last handed to an edge layer, so that an update
+    only needs to pass on the edges whose pen changed.
+    """
+    def __init__(self, pen_table):
+        """
+        :param pen_table: list of pens, indexed by the pen indices passed to changed_pens()
+        """
+        self.pen_table = pen_table
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the last update (e.g. for a new layer), so the next one sets all pens.
+        """
+        self._edge_ids = None
+        self._pen_indices = None
+
+    def changed_pens(self, edge_ids, pen_indices):
+        """
+        :param edge_ids: array of id pairs, shape=(N, 2)
+        :param pen_indices: array of indices into the pen table, same order as edge_ids
+        :returns: (new_pens, overwrite), where new_pens is a dict of id_pair -> pen
+            of the edges whose pen changed since the last update, and overwrite is True
+            if the edges differ from the last update, so new_pens replaces all pens
+        """
+        pen_indices = np.asarray(pen_indices)
+        if self._edge_ids is edge_ids or np.array_equal(self._edge_ids, edge_ids):
+            changed = np.flatnonzero(pen_indices != self._pen_indices)
+            overwrite = False
+        else:
+            changed = np.arange(len(pen_indices))
+            overwrite = True
+        self._edge_ids = edge_ids
+        self._pen_indices = pen_indices
+
+        pen_table = self.pen_table
+        new_pens = dict(zip(map(tuple, np.asarray(edge_ids)[changed].tolist()),
+                            [pen_table[i] for i in pen_indices[changed].tolist()]))
+        return new_pens, overwrite
@@ -266,6 +266,46 @@ def actual_axistags(axistags, shape):
     return AxisTags([axistags[j] for j, s in enumerate(shape) if s > 1])
 
 
+# number of table rows that are formatted / written at once
+table_chunk_rows = 2**16
+
+
+def table_chunks(table, chunk_rows=None):
+    """
+    Iterate over consecutive row blocks (views) of the table
+    """
+    chunk_rows = chunk_rows or table_chunk_rows
+    for start in range(0, table.shape[0], chunk_rows):
+        yield table[start:start + chunk_rows]
+
+
+def table_rows(table):
+    """
+    The number of rows a table contributes to the export progress (images count as one row)
+    """
+    if table.dtype.names is None:
+        return 1
+    return table.shape[0]
+
+
+def csv_column(column):
+    """
+    Format a column of a structured array as strings, like str() would format its items
+    """
+    if column.dtype.kind in "biuf" or column.dtype.type == np.str_:
+        return column.astype(str)
+    return np.array([str(item) for item in column], dtype=object)
+
+
+def hdf5_column(column):
+    """
+    Convert a column for the hdf5 export: hdf5 does not support unicode strings
+    """
+    if column.dtype.type == np.str_:
+        return np.core.defchararray.encode(column, 'utf-8')
+    return column
+
+
 class Mode(object):
     IlastikTrackingTable = 1
     IlastikFeatureTable = 2
@@ -393,13 +433,20 @@ class ExportFile(object):
         """
         count = 0
         self.ExportProgress(0)
+
+        total_rows = max(sum(table_rows(table) for table in self.table_dict.values()), 1)
+        written = [0]
+
+        def progress(rows):
+            written[0] += rows
+            self.ExportProgress(written[0] * 100 / total_rows)
+
         if mode in ("h5", "hd5", "hdf5"):
             with h5py.File(self.file_name, "w") as fout:
                 for table_name, table in self.table_dict.items():
                     self._make_h5_dataset(fout, table_name, table, self.meta_dict.get(table_name, {}),
-                                          compression if compression is not None else {})
+                                          compression if compression is not None else {}, progress)
                     count += 1
-                    self.ExportProgress(count * 100 / len(self.table_dict))
         elif mode == "csv":
             f_name = self.file_name.rsplit(".", 1)
             if len(f_name) == 1:
@@ -410,9 +457,8 @@ class ExportFile(object):
             for table_name, table in self.table_dict.items():
                 file_names.append("{name}_{table}.{ext}".format(name=base, table=table_name, ext=ext))
                 with open(file_names[-1], "w") as fout:
-                    self._make_csv_table(fout, table)
+                    self._make_csv_table(fout, table, progress)
                     count += 1
-                    self.ExportProgress(count * 100 / len(self.table_dict))
             if False:
                 with ZipFile("{name}.zip".format(name=base), "w") as zip_file:
                     for file_name in file_names:
@@ -428,16 +474,57 @@ class ExportFile(object):
         self.table_dict[table_name] = columns
 
     @staticmethod
-    def _make_h5_dataset(fout, table_name, table, meta, compression):
+    def _make_h5_dataset(fout, table_name, table, meta, compression, progress=None):
+        """
+        Write the table to a dataset. Tables (structured arrays) are written in
+        chunks of rows, converting only the current chunk for hdf5 export.
+        """
+        if progress is None:
+            progress = lambda rows: None
+
+        if table.dtype.names is None or table.shape[0] == 0:
+            sanitized_table = ExportFile._sanitize_table_for_hdf5_export(table)
+            try:
+                dset = fout.create_dataset(table_name, sanitized_table.shape, data=sanitized_table, **compression)
+            except TypeError:
+                dset = fout.create_dataset(table_name, sanitized_table.shape, data=sanitized_table)
+            progress(table_rows(table))
+        else:
+            dtype = ExportFile._hdf5_dtype(table)
+            chunks = (min(table.shape[0], table_chunk_rows),)
+            try:
+                dset = fout.create_dataset(table_name, table.shape, dtype=dtype, chunks=chunks, **compression)
+            except TypeError:
+                dset = fout.create_dataset(table_name, table.shape, dtype=dtype, chunks=chunks)
+
+            start = 0
+            for chunk in table_chunks(table):
+                converted = np.empty(chunk.shape, dtype=dtype)
+                for name in table.dtype.names:
+                    converted[name] = hdf5_column(chunk[name])
+                dset[start:start + chunk.shape[0]] = converted
+                start += chunk.shape[0]
+                progress(chunk.shape[0])
 
-        sanitized_table = ExportFile._sanitize_table_for_hdf5_export(table)
-        try:
-            dset = fout.create_dataset(table_name, sanitized_table.shape, data=sanitized_table, **compression)
-        except TypeError:
-            dset = fout.create_dataset(table_name, sanitized_table.shape, data=sanitized_table)
         for k, v in meta.items():
             dset.attrs[k] = v
 
+    @staticmethod
+    def _hdf5_dtype(table):
+        """
+        The dtype of the table with unicode string columns replaced by utf-8 encoded byte strings,
+        which are wide enough for the longest encoded string in the column
+        """
+        names = table.dtype.names
+        dtypes = []
+        for name in names:
+            column_dtype = table.dtype.fields[name][0]
+            if column_dtype.type == np.str_:
+                width = max([hdf5_column(chunk[name]).dtype.itemsize for chunk in table_chunks(table)] or [1])
+                column_dtype = np.dtype((np.bytes_, width))
+            dtypes.append((name, column_dtype))
+        return dtypes
+
     @staticmethod
     def _sanitize_table_for_hdf5_export(table):
         # sanitize the dtypes, this makes a temporary copy of the table :/
@@ -448,25 +535,25 @@ class ExportFile(object):
         hasstrings = [name for name in names if table[name].dtype.type == np.str_]
         if not hasstrings:
             return table
-        table_copy = {name: table[name] for name in names}
-        dtypes = {name: table_copy[name].dtype for name in names}
-        for string_column in hasstrings:
-            column = np.core.defchararray.encode(table[string_column], 'utf-8')
-            dtypes[string_column] = column.dtype
-            table_copy[string_column] = column
-
-        return np.array(list(zip(*[table_copy[name] for name in names])), dtype=[(name, dtypes[name]) for name in names])
-
+        sanitized_table = np.empty(table.shape, dtype=ExportFile._hdf5_dtype(table))
+        for name in names:
+            sanitized_table[name] = hdf5_column(table[name])
+        return sanitized_table
 
     @staticmethod
-    def _make_csv_table(fout, table):
+    def _make_csv_table(fout, table, progress=None):
+        """
+        Write the table as csv, formatting whole columns of one chunk of rows at a time
+        """
         line = ",".join(table.dtype.names)
         fout.write(line)
         fout.write("\n")
-        for row in table:
-            line = ",".join(map(str, row))
-            fout.write(line)
+        for chunk in table_chunks(table):
+            columns = [csv_column(chunk[name]).tolist() for name in table.dtype.names]
+            fout.write("\n".join([",".join(row) for row in zip(*columns)]))
             fout.write("\n")
+            if progress is not None:
+                progress(chunk.shape[0])
 
 
 class ProgressPrinter(object):
@@ -5,6 +5,7 @@ import json
 import logging
 import argparse
 import collections
+from math import sqrt, ceil
 from itertools import starmap
 from functools import partial, wraps
 
@@ -23,6 +24,8 @@ def main():
     parser.add_argument('filter_specs', help='json file containing filter list')
     parser.add_argument('output_path', help='example: my-predictions.h5/volume')
     parser.add_argument('--compute-blockwise', help='Compute blockwise instead of as a whole', action='store_true')
+    parser.add_argument('--block-shape', help='Block shape for --compute-blockwise (default: input shape / 4)', nargs='+', type=int)
+    parser.add_argument('--presmooth', help='Share a pre-smoothing pass between all filters of the same scale', action='store_true')
     parser.add_argument('--thread-count', help='The threadpool size', default=0, type=int)
     args = parser.parse_args()
 
@@ -32,10 +35,19 @@ def main():
 
     Request.reset_thread_pool(args.thread_count)
     
-    load_and_predict( args.grayscale, args.classifier, args.filter_specs, args.output_path, args.compute_blockwise )
+    load_and_predict( args.grayscale, args.classifier, args.filter_specs, args.output_path, args.compute_blockwise,
+                      args.block_shape, args.presmooth )
     logger.info("DONE.")
 
-def load_and_predict( input_data_or_path, classifier_filepath, feature_list_json_path, output_path=None, compute_blockwise=False ):
+def load_and_predict( input_data_or_path, classifier_filepath, feature_list_json_path, output_path=None, compute_blockwise=False,
+                      block_shape=None, presmooth=False ):
+    """
+    Load the data, classifier and filter specs, and predict.
+    
+    If computing blockwise with an output_path, the blocks are written to the output as soon as
+    they are ready, and None is returned (the predictions are not kept in memory).
+    Otherwise, the predictions are returned (and saved, if an output_path is given).
+    """
     assert output_path is None or isinstance( output_path, basestring )
 
     # Load
@@ -44,10 +56,16 @@ def load_and_predict( input_data_or_path, classifier_filepath, feature_list_json
     rf = load_classifier( classifier_filepath )
 
     # Predict
+    if compute_blockwise and output_path:
+        output_shape = input_data.dropChannelAxis().shape + (rf.labelCount(),)
+        block_predictions = iter_blockwise_predictions( input_data, rf, filter_specs, block_shape, presmooth )
+        save_predictions( block_predictions, output_path, shape=output_shape )
+        return None
+
     if compute_blockwise:
-        predictions = blockwise_predict( input_data, rf, filter_specs )
+        predictions = blockwise_predict( input_data, rf, filter_specs, block_shape, presmooth )
     else:
-        predictions = simple_predict( input_data, rf, filter_specs )
+        predictions = simple_predict( input_data, rf, filter_specs, presmooth )
     
     # Save
     if output_path:
@@ -55,7 +73,7 @@ def load_and_predict( input_data_or_path, classifier_filepath, feature_list_json
 
     return predictions
 
-def simple_predict( input_grayscale, random_forest, filter_spec_list ):
+def simple_predict( input_grayscale, random_forest, filter_spec_list, presmooth=False ):
     assert isinstance(random_forest, vigra.learning.RandomForest)
     assert isinstance( input_grayscale, vigra.VigraArray )
     input_grayscale = input_grayscale.dropChannelAxis()
@@ -70,14 +88,39 @@ def simple_predict( input_grayscale, random_forest, filter_spec_list ):
     logger.info( "Computing {} filters ({} channels)" .format( len(filter_spec_list), num_channels ) )
 
     # Compute features
-    feature_volume = compute_features( input_grayscale, filter_spec_list )
+    feature_volume = compute_features( input_grayscale, filter_spec_list, presmooth=presmooth )
 
     # Predict
     logger.info("Predicting...")
     prediction_volume = predict_from_features( feature_volume, random_forest )
     return prediction_volume
 
-def blockwise_predict( input_grayscale, random_forest, filter_spec_list, block_shape=None ):
+def blockwise_predict( input_grayscale, random_forest, filter_spec_list, block_shape=None, presmooth=False ):
+    """
+    Compute the predictions block by block (in parallel), and return them as a single volume.
+    See iter_blockwise_predictions() for details.
+    """
+    input_grayscale = input_grayscale.dropChannelAxis()
+    num_classes = random_forest.labelCount()
+    prediction_volume = np.ndarray( shape=input_grayscale.shape + (num_classes,), dtype=np.float32)
+
+    for block_roi, block_predictions in iter_blockwise_predictions( input_grayscale, random_forest, filter_spec_list,
+                                                                    block_shape, presmooth ):
+        prediction_volume[bb_to_slicing(*block_roi)] = block_predictions
+    
+    return prediction_volume
+
+def iter_blockwise_predictions( input_grayscale, random_forest, filter_spec_list, block_shape=None, presmooth=False,
+                                max_pending_blocks=None ):
+    """
+    Compute the predictions block by block, in parallel.
+    Each block's features are computed from the block plus a halo that is wide enough for the largest filter,
+    so the results are the same as if the whole volume was processed at once.
+
+    Yields (block_roi, block_predictions) in block order.
+    At most max_pending_blocks blocks are in flight (computing or waiting to be consumed) at any time.
+    By default, that's twice the number of worker threads.
+    """
     assert isinstance(random_forest, vigra.learning.RandomForest)
     assert isinstance( input_grayscale, vigra.VigraArray )
     input_grayscale = input_grayscale.dropChannelAxis()
@@ -93,34 +136,56 @@ def blockwise_predict( input_grayscale, random_forest, filter_spec_list, block_s
     
     if block_shape is None:
         # Arbitrary: Choose input_shape / 4
-        block_shape = np.array(input_grayscale.shape) // 4
+        block_shape = np.maximum( np.array(input_grayscale.shape) // 4, 1 )
     else:
         block_shape = np.array( block_shape )
 
-    num_classes = random_forest.labelCount()
-    prediction_volume = np.ndarray( shape=input_grayscale.shape + (num_classes,), dtype=np.float32)
+    halo = feature_halo( filter_spec_list, presmooth )
+    logger.info( "Using blocks of shape {} with a halo of {} pixels".format( tuple(block_shape), halo ) )
+
+    if max_pending_blocks is None:
+        max_pending_blocks = 2 * max(1, Request.global_thread_pool.num_workers)
 
     # How many blocks in each dimension?
     # This is the input shape, measured in units of blocks (rounded up)
     nd_block_counts = (input_grayscale.shape + np.array(block_shape)-1) // block_shape
 
-    # Iterate over blocks
-    for i, block_ndindex in enumerate( np.ndindex( *nd_block_counts ) ):
-        block_ndindex = np.array(block_ndindex)
-        block_roi = np.array([ block_shape*block_ndindex,
-                               block_shape*(block_ndindex+1) ])
-
-        # Clip to image boundaries
-        block_roi[0] = np.maximum( block_roi[0], (0,)*input_grayscale.ndim )
-        block_roi[1] = np.minimum( block_roi[1], input_grayscale.shape )
-
-        logger.info("Computing Features for block {}: {}".format( i, block_roi.tolist() ))
-        block_feature_volume = compute_features(input_grayscale, filter_spec_list, roi=block_roi)
-
-        logger.info("Computing Predictions for block {}: {}".format( i, block_roi.tolist() ))
-        prediction_volume[bb_to_slicing(*block_roi)] = predict_from_features( block_feature_volume, random_forest )
-    
-    return prediction_volume
+    def block_rois():
+        for block_ndindex in np.ndindex( *nd_block_counts ):
+            block_ndindex = np.array(block_ndindex)
+            block_roi = np.array([ block_shape*block_ndindex,
+                                   block_shape*(block_ndindex+1) ])
+
+            # Clip to image boundaries
+            block_roi[0] = np.maximum( block_roi[0], (0,)*input_grayscale.ndim )
+            block_roi[1] = np.minimum( block_roi[1], input_grayscale.shape )
+            yield block_roi
+
+    # Submit the blocks in order, but keep no more than max_pending_blocks around.
+    pending = collections.deque()
+    for i, block_roi in enumerate( block_rois() ):
+        req = Request( partial( predict_block, input_grayscale, random_forest, filter_spec_list, block_roi, halo, presmooth ) )
+        pending.append( (i, block_roi, req.submit()) )
+        if len(pending) >= max_pending_blocks:
+            i, block_roi, req = pending.popleft()
+            logger.info("Finished block {}: {}".format( i, block_roi.tolist() ))
+            yield block_roi, req.wait()
+
+    while pending:
+        i, block_roi, req = pending.popleft()
+        logger.info("Finished block {}: {}".format( i, block_roi.tolist() ))
+        yield block_roi, req.wait()
+
+def predict_block( input_grayscale, random_forest, filter_spec_list, block_roi, halo, presmooth=False ):
+    """
+    Compute the features and predictions for a single block.
+    Only the block and its halo are read from the input.
+    """
+    halo_roi = np.array([ np.maximum( block_roi[0] - halo, 0 ),
+                          np.minimum( block_roi[1] + halo, input_grayscale.shape ) ])
+    block_input = input_grayscale[bb_to_slicing(*halo_roi)]
+    block_feature_volume = compute_features( block_input, filter_spec_list, roi=block_roi - halo_roi[0], presmooth=presmooth )
+    return predict_from_features( block_feature_volume, random_forest )
 
 def bb_to_slicing(start, stop):
     """
@@ -147,9 +212,13 @@ def define_filter(is_vector_valued=False):
 
         Lastly, attach an attribute to the function object 'is_vector_valued',
         for clients to read if they want.
+
+        If the input_data has already been smoothed (see presmoothing_sigmas()),
+        pass the sigma of that smoothing as presmoothed_sigma. The filter then only
+        applies the remaining smoothing.
         """
         @wraps(filter_func)
-        def wrapper(input_data, scale, out, roi):
+        def wrapper(input_data, scale, out, roi, presmoothed_sigma=0.0):
             # Check input data format
             assert input_data.dtype == np.float32
             assert hasattr(input_data, 'axistags'), "Input must have axistags"
@@ -187,7 +256,7 @@ def define_filter(is_vector_valued=False):
                 assert out.shape == tuple(roi[1] - roi[0])
             
             # Call the filter
-            ret = filter_func( input_data, scale, out, roi )
+            ret = filter_func( input_data, scale, out, roi, presmoothed_sigma )
             assert ret is None, "Filter should work in-place, not return a value"
     
         wrapper.__wrapped__ = filter_func # Emulate python 3 behavior of @functools.wraps
@@ -195,22 +264,35 @@ def define_filter(is_vector_valued=False):
         return wrapper
     return decorator
 
+def residual_sigma(sigma, presmoothed_sigma):
+    """
+    The sigma of the smoothing that is still needed for a total smoothing of sigma,
+    if the data has already been smoothed with presmoothed_sigma.
+    (Gaussian smoothing composes: the variances add up.)
+    """
+    assert presmoothed_sigma < sigma, \
+        "Can't apply sigma {} to data that was already smoothed with sigma {}".format( sigma, presmoothed_sigma )
+    return sqrt(sigma**2 - presmoothed_sigma**2)
+
 @define_filter()
-def gaussian_smoothing(input_data, scale, out, roi):
-    vigra.filters.gaussianSmoothing(input_data, sigma=scale, out=out, window_size=WINDOW_SIZE, roi=roi)
+def gaussian_smoothing(input_data, scale, out, roi, presmoothed_sigma=0.0):
+    sigma = residual_sigma(scale, presmoothed_sigma)
+    vigra.filters.gaussianSmoothing(input_data, sigma=sigma, out=out, window_size=WINDOW_SIZE, roi=roi)
 
 @define_filter()
-def laplacian_of_gaussian(input_data, scale, out, roi):
+def laplacian_of_gaussian(input_data, scale, out, roi, presmoothed_sigma=0.0):
+    scale = residual_sigma(scale, presmoothed_sigma)
     vigra.filters.laplacianOfGaussian(input_data, scale=scale, out=out, window_size=WINDOW_SIZE, roi=roi)
 
 @define_filter()
-def gaussian_gradient_magnitude(input_data, scale, out, roi):
-    vigra.filters.gaussianGradientMagnitude(input_data, sigma=scale, out=out, window_size=WINDOW_SIZE, roi=roi)
+def gaussian_gradient_magnitude(input_data, scale, out, roi, presmoothed_sigma=0.0):
+    sigma = residual_sigma(scale, presmoothed_sigma)
+    vigra.filters.gaussianGradientMagnitude(input_data, sigma=sigma, out=out, window_size=WINDOW_SIZE, roi=roi)
 
 @define_filter()
-def difference_of_gaussians(input_data, scale, out, roi):
-    sigma_1 = scale
-    sigma_2 = 0.66*scale
+def difference_of_gaussians(input_data, scale, out, roi, presmoothed_sigma=0.0):
+    sigma_1 = residual_sigma(scale, presmoothed_sigma)
+    sigma_2 = residual_sigma(DOG_SIGMA_RATIO*scale, presmoothed_sigma)
 
     # Save RAM: Use the 'out' array as a temporary variable for smoothed_1.
     smoothed_1 = out
@@ -223,8 +305,9 @@ def difference_of_gaussians(input_data, scale, out, roi):
     np.subtract( smoothed_1, smoothed_2, out=out )
 
 @define_filter(is_vector_valued=True)
-def structure_tensor_eigenvalues(input_data, scale, out, roi):
-    inner_scale = scale
+def structure_tensor_eigenvalues(input_data, scale, out, roi, presmoothed_sigma=0.0):
+    # The outer smoothing is applied to the tensor, not the data: it can't make use of the presmoothing.
+    inner_scale = residual_sigma(scale, presmoothed_sigma)
     outer_scale = old_div(scale, 2.0)
 
     # FIXME: vigra seems to have a problem with non-contiguous arrays (in the channel dimension)
@@ -234,7 +317,8 @@ def structure_tensor_eigenvalues(input_data, scale, out, roi):
     out[:] = tempout
 
 @define_filter(is_vector_valued=True)
-def hessian_of_gaussian_eigenvalues(input_data, scale, out, roi):
+def hessian_of_gaussian_eigenvalues(input_data, scale, out, roi, presmoothed_sigma=0.0):
+    scale = residual_sigma(scale, presmoothed_sigma)
     # FIXME: vigra seems to have a problem with non-contiguous arrays (in the channel dimension)
     #        For now, we must provide a our own output array, which is always contiguous.
     tempout = np.empty_like( out )
@@ -251,9 +335,55 @@ FilterFunctions = { 'GaussianSmoothing'            : gaussian_smoothing,
 
 FilterSpec = collections.namedtuple( 'FilterSpec', 'name scale' )
 
+# The smaller sigma of DifferenceOfGaussians, relative to its scale
+DOG_SIGMA_RATIO = 0.66
 
+# With pre-smoothing, every filter still applies at least this much smoothing itself.
+MIN_RESIDUAL_SIGMA = 1.0
+
+# Radius of vigra's (derivative of) gaussian kernels, in units of sigma (rounded up).
+# Used to determine the halo of a block.
+KERNEL_RADIUS_SIGMAS = 4.0
+
+def presmoothing_sigmas( filter_spec_list ):
+    """
+    For each scale in the filter list, the sigma of a pre-smoothing step that
+    can be shared by all filters of that scale (0.0 if that's not worth it).
+    The smallest gaussian of that scale is left with MIN_RESIDUAL_SIGMA.
 
-def compute_features( input_grayscale, filter_spec_list, out=None, roi=None ):
+    Returns a dict: scale -> presmoothing sigma
+    """
+    smallest_sigmas = {}
+    for filter_name, scale in filter_spec_list:
+        sigma = DOG_SIGMA_RATIO*scale if filter_name == 'DifferenceOfGaussians' else scale
+        smallest_sigmas[scale] = min( sigma, smallest_sigmas.get(scale, sigma) )
+
+    presmoothing = {}
+    for scale, sigma in smallest_sigmas.items():
+        if sigma > MIN_RESIDUAL_SIGMA:
+            presmoothing[scale] = sqrt(sigma**2 - MIN_RESIDUAL_SIGMA**2)
+        else:
+            presmoothing[scale] = 0.0
+    return presmoothing
+
+def feature_halo( filter_spec_list, presmooth=False ):
+    """
+    The width of the halo (in pixels) that a block needs,
+    so that its features are the same as when computed on the whole volume.
+    """
+    presmoothing = presmoothing_sigmas( filter_spec_list ) if presmooth else {}
+    halo = 0.0
+    for filter_name, scale in filter_spec_list:
+        presmoothed_sigma = presmoothing.get(scale, 0.0)
+        sigma = presmoothed_sigma + residual_sigma(scale, presmoothed_sigma)
+        if filter_name == 'StructureTensorEigenvalues':
+            sigma += old_div(scale, 2.0) # outer scale
+        halo = max( halo, KERNEL_RADIUS_SIGMAS*sigma )
+    return int(ceil(halo))
+
+
+
+def compute_features( input_grayscale, filter_spec_list, out=None, roi=None, presmooth=False ):
     """
     Given a grayscale volume and a list of FilterSpecs, compute the filters and store them to a single multi-channel array.
     
@@ -270,6 +400,11 @@ def compute_features( input_grayscale, filter_spec_list, out=None, roi=None ):
         Optional (start, stop) tuple indicating which region to process,
         where len(roi[0]) == input_grayscale.ndim
         By default, the whole input volume is processed.
+
+    presmooth:
+        If True, the input is smoothed once per scale, and all filters of that scale
+        are computed from the smoothed input (see presmoothing_sigmas()).
+        The results only differ from the direct computation by discretization effects.
     """
     # Convert args as needed
     assert isinstance( input_grayscale, vigra.VigraArray )
@@ -297,12 +432,25 @@ def compute_features( input_grayscale, filter_spec_list, out=None, roi=None ):
             "output array has the wrong shape. Expected {}, got {}" \
             .format( output_shape, out.shape )
 
+    # Pre-smooth the input, once per scale (in parallel).
+    presmoothing = presmoothing_sigmas( filter_spec_list ) if presmooth else {}
+    presmoothed_inputs = {}
+    def presmooth_input( scale, sigma ):
+        presmoothed = vigra.filters.gaussianSmoothing(input_grayscale, sigma=sigma, window_size=WINDOW_SIZE)
+        presmoothed_inputs[scale] = vigra.taggedView( presmoothed, input_grayscale.axistags )
+
+    execute_tasks( [ partial( presmooth_input, scale, sigma )
+                     for scale, sigma in presmoothing.items() if sigma > 0.0 ] )
+
     # Prepare a list of tasks to execute.
     tasks = []
     for (filter_name, scale), (start_channel, stop_channel) in zip(filter_spec_list, filter_channel_ranges):
         filter = FilterFunctions[filter_name]
         filter_out = out[..., start_channel:stop_channel]
-        task = partial( filter, input_grayscale, scale, filter_out, roi )
+        if scale in presmoothed_inputs:
+            task = partial( filter, presmoothed_inputs[scale], scale, filter_out, roi, presmoothing[scale] )
+        else:
+            task = partial( filter, input_grayscale, scale, filter_out, roi )
         tasks.append( task )
 
     # Actually do the work
@@ -413,22 +561,46 @@ def load_classifier( classifier_filepath ):
     rf = vigra.learning.RandomForest(classifier_filepath, classifier_groupname)
     return rf
 
-def save_predictions( predictions, output_path, compression=False ):
+def save_predictions( predictions, output_path, compression=False, shape=None ):
+    """
+    Save the predictions to .h5 or .npy.
+
+    predictions:
+        Either the complete prediction volume, or an iterable of (block_roi, block_predictions),
+        e.g. from iter_blockwise_predictions().  In the latter case, each block is written
+        as soon as it is available, and the shape of the complete volume must be given.
+    """
     logger.info("Saving predictions to {}".format( output_path ))
+    if isinstance(predictions, np.ndarray):
+        blocks = [ ( ((0,)*predictions.ndim, predictions.shape), predictions ) ]
+        shape = predictions.shape
+    else:
+        assert shape is not None, "Must provide the output shape when saving blockwise predictions"
+        blocks = predictions
+    
     if '.h5' in output_path:
         output_path, dataset = output_path.split('.h5')
         output_path += '.h5'
         with h5py.File(output_path, 'w') as f:
             if compression:
-                f.create_dataset(dataset, data=predictions, chunks=True, compression='gzip', compression_opts=4)
+                dset = f.create_dataset(dataset, shape=shape, dtype=np.float32, chunks=True, compression='gzip', compression_opts=4)
             else:
-                f.create_dataset(dataset, data=predictions, chunks=True)
+                dset = f.create_dataset(dataset, shape=shape, dtype=np.float32, chunks=True)
+            _write_blocks( dset, blocks )
                 
     elif '.npy' in output_path:
         assert not compression, "Compression not available in .npy format."
-        np.save(output_path, predictions)
+        out = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.float32, shape=shape)
+        _write_blocks( out, blocks )
+        out.flush()
+        del out
     else:
         raise RuntimeError("Unknown output file format: {}".format( output_path ))
+
+def _write_blocks( out, blocks ):
+    for block_roi, block_predictions in blocks:
+        block_slicing = bb_to_slicing( block_roi[0], block_roi[1] )
+        out[block_slicing] = np.asarray(block_predictions)
         
 
 def __debug_setup():
@@ -27,6 +27,7 @@ from ilastik.applets.dataSelection import DataSelectionApplet
 from ilastik.applets.wsdt import WsdtApplet
 from ilastik.applets.edgeTrainingWithMulticut import EdgeTrainingWithMulticutApplet
 from ilastik.applets.edgeTrainingWithMulticut.opEdgeTrainingWithMulticut import OpEdgeTrainingWithMulticut
+from ilastik.applets.multicut.opMulticut import AVAILABLE_SOLVER_NAMES
 from ilastik.applets.dataExport.dataExportApplet import DataExportApplet
 from ilastik.applets.batchProcessing import BatchProcessingApplet
 
@@ -118,6 +119,9 @@ class EdgeTrainingWithMulticutWorkflow(Workflow):
         # Parse workflow-specific command-line args
         parser = argparse.ArgumentParser()
         parser.add_argument('--retrain', help="Re-train the classifier based on labels stored in the project file, and re-save.", action="store_true")
+        parser.add_argument('--multicut-solver', help="Multicut solver to use (overrides the project setting). "
+                            "One of: {}".format(', '.join(AVAILABLE_SOLVER_NAMES)), choices=AVAILABLE_SOLVER_NAMES)
+        parser.add_argument('--beta', help="Multicut beta parameter (overrides the project setting).", type=float)
         self.parsed_workflow_args, unused_args = parser.parse_known_args(workflow_cmdline_args)
         if unused_args:
             # Parse batch export/input args.
@@ -258,6 +262,13 @@ class EdgeTrainingWithMulticutWorkflow(Workflow):
         if self._data_export_args:
             self.dataExportApplet.configure_operator_with_parsed_args( self._data_export_args )
 
+        # Override the multicut settings?
+        opMulticut = self.edgeTrainingWithMulticutApplet.topLevelOperator
+        if self.parsed_workflow_args.multicut_solver:
+            opMulticut.SolverName.setValue(self.parsed_workflow_args.multicut_solver)
+        if self.parsed_workflow_args.beta is not None:
+            opMulticut.Beta.setValue(self.parsed_workflow_args.beta)
+
         # Retrain the classifier?
         if self.parsed_workflow_args.retrain:
             self._force_retrain_classifier(projectManager)
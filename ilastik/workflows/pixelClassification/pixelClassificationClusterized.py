@@ -48,7 +48,9 @@ import ilastik_main
 import ilastik.monkey_patches
 from lazyflow.utility.timer import timeLogged
 from ilastik.clusterConfig import parseClusterConfigFile
-from ilastik.clusterOps import OpClusterize, OpTaskWorker
+from ilastik.clusterOps import OpClusterize, OpTaskWorker, BlockClaimQueue, blockClaimDirectory
+from lazyflow.rtype import Roi, SubRegion
+from lazyflow.utility.io_util.blockwiseFileset import BlockwiseFileset
 from ilastik.utility import log_exception
 
 import ilastik.workflows # Load all known workflow modules
@@ -82,6 +84,8 @@ def getArgParser():
     parser.add_argument('--output_description_file', help='The JSON file that describes the output dataset', required=False)
     parser.add_argument('--logfile', help='A filepath to dump all log messages to.', required=False)
     parser.add_argument('--_node_work_', help='Internal use only', required=False)
+    parser.add_argument('--_node_queue_', action='store_true', help='Internal use only', required=False)
+    parser.add_argument('--_progress_file_', help='Internal use only', required=False)
 
     return parser
 
@@ -103,9 +107,11 @@ def runWorkflow(cluster_args):
     ilastik_main_args.project = cluster_args.project
     ilastik_main_args.process_name = cluster_args.process_name
 
+    is_node = cluster_args._node_work_ is not None or cluster_args._node_queue_
+
     # Nodes should not write to a common logfile.
     # Override with /dev/null
-    if cluster_args._node_work_ is None:
+    if not is_node:
         ilastik_main_args.logfile = cluster_args.logfile
     else:
         ilastik_main_args.logfile = "/dev/null"
@@ -121,10 +127,10 @@ def runWorkflow(cluster_args):
 
     # Configure the thread count.
     # Nowadays, this is done via an environment variable setting for ilastik_main to detect.
-    if cluster_args._node_work_ is not None and config.task_threadpool_size is not None:
+    if is_node and config.task_threadpool_size is not None:
         os.environ["LAZYFLOW_THREADS"] = str(config.task_threadpool_size)
     
-    if cluster_args._node_work_ is not None and config.task_total_ram_mb is not None:
+    if is_node and config.task_total_ram_mb is not None:
         os.environ["LAZYFLOW_TOTAL_RAM_MB"] = str(config.task_total_ram_mb)
 
     # Instantiate 'shell' by calling ilastik_main with our 
@@ -138,14 +144,17 @@ def runWorkflow(cluster_args):
 
     clusterOperator = None
     try:
-        if cluster_args._node_work_ is not None:
+        if is_node:
             clusterOperator, resultSlot = prepare_node_cluster_operator(config, cluster_args, finalOutputSlot)
         else:
             clusterOperator, resultSlot = prepare_master_cluster_operator(cluster_args, finalOutputSlot)
         
         # Get the result
         logger.info("Starting task")
-        result = resultSlot[0].value # FIXME: The image index is hard-coded here.
+        if cluster_args._node_queue_:
+            result = run_node_queue(config, cluster_args, clusterOperator, resultSlot)
+        else:
+            result = resultSlot[0].value # FIXME: The image index is hard-coded here.
     finally:
         logger.info("Cleaning up")
         global stop_background_tasks
@@ -175,7 +184,9 @@ def prepare_node_cluster_operator(config, cluster_args, finalOutputSlot):
 
     # FIXME: Image index is hard-coded as 0.  We assume we are working with only one (big) dataset in cluster mode.            
     opClusterTaskWorker.Input.connect( finalOutputSlot )
-    opClusterTaskWorker.RoiString[0].setValue( cluster_args._node_work_ )
+    if cluster_args._node_work_ is not None:
+        # (Queue workers set the roi for each block they claim.)
+        opClusterTaskWorker.RoiString[0].setValue( cluster_args._node_work_ )
     opClusterTaskWorker.TaskName.setValue( cluster_args.process_name )
     opClusterTaskWorker.ConfigFilePath.setValue( cluster_args.option_config_file )
     opClusterTaskWorker.OutputFilesetDescription.setValue( cluster_args.output_description_file )
@@ -190,11 +201,51 @@ def prepare_node_cluster_operator(config, cluster_args, finalOutputSlot):
                 subprocess.call( shell_cmd, shell=True )
             background_tasks.put( functools.partial( shell_call, cmd ) )
         opClusterTaskWorker.innerOperators[0].progressSignal.subscribe( report_progress )
+
+    # The local task executor polls the task progress from a file.
+    if cluster_args._progress_file_ is not None:
+        def write_progress_file( progress ):
+            def write_file(progress_file_path):
+                tmp_path = progress_file_path + ".tmp"
+                with open(tmp_path, 'w') as f:
+                    f.write( str(int(progress)) )
+                os.rename( tmp_path, progress_file_path )
+            background_tasks.put( functools.partial( write_file, cluster_args._progress_file_ ) )
+        opClusterTaskWorker.innerOperators[0].progressSignal.subscribe( write_progress_file )
     
     resultSlot = opClusterTaskWorker.ReturnCode
     clusterOperator = opClusterTaskWorker
     return (clusterOperator, resultSlot)
 
+def run_node_queue(config, cluster_args, opClusterTaskWorker, resultSlot):
+    """
+    Process blocks from the shared block queue until there are none left.
+    """
+    blockwiseFileset = BlockwiseFileset( cluster_args.output_description_file )
+    try:
+        block_queue = BlockClaimQueue( blockClaimDirectory( cluster_args.output_description_file ),
+                                       blockwiseFileset,
+                                       cluster_args.process_name,
+                                       config.task_stale_claim_secs )
+        opClusterTaskWorker.innerOperators[0].progressSignal.subscribe( block_queue.heartbeat )
+        opClusterTaskWorker.innerOperators[0].blockClaimQueue = block_queue
+
+        result = True
+        while True:
+            roi = block_queue.claimNext()
+            if roi is None:
+                break
+            logger.info( "Claimed block: {}".format( roi ) )
+            try:
+                roi_string = Roi.dumps( SubRegion( None, start=roi[0], stop=roi[1] ) )
+                opClusterTaskWorker.RoiString[0].setValue( roi_string )
+                result = bool( resultSlot[0].value ) and result
+            finally:
+                block_queue.release( roi )
+        return result
+    finally:
+        blockwiseFileset.close()
+
 def prepare_master_cluster_operator(cluster_args, finalOutputSlot):
     # We're the master
     opClusterizeMaster = OperatorWrapper( OpClusterize, parent=finalOutputSlot.getRealOperator().parent )
@@ -206,6 +257,14 @@ def prepare_master_cluster_operator(cluster_args, finalOutputSlot):
     opClusterizeMaster.OutputDatasetDescription.setValue( cluster_args.output_description_file )
     opClusterizeMaster.ConfigFilePath.setValue( cluster_args.option_config_file )
 
+    # Only the local task executor reports progress.
+    last_progress = [None]
+    def log_progress( progress ):
+        if progress != last_progress[0]:
+            last_progress[0] = progress
+            logger.info( "Overall progress: {}%".format( progress ) )
+    opClusterizeMaster.innerOperators[0].progressSignal.subscribe( log_progress )
+
     resultSlot = opClusterizeMaster.ReturnCode
     clusterOperator = opClusterizeMaster
     return (clusterOperator, resultSlot)
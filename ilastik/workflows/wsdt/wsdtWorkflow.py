@@ -18,6 +18,7 @@
 # on the ilastik web site at:
 #           http://ilastik.org/license.html
 ###############################################################################
+import argparse
 import numpy as np
 
 from ilastik.workflow import Workflow
@@ -90,6 +91,12 @@ class WsdtWorkflow(Workflow):
 
         # -- Parse command-line arguments
         #    (Command-line args are applied in onProjectLoaded(), below.)
+        parser = argparse.ArgumentParser()
+        parser.add_argument('--block-shape', help="Compute the watershed blockwise, with blocks of the given (spatial) shape, e.g. --block-shape 512 512 512",
+                            type=int, nargs='+')
+        parser.add_argument('--block-halo', help="Halo (in pixels) around each block in blockwise mode", type=int)
+        self.parsed_workflow_args, workflow_cmdline_args = parser.parse_known_args(workflow_cmdline_args or [])
+
         if workflow_cmdline_args:
             self._data_export_args, unused_args = self.dataExportApplet.parse_known_cmdline_args( workflow_cmdline_args )
             self._batch_input_args, unused_args = self.dataSelectionApplet.parse_known_cmdline_args( unused_args, role_names )
@@ -132,6 +139,13 @@ class WsdtWorkflow(Workflow):
         if self._data_export_args:
             self.dataExportApplet.configure_operator_with_parsed_args( self._data_export_args )
 
+        # Blockwise watershed?
+        opWsdt = self.wsdtApplet.topLevelOperator
+        if self.parsed_workflow_args.block_shape:
+            opWsdt.BlockShape.setValue( tuple(self.parsed_workflow_args.block_shape) )
+        if self.parsed_workflow_args.block_halo is not None:
+            opWsdt.BlockHalo.setValue( self.parsed_workflow_args.block_halo )
+
         if self._headless and self._batch_input_args and self._data_export_args:
             logger.info("Beginning Batch Processing")
             self.batchProcessingApplet.run_export_from_parsed_args(self._batch_input_args)
@@ -52,6 +52,11 @@ parser.add_argument(
     '--exit_on_failure',
     help='Immediately call exit(1) if an unhandled exception occurs.',
     action='store_true', default=False)
+parser.add_argument(
+    '--lazy_project_load', '--lazy-project-load',
+    help='Headless mode only: read large items of the project file (e.g. '
+    'label blocks) only once they are needed.',
+    action='store_true', default=False)
 parser.add_argument(
     '--hbp', help='Enable HBP-specific functionality.',
     action='store_true', default=False)
@@ -131,7 +136,8 @@ def main(parsed_args, workflow_cmdline_args=[], init_logging=True):
             f()
 
         from ilastik.shell.headless.headlessShell import HeadlessShell
-        shell = HeadlessShell(workflow_cmdline_args)
+        shell = HeadlessShell(workflow_cmdline_args,
+                              lazy_project_load=parsed_args.lazy_project_load)
 
         # Run post-init
         for f in postinit_funcs:
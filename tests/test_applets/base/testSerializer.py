@@ -536,6 +536,88 @@ class TestSerialBlockSlot(unittest.TestCase):
         shutil.rmtree(tmp_dir)
 
 
+    def testIncrementalUpdate(self):
+        tmp_dir = tempfile.mkdtemp()
+        h5_filepath = os.path.join(tmp_dir , 'serial_blockslot_test.h5' )
+
+        opLabelArrays, slotSerializer = self._init_objects()
+
+        opLabelArrays.Input[0][10:11, 10:20, 10:20, 0:1] = 1*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+        opLabelArrays.Input[0][30:31, 30:40, 30:40, 0:1] = 2*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+        opLabelArrays.Input[0][50:51, 50:60, 50:60, 0:1] = 2*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+
+        with h5py.File(h5_filepath, 'w') as f:
+            label_group = f.create_group('label_data')
+            slotSerializer.serialize( label_group )
+
+            # Mark the stored blocks, so we can tell which ones get rewritten.
+            lane_group = label_group[slotSerializer.name]['0000']
+            for block in lane_group.values():
+                block.attrs['untouched'] = True
+
+            # Change one block, clear another and add a new one.
+            opLabelArrays.Input[0][10:11, 10:20, 10:20, 0:1] = 3*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+            opLabelArrays.Input[0][50:51, 50:60, 50:60, 0:1] = 255*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+            opLabelArrays.Input[0][70:71, 70:80, 70:80, 0:1] = 1*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+            slotSerializer.serialize( label_group )
+
+            lane_group = label_group[slotSerializer.name]['0000']
+            untouched = sorted( block.attrs['blockSlice'] for block in lane_group.values()
+                                if 'untouched' in block.attrs )
+            assert len(untouched) == 1
+            blockSlice = untouched[0]
+            if isinstance(blockSlice, bytes):
+                blockSlice = blockSlice.decode('utf-8')
+            assert '30:40' in blockSlice
+
+        opLabelArrays, slotSerializer = self._init_objects()
+
+        with h5py.File(h5_filepath, 'r') as f:
+            label_group = f['label_data']
+            slotSerializer.deserialize( label_group )
+
+        assert ( opLabelArrays.Output[0][10:11, 10:20, 10:20, 0:1].wait() == 3 ).all()
+        assert ( opLabelArrays.Output[0][30:31, 30:40, 30:40, 0:1].wait() == 2 ).all()
+        assert ( opLabelArrays.Output[0][50:51, 50:60, 50:60, 0:1].wait() == 0 ).all()
+        assert ( opLabelArrays.Output[0][70:71, 70:80, 70:80, 0:1].wait() == 1 ).all()
+
+        os.remove(h5_filepath)
+        shutil.rmtree(tmp_dir)
+
+    def testLazyLoad(self):
+        tmp_dir = tempfile.mkdtemp()
+        h5_filepath = os.path.join(tmp_dir , 'serial_blockslot_test.h5' )
+
+        opLabelArrays, slotSerializer = self._init_objects()
+
+        opLabelArrays.Input[0][10:11, 10:20, 10:20, 0:1] = 1*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+        opLabelArrays.Input[0][30:31, 30:40, 30:40, 0:1] = 2*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+
+        with h5py.File(h5_filepath, 'w') as f:
+            label_group = f.create_group('label_data')
+            slotSerializer.serialize( label_group )
+
+        opLabelArrays, slotSerializer = self._init_objects()
+
+        with h5py.File(h5_filepath, 'r') as f:
+            label_group = f['label_data']
+            slotSerializer.deserializeLazily( label_group )
+            assert slotSerializer._isLoadPending(0)
+            assert not slotSerializer.dirty
+
+            # The blocks are read on the first request.
+            assert ( opLabelArrays.Output[0][10:11, 10:20, 10:20, 0:1].wait() == 1 ).all()
+            assert not slotSerializer._isLoadPending(0)
+            assert ( opLabelArrays.Output[0][30:31, 30:40, 30:40, 0:1].wait() == 2 ).all()
+
+            # Loading doesn't count as a change.
+            assert not slotSerializer.dirty
+            assert not slotSerializer.shouldSerialize( label_group )
+
+        os.remove(h5_filepath)
+        shutil.rmtree(tmp_dir)
+
+
 class TestSerialBlockSlot2(unittest.TestCase):
 
     def _init_objects(self):
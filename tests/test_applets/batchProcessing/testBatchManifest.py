@@ -0,0 +1,104 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import shutil
+import tempfile
+import unittest
+
+from ilastik.applets.batchProcessing.batchManifest import BatchManifest
+
+
+class TestBatchManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.manifest_path = os.path.join(self.tmpdir, 'manifest.jsonl')
+        self.inputs = []
+        self.outputs = []
+        for i in range(3):
+            input_path = os.path.join(self.tmpdir, 'input{}.png'.format(i))
+            output_path = os.path.join(self.tmpdir, 'output{}.h5'.format(i))
+            self._write(input_path, 'input')
+            self._write(output_path, 'output')
+            self.inputs.append((input_path,))
+            self.outputs.append(output_path + '/exported_data')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _write(self, path, contents):
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def testResume(self):
+        manifest = BatchManifest(self.manifest_path, 'params')
+        assert manifest.completed_output(self.inputs[0]) is None
+        manifest.record(self.inputs[0], self.outputs[0])
+        manifest.record(self.inputs[1], self.outputs[1])
+
+        manifest = BatchManifest(self.manifest_path, 'params')
+        assert manifest.completed_output(self.inputs[0]) == self.outputs[0]
+        assert manifest.completed_output(self.inputs[1]) == self.outputs[1]
+        assert manifest.completed_output(self.inputs[2]) is None
+
+        # Other parameters invalidate all records
+        manifest = BatchManifest(self.manifest_path, 'other params')
+        assert manifest.completed_output(self.inputs[0]) is None
+
+    def testChangedFiles(self):
+        manifest = BatchManifest(self.manifest_path, 'params')
+        manifest.record(self.inputs[0], self.outputs[0])
+        manifest.record(self.inputs[1], self.outputs[1])
+
+        self._write(self.inputs[0][0], 'changed input')
+        self._write(self.outputs[1].split('/exported_data')[0], 'partially overwritten output')
+
+        manifest = BatchManifest(self.manifest_path, 'params')
+        assert manifest.completed_output(self.inputs[0]) is None
+        assert manifest.completed_output(self.inputs[1]) is None
+
+    def testTruncatedRecord(self):
+        manifest = BatchManifest(self.manifest_path, 'params')
+        manifest.record(self.inputs[0], self.outputs[0])
+        # Simulate a process that was killed while writing a record
+        with open(self.manifest_path, 'a') as f:
+            f.write('{"key": "[\\"unfinished')
+
+        manifest = BatchManifest(self.manifest_path, 'params')
+        assert manifest.completed_output(self.inputs[0]) == self.outputs[0]
+        manifest.record(self.inputs[1], self.outputs[1])
+
+        manifest = BatchManifest(self.manifest_path, 'params')
+        assert manifest.completed_output(self.inputs[0]) == self.outputs[0]
+        assert manifest.completed_output(self.inputs[1]) == self.outputs[1]
+
+    def testUnwritableManifest(self):
+        # e.g. a read-only project directory: the batch run must go on.
+        manifest_path = os.path.join(self.tmpdir, 'missing_dir', 'manifest.jsonl')
+        manifest = BatchManifest(manifest_path, 'params')
+        manifest.record(self.inputs[0], self.outputs[0])
+        manifest.record(self.inputs[1], self.outputs[1])
+        assert not os.path.exists(manifest_path)
+        assert manifest.completed_output(self.inputs[0]) is None
+
+
+if __name__ == "__main__":
+    unittest.main()
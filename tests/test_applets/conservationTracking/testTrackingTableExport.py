@@ -0,0 +1,130 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2017, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#           http://ilastik.org/license.html
+###############################################################################
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import networkx as nx
+import pytest
+
+from ilastik.plugins import PluginExportContext
+from ilastik.plugins_default import tracking_csv_export
+from ilastik.plugins_default.tracking_csv_export import TrackingCSVExportFormatPlugin, trackingColumnsPerFrame
+
+# The features are in a category without a plugin, so their names are used as they are.
+CATEGORY = 'Test Features'
+
+EXPECTED_CSV = """\
+frame,labelimageId,trackId,lineageId,parentTrackId,mergerLabelId,Center_of_the_object_0,Center_of_the_object_1,Count,Mean_Intensity
+0,1,1,1,0,0,1,2,10.000000,0.500000
+0,2,2,2,0,2,3,4,20.000000,0.250000
+1,1,3,1,1,0,5,6,5.000000,1.000000
+1,2,-1,-1,0,0,7,8,6.000000,2.000000
+"""
+
+class HypothesesGraph(object):
+    """Stands in for the hytra HypothesesGraph."""
+    def __init__(self, graph):
+        self._graph = graph
+
+class FeaturesSlot(object):
+    """Stands in for the object features slot."""
+    def __init__(self, features):
+        self.features = features
+
+    def __call__(self, roi):
+        return self
+
+    def wait(self):
+        return self.features
+
+class TestTrackingTableExport(object):
+
+    def setup_method(self, method):
+        self.tmpdir = tempfile.mkdtemp()
+
+        graph = nx.DiGraph()
+        graph.add_node((1, 2), trackId=None, lineageId=None)
+        graph.add_node((0, 1), trackId=1, lineageId=1)
+        graph.add_node((0, 2), trackId=2, lineageId=2, mergerValue=2)
+        graph.add_node((1, 1), trackId=3, lineageId=1, parent=(0, 1))
+        self.hypothesesGraph = HypothesesGraph(graph)
+
+        # the first row is the background object
+        self.features = {
+            0: {CATEGORY: {'Center_of_the_object': np.array([[0, 0], [1.5, 2.25], [3.75, 4.0]]),
+                           'Count': np.array([0, 10, 20]),
+                           'Mean_Intensity': np.array([0, 0.5, 0.25]),
+                           'Histogram': np.zeros((3, 64))}},
+            1: {CATEGORY: {'Center_of_the_object': np.array([[0, 0], [5.5, 6.5], [7.0, 8.0]]),
+                           'Count': np.array([0, 5, 6]),
+                           'Mean_Intensity': np.array([0, 1.0, 2.0]),
+                           'Histogram': np.zeros((3, 64))}}}
+        self.context = PluginExportContext(FeaturesSlot(self.features), None, None, None)
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.tmpdir)
+
+    def testTrackingColumns(self):
+        columns = trackingColumnsPerFrame(self.hypothesesGraph._graph)
+        assert sorted(columns.keys()) == [0, 1]
+        np.testing.assert_array_equal(columns[0], [[1, 1, 1, 0, 0], [2, 2, 2, 0, 2]])
+        np.testing.assert_array_equal(columns[1], [[1, 3, 1, 1, 0], [2, -1, -1, 0, 0]])
+
+    def testFrameTables(self):
+        columns = tracking_csv_export.featureColumns(self.features[0], lambda category, name: name)
+        headers = [header for _, _, _, header, _ in columns]
+        assert headers == ['Center_of_the_object_0', 'Center_of_the_object_1', 'Count', 'Mean_Intensity']
+
+        tables = list(tracking_csv_export.frameTables(self.hypothesesGraph._graph, self.features, columns))
+        assert [frame for frame, _ in tables] == [0, 1]
+        table = tables[1][1]
+        assert table.dtype['Center_of_the_object_0'] == np.float64
+        np.testing.assert_array_equal(table['labelimageId'], [1, 2])
+        np.testing.assert_array_equal(table['Center_of_the_object_0'], [5.5, 7.0])
+
+    def testCSV(self):
+        filename = os.path.join(self.tmpdir, 'tracking')
+        assert TrackingCSVExportFormatPlugin().export(filename, self.hypothesesGraph, self.context)
+        with open(filename + '.csv') as f:
+            assert f.read() == EXPECTED_CSV
+
+    def testParquet(self):
+        pyarrow_parquet = pytest.importorskip('pyarrow.parquet')
+        from ilastik.plugins_default.tracking_parquet_export import TrackingParquetExportFormatPlugin
+
+        filename = os.path.join(self.tmpdir, 'tracking')
+        assert TrackingParquetExportFormatPlugin().export(filename, self.hypothesesGraph, self.context)
+        table = pyarrow_parquet.read_table(filename + '.parquet')
+
+        assert table.schema.names == EXPECTED_CSV.splitlines()[0].split(',')
+        assert table.num_rows == 4
+        columns = table.to_pydict()
+        assert str(table.schema.field('trackId').type) == 'int64'
+        assert columns['trackId'] == [1, 2, 3, -1]
+        assert columns['parentTrackId'] == [0, 0, 1, 0]
+
+        # Object centers keep their fractions
+        assert str(table.schema.field('Center_of_the_object_0').type) == 'double'
+        assert columns['Center_of_the_object_0'] == [1.5, 3.75, 5.5, 7.0]
+        assert columns['Center_of_the_object_1'] == [2.25, 4.0, 6.5, 8.0]
+        assert columns['Mean_Intensity'] == [0.5, 0.25, 1.0, 2.0]
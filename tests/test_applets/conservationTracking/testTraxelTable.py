@@ -0,0 +1,70 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2017, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#           http://ilastik.org/license.html
+###############################################################################
+import numpy as np
+
+from ilastik.applets.tracking.conservation.opConservationTracking import traxel_table, clip_probabilities
+
+
+class TestTraxelTable(object):
+    def features(self, centers, lower, upper, counts):
+        # prepend the background row, as the object features do
+        def withBackground(a):
+            a = np.asarray(a, dtype=np.float64)
+            return np.concatenate((np.zeros((1,) + a.shape[1:]), a))
+        return {'RegionCenter': withBackground(centers),
+                'Coord<Minimum>': withBackground(lower),
+                'Coord<Maximum>': withBackground(upper),
+                'Count': withBackground(np.asarray(counts).reshape(-1, 1))}
+
+    def testFilters3d(self):
+        feats = self.features(centers=[[5, 5, 5], [50, 5, 5], [5, 5, 5], [8, 8, 8]],
+                              lower=[[3, 3, 3], [48, 3, 3], [4, 4, 4], [6, 6, 6]],
+                              upper=[[7, 7, 7], [52, 7, 7], [6, 6, 6], [10, 10, 10]],
+                              counts=[100, 100, 2, 100])
+        # object 2 is out of the field of view, object 3 too small
+        table = traxel_table(feats, (0, 40), (0, 40), (0, 40), (10, 1000))
+        assert list(table['ids']) == [1, 4]
+        assert list(table['filtered']) == [2, 3]
+        assert table['com'].shape == (2, 3)
+        np.testing.assert_array_equal(table['com'][1], [8, 8, 8])
+        np.testing.assert_array_equal(table['upper'][0], [7, 7, 7])
+        np.testing.assert_array_equal(table['count'], [100, 100])
+
+    def testPadding2d(self):
+        feats = self.features(centers=[[5, 6], [7, 8]],
+                              lower=[[4, 5], [6, 7]],
+                              upper=[[6, 7], [8, 9]],
+                              counts=[10, 20])
+        table = traxel_table(feats, (0, 40), (0, 40), (0, 1), (0, 1000))
+        assert list(table['ids']) == [1, 2]
+        np.testing.assert_array_equal(table['com'], [[5, 6, 0], [7, 8, 0]])
+        np.testing.assert_array_equal(table['lower'][:, 2], [0, 0])
+
+    def testEmptyFrame(self):
+        feats = self.features(np.zeros((0, 3)), np.zeros((0, 3)), np.zeros((0, 3)), [])
+        table = traxel_table(feats, (0, 40), (0, 40), (0, 40), (0, 1000))
+        assert len(table['ids']) == 0
+        assert len(table['filtered']) == 0
+        assert table['com'].shape == (0, 3)
+
+    def testClipProbabilities(self):
+        np.testing.assert_array_equal(clip_probabilities(np.array([0., 0.5, 1.])),
+                                      [0.0000001, 0.5, 0.99999999])
@@ -5,6 +5,7 @@ from ilastikrag.util import generate_random_voronoi
 
 from lazyflow.graph import Graph
 from ilastik.applets.edgeTraining import OpEdgeTraining
+from ilastik.applets.edgeTraining.opEdgeTraining import EdgeTrainingSet
 
 import logging
 logger = logging.getLogger("tests.test_applets.edgeTraining")
@@ -57,3 +58,89 @@ class TestOpEdgeTraining(object):
         # ON
         assert edge_prob_dict[edge_C] > 0.5, "Expected > 0.5, got {}".format(edge_prob_dict[edge_C])
         assert edge_prob_dict[edge_D] > 0.5, "Expected > 0.5, got {}".format(edge_prob_dict[edge_D])
+
+    def testAddFeatures(self):
+        superpixels = generate_random_voronoi( (100,100,100), 100 )
+        superpixels = superpixels.insertChannelAxis()
+
+        voxel_data = np.concatenate( (superpixels, superpixels[::-1]), axis=-1 ).astype(np.float32)
+
+        graph = Graph()
+        multilane_op = OpEdgeTraining(graph=graph)
+        multilane_op.VoxelData.resize(1) # resizes all level-1 slots.
+        op_view = multilane_op.getLane(0)
+
+        op_view.VoxelData.setValue( voxel_data, extra_meta={'channel_names': ['Grayscale', 'Flipped']} )
+        op_view.Superpixels.setValue( superpixels )
+
+        multilane_op.FeatureNames.setValue( { "Grayscale": ['standard_edge_mean'],
+                                              "Flipped": ['standard_edge_count'] } )
+        first_df = op_view.opEdgeFeaturesCache.Output.value
+        assert list(first_df.columns.values) == ['sp1', 'sp2', 'Grayscale standard_edge_mean', 'Flipped standard_edge_count']
+
+        # Adding a feature only computes the new columns; the result must match a fresh computation.
+        feature_names = { "Grayscale": ['standard_edge_mean', 'standard_edge_quantiles'],
+                          "Flipped": ['standard_edge_count'] }
+        multilane_op.FeatureNames.setValue( feature_names )
+        second_df = op_view.opEdgeFeaturesCache.Output.value
+
+        fresh_op = OpEdgeTraining(graph=graph)
+        fresh_op.VoxelData.resize(1)
+        fresh_view = fresh_op.getLane(0)
+        fresh_view.VoxelData.setValue( voxel_data, extra_meta={'channel_names': ['Grayscale', 'Flipped']} )
+        fresh_view.Superpixels.setValue( superpixels )
+        fresh_op.FeatureNames.setValue( feature_names )
+        fresh_df = fresh_view.opEdgeFeaturesCache.Output.value
+
+        assert list(second_df.columns.values) == list(fresh_df.columns.values)
+        assert np.allclose( second_df.values, fresh_df.values )
+
+        # A table assembled from seeded columns (e.g. from the project file) has the same column order, too.
+        seeded_op = OpEdgeTraining(graph=graph)
+        seeded_op.VoxelData.resize(1)
+        seeded_view = seeded_op.getLane(0)
+        seeded_view.VoxelData.setValue( voxel_data, extra_meta={'channel_names': ['Grayscale', 'Flipped']} )
+        seeded_view.Superpixels.setValue( superpixels )
+        seeded_op.opComputeEdgeFeatures.getLane(0).seed_feature_columns( fresh_df )
+        seeded_op.FeatureNames.setValue( feature_names )
+        seeded_df = seeded_view.opEdgeFeaturesCache.Output.value
+        assert list(seeded_df.columns.values) == list(fresh_df.columns.values)
+        assert np.allclose( seeded_df.values, fresh_df.values )
+
+
+class TestEdgeTrainingSet(object):
+
+    def testUpdate(self):
+        edge_features_df = pd.DataFrame( { 'sp1': [1, 1, 2, 3],
+                                           'sp2': [2, 3, 3, 4],
+                                           'mean': [0.1, 0.2, 0.3, 0.4] },
+                                         columns=['sp1', 'sp2', 'mean'] )
+        training_set = EdgeTrainingSet(edge_features_df)
+
+        # Zero labels and unknown edges are ignored, the id order within a pair doesn't matter.
+        training_set.update( { (1,2): 1, (4,3): 2, (2,3): 0, (8,9): 1 } )
+        assert (training_set.features[:,0] == [0.1, 0.4]).all()
+        assert (training_set.labels == [1, 2]).all()
+
+        # New labels are appended
+        training_set.update( { (1,2): 1, (4,3): 2, (1,3): 2 } )
+        assert (training_set.features[:,0] == [0.1, 0.4, 0.2]).all()
+        assert (training_set.labels == [1, 2, 2]).all()
+
+        # Changed and removed labels
+        training_set.update( { (1,2): 2 } )
+        assert (training_set.features[:,0] == [0.1]).all()
+        assert (training_set.labels == [2]).all()
+
+    def testAlignedFeatures(self):
+        edge_features_df = pd.DataFrame( { 'sp1': [1, 2],
+                                           'sp2': [2, 3],
+                                           'mean': [0.1, 0.2],
+                                           'count': [10.0, 20.0] },
+                                         columns=['sp1', 'sp2', 'count', 'mean'] )
+        training_set = EdgeTrainingSet(edge_features_df)
+        training_set.update( { (1,2): 1, (2,3): 2 } )
+
+        # Columns are aligned by name, not by position
+        assert (training_set.aligned_features(['mean', 'count']) == [[0.1, 10.0], [0.2, 20.0]]).all()
+        assert (training_set.aligned_features(['count', 'mean']) == training_set.features).all()
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+opMulticut = pytest.importorskip("ilastik.applets.multicut.opMulticut")
+from ilastik.applets.multicut.opMulticut import assign_nodes_to_blocks, solve_decomposed, solve_with_nifty
+
+pytestmark = pytest.mark.skipif(not opMulticut.DECOMPOSED_SOLVER_NAMES, reason="Nifty not available")
+
+
+def superpixel_grid():
+    """
+    An 8x8 label image of 2x2 superpixels (ids 1..16, node 0 doesn't occur)
+    and the edges between horizontally and vertically neighboring superpixels.
+    """
+    ids = np.arange(1, 17).reshape(4, 4)
+    label_img = ids.repeat(2, axis=0).repeat(2, axis=1).astype(np.uint32)
+    edge_ids = np.concatenate( [ np.stack( [ids[:, :-1].ravel(), ids[:, 1:].ravel()], axis=1 ),
+                                 np.stack( [ids[:-1, :].ravel(), ids[1:, :].ravel()], axis=1 ) ] )
+    return label_img, edge_ids.astype(np.uint32)
+
+
+def energy(edge_ids, edge_weights, labels):
+    cut = labels[edge_ids[:, 0]] != labels[edge_ids[:, 1]]
+    return edge_weights[cut].sum()
+
+
+class TestDecomposedMulticut(object):
+
+    def testAssignNodesToBlocks(self):
+        label_img, _ = superpixel_grid()
+        # Superpixel 6 reaches into the blocks on its right and below
+        label_img[3:5, 3:5] = 6
+
+        node_blocks, block_count = assign_nodes_to_blocks(label_img, 17, (4, 4))
+        assert block_count == 4
+        expected = [4] + [0, 0, 1, 1,
+                          0, 0, 1, 1,
+                          2, 2, 3, 3,
+                          2, 2, 3, 3]
+        assert list(node_blocks) == expected
+
+    def testSolveDecomposed(self):
+        label_img, edge_ids = superpixel_grid()
+
+        # Trivially separable: the left and the right half of the image attract themselves,
+        # and repel each other.  Both halves span two blocks (above each other).
+        left = np.zeros(17, dtype=bool)
+        left[np.arange(1, 17).reshape(4, 4)[:, :2].ravel()] = True
+        same_half = left[edge_ids[:, 0]] == left[edge_ids[:, 1]]
+        edge_weights = np.where(same_half, 1.0, -1.0)
+
+        labels = solve_decomposed(label_img, edge_ids, edge_weights, 17, 'FmGreedy', block_shape=(4, 4))
+
+        # Every node gets a label, and the labels are consistent across the block borders.
+        assert labels.shape == (17,)
+        assert len(set(labels[1:][left[1:]])) == 1
+        assert len(set(labels[1:][~left[1:]])) == 1
+        assert labels[1] != labels[16]
+
+        full_labels = solve_with_nifty(edge_ids, edge_weights, 17, 'FmGreedy')
+        assert energy(edge_ids, edge_weights, labels) <= energy(edge_ids, edge_weights, full_labels) + 1e-6
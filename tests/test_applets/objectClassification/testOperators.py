@@ -29,13 +29,13 @@ import vigra
 from lazyflow.graph import Graph
 from ilastik.applets.objectClassification.opObjectClassification import \
     OpRelabelSegmentation, OpObjectTrain, OpObjectPredict, OpObjectClassification, \
-    OpBadObjectsToWarningMessage, OpMaxLabel
+    OpBadObjectsToWarningMessage, OpMaxLabel, uncertainty_from_probabilities
     
 from lazyflow.classifiers import ParallelVigraRfLazyflowClassifier
 
 from ilastik.applets import objectExtraction
 from ilastik.applets.objectExtraction.opObjectExtraction import \
-    OpRegionFeatures, OpAdaptTimeListRoi, OpObjectExtraction
+    OpRegionFeatures, OpAdaptTimeListRoi, OpObjectExtraction, default_features_key
 
 
 def segImage():
@@ -56,6 +56,13 @@ def segImage():
     img.axistags = vigra.defaultAxistags('txyzc')    
     return img
 
+def counts(nlabels):
+    '''
+    features holding only the object count of each time step
+    '''
+    return dict((t, {default_features_key: {'Count': np.zeros((n, 1))}})
+                for t, n in enumerate(nlabels))
+
 def emptyImage():
     '''
     an empty 5D image 
@@ -77,7 +84,7 @@ class TestOpRelabelSegmentation(unittest.TestCase):
                 1 : np.array([40, 50, 60, 70])}
         self.op.Image.setValue(segimg)
         self.op.ObjectMap.setValue(map_)
-        self.op.Features._setReady() # hack because we do not use features
+        self.op.Features.setValue(counts((3, 4)))
         img = self.op.Output.value
 
         assert img[0, 49, 49, 49, 0] == 10
@@ -88,6 +95,28 @@ class TestOpRelabelSegmentation(unittest.TestCase):
         assert (np.all(img[1, 10:20, 10:20, 10:20, 0] == 60))
         assert (np.all(img[1, 20:25, 20:25, 20:25, 0] == 70))
 
+    def test_short_map_and_dirty(self):
+        segimg = segImage()
+        # the map for t=1 does not cover label 3, the map for t=0 is empty
+        map_ = {0 : np.array([]),
+                1 : np.array([0, 50, 60])}
+        self.op.Image.setValue(segimg)
+        self.op.ObjectMap.setValue(map_)
+        self.op.Features.setValue(counts((3, 4)))
+        img = self.op.Output.value
+
+        assert np.all(img[0] == 0)
+        assert np.all(img[1, 0:10, 0:10, 0:10, 0] == 50)
+        assert np.all(img[1, 10:20, 10:20, 10:20, 0] == 60)
+        assert np.all(img[1, 20:25, 20:25, 20:25, 0] == 0)
+
+        # the cached lookup tables must not survive a change of the map
+        self.op.ObjectMap.setValue({0 : np.array([0, 1, 2]),
+                                    1 : np.array([0, 5, 6, 7])})
+        img = self.op.Output.value
+        assert np.all(img[0, 20:25, 20:25, 20:25, 0] == 2)
+        assert np.all(img[1, 20:25, 20:25, 20:25, 0] == 7)
+
 class TestOpObjectTrain(unittest.TestCase):
     
     nRandomForests = 1
@@ -248,6 +277,55 @@ class TestOpObjectPredict(unittest.TestCase):
         ###
         uncerts = self.op.UncertaintyEstimate([0]).wait()
         self.assertTrue(uncerts[0][0]==0)
+
+    def test_uncertainty_all_frames(self):
+        ###
+        # test that all frames are returned at once, and agree with the probabilities
+        ###
+        uncerts = self.op.UncertaintyEstimate([]).wait()
+        probs = self.op.Probabilities([]).wait()
+        self.assertEqual(sorted(uncerts.keys()), [0, 1])
+        for t in uncerts:
+            sortedProbs = np.sort(probs[t], axis=1)
+            expected = 1 - (sortedProbs[:, -1] - sortedProbs[:, -2])
+            expected[0] = 0
+            self.assertTrue(np.allclose(uncerts[t], expected))
+
+
+    def test_cache_eviction(self):
+        ###
+        # test that evicted time steps are recomputed transparently
+        ###
+        from ilastik.config import cfg
+        probs = self.op.Probabilities([0, 1]).wait()
+        self.assertTrue(self.op.usedMemory() > 0)
+
+        old_max_cached = cfg.get('object classification', 'max_cached_time_steps')
+        try:
+            cfg.set('object classification', 'max_cached_time_steps', '1')
+            self.op.Probabilities([1]).wait()
+            self.assertEqual(list(self.op.CachedProbabilities([0, 1]).wait().keys()), [1])
+            self.assertEqual([t for t, _ in self.op.getBlockAccessTimes()], [1])
+        finally:
+            cfg.set('object classification', 'max_cached_time_steps', old_max_cached)
+
+        self.assertTrue(self.op.freeBlock(1) > 0)
+        self.assertEqual(self.op.usedMemory(), 0)
+
+        recomputed = self.op.Probabilities([0, 1]).wait()
+        for t in (0, 1):
+            self.assertTrue(np.all(recomputed[t] == probs[t]))
+
+
+class TestUncertaintyFromProbabilities(unittest.TestCase):
+    def test_margin(self):
+        prob = np.array([[0, 0, 0], [0.7, 0.2, 0.1], [0.3, 0.3, 0.4], [0.1, 0.1, 0.8]])
+        uncert = uncertainty_from_probabilities(prob)
+        self.assertTrue(np.allclose(uncert, [0, 0.5, 0.9, 0.3]))
+
+    def test_single_class(self):
+        uncert = uncertainty_from_probabilities(np.ones((5, 1)))
+        self.assertTrue(np.all(uncert == 0))
         
 
  
@@ -22,7 +22,7 @@ from __future__ import division
 import ilastik.ilastik_logging
 ilastik.ilastik_logging.default_config.init()
 
-from ilastik.applets.objectClassification.opObjectClassification import OpObjectClassification
+from ilastik.applets.objectClassification.opObjectClassification import OpObjectClassification, bbox_overlaps
 import numpy
 
 class TestTransferLabelsFunction(object):
@@ -53,3 +53,30 @@ class TestTransferLabelsFunction(object):
         newmin4 =  coords_new["Coord<Minimum>"][4]
         newmax4 = coords_new["Coord<Maximum>"][4]
         assert numpy.all(newlost["conflict"]==(newmin4+(newmax4-newmin4)/2.))
+
+
+class TestBBoxOverlaps(object):
+    def test_against_all_pairs(self):
+        rng = numpy.random.RandomState(0)
+        for ndim in (2, 3):
+            mins_a = rng.randint(0, 100, size=(200, ndim))
+            maxs_a = mins_a + rng.randint(0, 15, size=(200, ndim))
+            mins_b = rng.randint(0, 100, size=(150, ndim))
+            maxs_b = mins_b + rng.randint(0, 15, size=(150, ndim))
+
+            ia, ib, overlaps = bbox_overlaps(mins_a, maxs_a, mins_b, maxs_b)
+
+            rad_a = 0.5*(maxs_a - mins_a)[:, None, :]
+            rad_b = 0.5*(maxs_b - mins_b)[None, :, :]
+            dist = numpy.abs((mins_a[:, None, :] + rad_a) - (mins_b[None, :, :] + rad_b))
+            over = rad_a + rad_b - dist
+            expected = numpy.where(numpy.all(over > 0, axis=2), numpy.prod(over, axis=2), 0)
+            ea, eb = numpy.nonzero(expected)
+            assert numpy.all(ia == ea)
+            assert numpy.all(ib == eb)
+            assert numpy.allclose(overlaps, expected[ea, eb])
+
+    def test_empty(self):
+        ia, ib, overlaps = bbox_overlaps(numpy.zeros((0, 3)), numpy.zeros((0, 3)),
+                                         numpy.array([[0, 0, 0]]), numpy.array([[5, 5, 5]]))
+        assert len(ia) == len(ib) == len(overlaps) == 0
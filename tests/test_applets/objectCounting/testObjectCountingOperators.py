@@ -29,12 +29,13 @@ import unittest
 import numpy as np
 import vigra
 from lazyflow.graph import Graph
+from lazyflow.operators import OpArrayPiper
 from ilastik.applets.objectClassification.opObjectClassification import \
     OpRelabelSegmentation, OpObjectTrain, OpObjectPredict, OpObjectClassification, \
     OpBadObjectsToWarningMessage, OpMaxLabel
     
 from ilastik.applets.counting.opCounting import \
-    OpCounting, OpMean, OpVolumeOperator,OpLabelPipeline, \
+    OpCounting, OpMean, OpVolumeOperator, OpDensityIntegral, OpLabelPipeline, \
     OpPredictionPipelineNoCache,OpPredictionPipeline
 
 from ilastik.applets.counting.countingOperators import OpTrainCounter, OpPredictCounter, OpLabelPreviewer
@@ -89,6 +90,85 @@ class TestOpMean(unittest.TestCase):
         #FIXME: why is it this the region ?
         np.testing.assert_allclose(np.mean(rimg.view(np.ndarray),axis=2),mean.view(np.ndarray)[...,0:1,0])
 
+
+class TestOpVolumeOperator(unittest.TestCase):
+    def setUp(self):
+        g = Graph()
+        self.data = np.random.rand(100, 60, 2).astype(np.float32)
+        self.blockShapes = []
+        def blockSum(a):
+            self.blockShapes.append(a.shape)
+            return np.sum(a)
+
+        self.opPiper = OpArrayPiper(graph=g)
+        self.opPiper.Input.setValue(self.data)
+        self.op = OpVolumeOperator(graph=g)
+        self.op.Input.connect(self.opPiper.Output)
+        self.op.blockShape.setValue((32, 32, None))
+        self.op.Function.setValue(blockSum)
+
+    def test(self):
+        del self.blockShapes[:]
+        total = self.op.Output[:].wait()[0]
+        np.testing.assert_allclose(total, self.data.sum(), rtol=1e-5)
+        # 4*2 blocks, plus the final reduction
+        assert len(self.blockShapes) == 9
+
+        # Only the dirty block is recomputed
+        del self.blockShapes[:]
+        self.opPiper.Input.setDirty(np.s_[40:50, 10:20, :])
+        total = self.op.Output[:].wait()[0]
+        np.testing.assert_allclose(total, self.data.sum(), rtol=1e-5)
+        assert self.blockShapes[0] == (32, 32, 2)
+        assert len(self.blockShapes) == 2
+
+
+class TestOpDensityIntegral(unittest.TestCase):
+    def setUp(self):
+        g = Graph()
+        self.data = np.random.rand(1, 100, 70, 1, 1).astype(np.float32)
+        self.opPiper = OpArrayPiper(graph=g)
+        self.opPiper.Input.setValue(self.data)
+        self.op = OpDensityIntegral(graph=g)
+        self.op.Input.connect(self.opPiper.Output)
+        self.op.BlockShape.setValue((1, 32, 16, 1, 1))
+
+    def test(self):
+        # Only the intersecting blocks are computed
+        np.testing.assert_allclose(self.op.boxSum((0, 3, 5, 0, 0), (1, 10, 12, 1, 1)),
+                                   self.data[0, 3:10, 5:12].sum(), rtol=1e-5)
+        assert self.op._known.sum() == 1
+
+        np.testing.assert_allclose(self.op.Output[:].wait()[0], self.data.sum(), rtol=1e-5)
+
+        boxes = [ ((0, 0, 0, 0, 0), (1, 100, 70, 1, 1)),
+                  ((0, 3, 5, 0, 0), (1, 10, 12, 1, 1)),    # within a single block
+                  ((0, 20, 10, 0, 0), (1, 90, 69, 1, 1)),  # many blocks
+                  ((0, 64, 48, 0, 0), (1, 96, 64, 1, 1)) ] # exactly one block
+        sums = self.op.boxSums(boxes)
+        for (start, stop), boxSum in zip(boxes, sums):
+            expected = self.data[tuple(slice(a, b) for a, b in zip(start, stop))].sum()
+            np.testing.assert_allclose(boxSum, expected, rtol=1e-5)
+
+        # Change some data: only the intersecting block is recomputed
+        self.data[0, 40:45, 20:25] = 1.0
+        self.opPiper.Input.setDirty(np.s_[:, 40:45, 20:25, :, :])
+        assert self.op._known.sum() == 4*5-1
+        np.testing.assert_allclose(self.op.boxSum(*boxes[2]), self.data[0, 20:90, 10:69].sum(), rtol=1e-5)
+
+    def testCoveredBlocks(self):
+        # Blocks that are completely covered by the box only need their totals
+        np.testing.assert_allclose(self.op.boxSum((0, 0, 0, 0, 0), (1, 100, 70, 1, 1)), self.data.sum(), rtol=1e-5)
+        assert self.op._known.all()
+        assert len(self.op._tables) == 0
+
+    def testMaxTableBytes(self):
+        self.op.MaxTableBytes = 2 * (32+1) * (16+1) * 8
+        box = ((0, 20, 10, 0, 0), (1, 90, 69, 1, 1))
+        for _ in range(2):
+            np.testing.assert_allclose(self.op.boxSum(*box), self.data[0, 20:90, 10:69].sum(), rtol=1e-5)
+            assert self.op._tableBytes <= self.op.MaxTableBytes
+
         
 # class TestOpObjectTrain(unittest.TestCase):
 #     
@@ -27,7 +27,7 @@ import numpy as np
 import vigra
 from lazyflow.graph import Graph
 from lazyflow.operators import OpLabelVolume
-from ilastik.applets.objectExtraction.opObjectExtraction import OpAdaptTimeListRoi, OpRegionFeatures, OpObjectExtraction
+from ilastik.applets.objectExtraction.opObjectExtraction import OpAdaptTimeListRoi, OpRegionFeatures, OpObjectExtraction, group_by_extent
 from ilastik.plugins import pluginManager
 
 import warnings
@@ -206,3 +206,145 @@ class TestOpRegionFeaturesAgainstNumpy(unittest.TestCase):
                 for icoord, coord in enumerate(centers[iobj]):
                     center_good = mins[iobj][icoord] + old_div((maxs[iobj][icoord]-mins[iobj][icoord]),2.)
                     assert abs(coord-center_good)<0.01
+
+    def test_chunked_local_features(self):
+        from ilastik.config import cfg
+        old_chunk_size = cfg.get('object extraction', 'local_features_chunk_size')
+        try:
+            cfg.set('object extraction', 'local_features_chunk_size', '0')
+            unchunked = self.op.Output[0:2].wait()
+            cfg.set('object extraction', 'local_features_chunk_size', '1')
+            chunked = self.op.Output[0:2].wait()
+        finally:
+            cfg.set('object extraction', 'local_features_chunk_size', old_chunk_size)
+
+        for t in range(2):
+            for key, value in unchunked[t][NAME].items():
+                np.testing.assert_array_equal(value, chunked[t][NAME][key])
+
+
+class TestOpRegionFeaturesBlockwise(unittest.TestCase):
+    def setUp(self):
+        g = Graph()
+        self.features = {
+            NAME : {
+                "Count" : {},
+                "Sum" : {},
+                "Mean" : {},
+                "Variance" : {},
+                "Minimum" : {},
+                "Maximum" : {},
+                "RegionCenter" : {},
+                "Coord<Minimum>" : {},
+                "Coord<Maximum>" : {},
+            }
+        }
+
+        # 100*100*20 voxels of float32 raw data and uint32 labels don't fit into 1 MB
+        binimage = np.zeros((1, 100, 100, 20, 1), dtype=np.float32)
+        binimage[0, 5:95, 10:60, 2:18, 0] = 1   # crosses many block borders
+        binimage[0, 0:100, 70:72, 10, 0] = 1    # thin bar along x
+        binimage[0, 80:83, 80:83, 0:2, 0] = 1
+        binimage = vigra.taggedView(binimage, 'txyzc')
+
+        np.random.seed(0)
+        rawimage = np.random.random(binimage.shape).astype(np.float32)
+        rawimage = vigra.taggedView(rawimage, 'txyzc')
+
+        self.labelop = OpLabelVolume(graph=g)
+        self.labelop.Input.setValue(binimage)
+        self.op = OpRegionFeatures(graph=g)
+        self.op.LabelVolume.connect(self.labelop.Output)
+        self.op.RawVolume.setValue(rawimage)
+        self.op.Features.setValue(self.features)
+
+    def test_blockwise_against_in_memory(self):
+        from ilastik.config import cfg
+        old_budget = cfg.get('object extraction', 'max_time_slice_mb')
+        try:
+            cfg.set('object extraction', 'max_time_slice_mb', '0')
+            assert not self.op._use_blockwise()
+            in_memory = self.op.Output[0:1].wait()
+            cfg.set('object extraction', 'max_time_slice_mb', '1')
+            assert self.op._use_blockwise()
+            blockwise = self.op.Output[0:1].wait()
+        finally:
+            cfg.set('object extraction', 'max_time_slice_mb', old_budget)
+
+        in_memory = in_memory[0][NAME]
+        blockwise = blockwise[0][NAME]
+        assert in_memory["Count"].shape[0] == 4
+        for key in self.features[NAME]:
+            np.testing.assert_allclose(blockwise[key], in_memory[key], rtol=1e-5, err_msg=key)
+
+
+class TestLocalFeatureBatches(unittest.TestCase):
+    def setUp(self):
+        g = Graph()
+        self.op = OpRegionFeatures(graph=g)
+
+        class Axes(object):
+            x, y, z, c = 0, 1, 2, 3
+        self.axes = Axes()
+
+        self.image = vigra.taggedView(np.random.randint(0, 255, size=(50, 40, 30, 2)).astype(np.float32), 'xyzc')
+        labels = np.zeros((50, 40, 30), dtype=np.uint32)
+        labels[0:5, 0:5, 0:5] = 1
+        labels[10:15, 20:25, 10:15] = 2
+        labels[30:40, 5:10, 20:25] = 3
+        labels[45:50, 35:40, 25:30] = 4
+        self.labels = vigra.taggedView(labels, 'xyz')
+        self.mincoords = np.array([[0, 0, 0], [10, 20, 10], [30, 5, 20], [45, 35, 25]])
+        self.maxcoords = np.array([[4, 4, 4], [14, 24, 14], [39, 9, 24], [49, 39, 29]])
+
+    def test_extents(self):
+        margin = (3, 2, 1)
+        starts, stops = self.op.compute_extents(self.image, self.mincoords, self.maxcoords, self.axes, margin)
+        for i in range(self.mincoords.shape[0]):
+            extent = self.op.compute_extent(i, self.image, self.mincoords, self.maxcoords, self.axes, margin)
+            assert [s.start for s in extent] == list(starts[i])
+            assert [s.stop for s in extent] == list(stops[i])
+
+    def test_stacks(self):
+        margin = (3, 2, 1)
+        starts, stops = self.op.compute_extents(self.image, self.mincoords, self.maxcoords, self.axes, margin)
+        seen = []
+        for object_ids in group_by_extent(starts, stops):
+            rawbboxes, binary_bboxes = self.op.compute_bbox_stacks(
+                self.image, self.labels, starts, stops, object_ids, self.axes)
+            assert rawbboxes.shape[0] == binary_bboxes.shape[0] == len(object_ids)
+            for j, i in enumerate(object_ids):
+                extent = self.op.compute_extent(i, self.image, self.mincoords, self.maxcoords, self.axes, margin)
+                rawbbox = self.op.compute_rawbbox(self.image, extent, self.axes)
+                binary_bbox = np.asarray(self.labels[tuple(extent)]) == i + 1
+                np.testing.assert_array_equal(rawbboxes[j], rawbbox)
+                np.testing.assert_array_equal(binary_bboxes[j], binary_bbox)
+                seen.append(i)
+        assert sorted(seen) == list(range(self.mincoords.shape[0]))
+
+    def test_batch_local(self):
+        self._check_batch({"Mean in neighborhood": {"margin": (3, 2, 1)},
+                           "Sum in neighborhood": {"margin": (3, 2, 1)}})
+
+    def test_batch_fallback(self):
+        # the histogram ranges depend on each object, so these go object by object
+        self._check_batch({"Histogram in neighborhood": {"margin": (3, 2, 1)}})
+
+    def _check_batch(self, features):
+        plugin = pluginManager.getPluginByName(NAME, "ObjectFeatures").plugin_object
+        plugin.ndim = 3
+        margin = (3, 2, 1)
+        starts, stops = self.op.compute_extents(self.image, self.mincoords, self.maxcoords, self.axes, margin)
+        object_ids = next(group_by_extent(starts, stops))
+        rawbboxes, binary_bboxes = self.op.compute_bbox_stacks(
+            self.image, self.labels, starts, stops, object_ids, self.axes)
+
+        batch = plugin.compute_local_batch(rawbboxes, binary_bboxes, features, self.axes)
+        for j, i in enumerate(object_ids):
+            extent = self.op.compute_extent(i, self.image, self.mincoords, self.maxcoords, self.axes, margin)
+            rawbbox = self.op.compute_rawbbox(self.image, extent, self.axes)
+            binary_bbox = np.asarray(self.labels[tuple(extent)]) == i + 1
+            single = plugin.compute_local(rawbbox, binary_bbox, features, self.axes)
+            assert set(single.keys()) == set(batch.keys())
+            for key in single:
+                np.testing.assert_array_almost_equal(single[key], batch[key][j])
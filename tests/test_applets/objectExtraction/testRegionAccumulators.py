@@ -0,0 +1,84 @@
+from __future__ import division
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2017, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+from builtins import range
+import unittest
+import numpy as np
+
+from ilastik.applets.objectExtraction.regionAccumulators import RegionFeatureAccumulator
+
+
+class TestRegionFeatureAccumulator(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.raw = np.random.random((30, 20, 10, 2))
+        labels = np.zeros((30, 20, 10), dtype=np.uint32)
+        labels[2:12, 3:8, 0:5] = 1
+        labels[8:25, 10:19, 4:10] = 2   # overlaps several blocks
+        labels[26:30, 0:4, 0:10] = 4    # label 3 is missing
+        self.labels = labels
+
+    def _blockwise(self, block_shape, histogram_range=None):
+        acc = RegionFeatureAccumulator(2, 3, histogram_range)
+        for x in range(0, 30, block_shape[0]):
+            for y in range(0, 20, block_shape[1]):
+                for z in range(0, 10, block_shape[2]):
+                    slicing = (slice(x, x + block_shape[0]),
+                               slice(y, y + block_shape[1]),
+                               slice(z, z + block_shape[2]))
+                    acc.merge(RegionFeatureAccumulator.from_block(
+                        self.raw[slicing], self.labels[slicing], (x, y, z), 3, histogram_range))
+        return acc
+
+    def test_against_numpy(self):
+        names = list(RegionFeatureAccumulator.supported_features)
+        feats = self._blockwise((7, 6, 4), (0., 1.)).features(names)
+        for name in names:
+            assert feats[name].shape[0] == 4, name
+
+        coords = np.indices(self.labels.shape).reshape(3, -1).T
+        values = self.raw.reshape(-1, 2)
+        for label in (1, 2, 4):
+            mask = (self.labels == label).reshape(-1)
+            i = label - 1
+            assert feats['Count'][i, 0] == mask.sum()
+            np.testing.assert_allclose(feats['Sum'][i], values[mask].sum(axis=0))
+            np.testing.assert_allclose(feats['Mean'][i], values[mask].mean(axis=0))
+            np.testing.assert_allclose(feats['Variance'][i], values[mask].var(axis=0))
+            np.testing.assert_allclose(feats['Minimum'][i], values[mask].min(axis=0))
+            np.testing.assert_allclose(feats['Maximum'][i], values[mask].max(axis=0))
+            np.testing.assert_allclose(feats['RegionCenter'][i], coords[mask].mean(axis=0))
+            np.testing.assert_array_equal(feats['Coord<Minimum>'][i], coords[mask].min(axis=0))
+            np.testing.assert_array_equal(feats['Coord<Maximum>'][i], coords[mask].max(axis=0))
+            hist = np.bincount(np.clip((values[mask, 0] * 64).astype(int), 0, 63), minlength=64)
+            np.testing.assert_array_equal(feats['Histogram'][i], hist)
+
+        # missing labels have all-zero features
+        for name in names:
+            assert np.all(feats[name][2] == 0), name
+
+    def test_block_shape_independent(self):
+        names = list(RegionFeatureAccumulator.supported_features)
+        whole = self._blockwise((30, 20, 10), (0., 1.)).features(names)
+        blocks = self._blockwise((4, 3, 2), (0., 1.)).features(names)
+        for name in names:
+            np.testing.assert_allclose(whole[name], blocks[name], err_msg=name)
+
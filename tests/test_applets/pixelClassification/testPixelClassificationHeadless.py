@@ -21,6 +21,7 @@
 from __future__ import print_function
 import os
 import sys
+import collections
 import imp
 import numpy
 import h5py
@@ -259,6 +260,59 @@ class TestPixelClassificationHeadless(object):
             opReorderAxes.cleanUp()
             opReader.cleanUp()
 
+    def testLazyProjectLoad(self):
+        shell = HeadlessShell(lazy_project_load=True)
+        shell.openProjectFile(self.PROJECT_FILE)
+        try:
+            opPixelClass = shell.workflow.pcApplet.topLevelOperator
+
+            # The labels are served by the internal label pipeline,
+            # which must trigger the deferred load.
+            assert len(opPixelClass.NonzeroLabelBlocks[0].value) > 0
+            labels1 = opPixelClass.LabelImages[0][sl[0:1,0:10,0:10,0:1,0:1]].wait()
+            labels2 = opPixelClass.LabelImages[0][sl[0:1,0:10,10:20,0:1,0:1]].wait()
+            assert (labels1 == 1).all()
+            assert (labels2 == 2).all()
+
+            # Loading the labels doesn't count as a change.
+            serializer = shell.workflow.pcApplet.dataSerializers[0]
+            labelSlots = [ss for ss in serializer.serialSlots if ss.name == 'LabelSets']
+            assert len(labelSlots) == 1
+            assert not labelSlots[0].dirty
+        finally:
+            shell.closeCurrentProject()
+
+    def testBatchLanes(self):
+        # Five datasets on two batch lanes: three rounds, the lanes are reused in the second and third.
+        dataset_paths = []
+        for i in range(5):
+            dataset_path = os.path.join(self.data_dir, 'batch_data_{}.npy'.format(i))
+            self.create_random_data(dataset_path)
+            dataset_paths.append(dataset_path)
+        role_data_dict = collections.OrderedDict([(0, dataset_paths)])
+
+        shell = HeadlessShell()
+        shell.openProjectFile(self.PROJECT_FILE)
+        try:
+            workflow = shell.workflow
+
+            # If a lane lost the classifier from the project, it would be retrained with
+            # a different random forest, and the results wouldn't match.
+            serial_results = workflow.batchProcessingApplet.run_export(
+                role_data_dict, export_to_array=True, num_batch_lanes=1)
+            concurrent_results = workflow.batchProcessingApplet.run_export(
+                role_data_dict, export_to_array=True, num_batch_lanes=2)
+
+            assert len(workflow.dataSelectionApplet.topLevelOperator) == 1
+
+            assert len(serial_results) == len(concurrent_results) == 5
+            for serial_result, concurrent_result in zip(serial_results, concurrent_results):
+                assert (serial_result == concurrent_result).all()
+        finally:
+            shell.closeCurrentProject()
+            for dataset_path in dataset_paths:
+                os.remove(dataset_path)
+
     def testHeadlessNoRawData(self):
         # Delete raw data first
         os.remove(self.RAW_DATA)
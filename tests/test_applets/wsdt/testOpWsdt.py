@@ -0,0 +1,81 @@
+import numpy as np
+import vigra
+
+from lazyflow.graph import Graph
+from ilastik.applets.wsdt.opWsdt import OpWsdt, OpCachedWsdt, matching_face_labels, merged_label_ids
+
+
+class TestBlockStitching(object):
+
+    def testMatchingFaceLabels(self):
+        labels_a = np.array( [[1, 1, 1, 2],
+                              [1, 1, 2, 2]] )
+        labels_b = np.array( [[5, 5, 5, 6],
+                              [5, 5, 7, 8]] )
+
+        # 2 is split between 6, 7 and 8, none of them covers most of it.
+        matching_a, matching_b = matching_face_labels(labels_a, labels_b)
+        assert list(matching_a) == [1]
+        assert list(matching_b) == [5]
+
+    def testMergedLabelIds(self):
+        merge_pairs = [ (np.array([1, 2]), np.array([5, 6])),
+                        (np.array([6]), np.array([3])) ]
+        new_ids = merged_label_ids(6, merge_pairs)
+        assert list(new_ids) == [0, 1, 2, 2, 3, 1, 2]
+
+        # Merged labels without any occurring label are not numbered
+        occurring = np.array( [False, True, False, False, False, True, True] )
+        new_ids = merged_label_ids(6, merge_pairs, occurring)
+        assert list(new_ids[[0, 1, 2, 3, 5, 6]]) == [0, 1, 2, 2, 1, 2]
+
+
+def membrane_grid():
+    """
+    A boundary map with a grid of one pixel wide membranes,
+    which separate cells of 11x11 pixels.
+    """
+    pmap = np.zeros( (48, 48), dtype=np.float32 )
+    pmap[::12, :] = 1.0
+    pmap[:, ::12] = 1.0
+    pmap[-1, :] = 1.0
+    pmap[:, -1] = 1.0
+    return vigra.taggedView( pmap[..., None], 'yxc' )
+
+
+class TestOpWsdtBlockwise(object):
+
+    def _superpixels(self, pmap, block_shape=None):
+        op = OpWsdt( graph=Graph() )
+        op.Input.setValue( pmap )
+        op.SigmaMinima.setValue( 1.0 )
+        op.BlockHalo.setValue( 16 )
+        if block_shape is not None:
+            op.BlockShape.setValue( block_shape )
+        return op.Superpixels[:].wait()[..., 0]
+
+    def testBlockwiseMatchesWholeVolume(self):
+        pmap = membrane_grid()
+        whole = self._superpixels( pmap )
+        # The blocks don't line up with the cells, so the cells have to be stitched.
+        blockwise = self._superpixels( pmap, (20, 20) )
+
+        assert (whole != 0).all()
+        assert (blockwise != 0).all()
+
+        # Which membrane pixels go to which cell is up to the watershed,
+        # but the cells must be the same superpixels (up to their ids).
+        cells = np.asarray( pmap[..., 0] ) == 0
+        pairs = np.unique( np.stack( [whole[cells], blockwise[cells]] ), axis=1 )
+        assert pairs.shape[1] == 16
+        assert len( np.unique(pairs[0]) ) == len( np.unique(pairs[1]) ) == 16
+
+    def testCacheBlockShape(self):
+        op = OpCachedWsdt( graph=Graph() )
+        op.Input.setValue( membrane_grid() )
+        op.BlockShape.setValue( (20, 20) )
+        assert op._opCache.BlockShape.value == (20, 20, 1)
+
+        # Back to whole-volume mode
+        op.BlockShape.setValue( None )
+        assert not op._opCache.BlockShape.ready()
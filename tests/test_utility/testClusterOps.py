@@ -0,0 +1,227 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import collections
+import unittest
+
+from lazyflow.graph import Graph
+from lazyflow.utility.io_util.blockwiseFileset import BlockwiseFileset
+
+from ilastik import clusterOps
+from ilastik.clusterOps import OpClusterize, BlockClaimQueue
+
+# A node task that behaves according to its name.
+# Its attempts are counted in <name>.attempts, and a finished block is marked by <name>.done.
+TASK_SCRIPT = """\
+name=$1
+shift
+for arg in "$@"; do
+    case "$arg" in --_progress_file_=*) progress_file="${arg#--_progress_file_=}" ;; esac
+done
+dir=$(dirname "$0")
+echo x >> "$dir/$name.attempts"
+attempt=$(wc -l < "$dir/$name.attempts")
+echo 50 > "$progress_file"
+case "$name" in
+    fail_once) [ $attempt -gt 1 ] || exit 1 ;;
+    hang_once) [ $attempt -gt 1 ] || sleep 60 ;;
+    forget_once) [ $attempt -gt 1 ] || exit 0 ;;
+    always_fail) exit 1 ;;
+esac
+touch "$dir/$name.done"
+echo 100 > "$progress_file"
+"""
+
+class StubFileset(object):
+    """
+    Stands in for the BlockwiseFileset: a block is available if its task marked it as done.
+    """
+    def __init__(self, directory, taskNamesByBlockStart):
+        self.directory = directory
+        self.taskNamesByBlockStart = taskNamesByBlockStart
+
+    def getBlockStatus(self, blockStart):
+        if os.path.exists( os.path.join( self.directory, self.taskNamesByBlockStart[tuple(blockStart)] + ".done" ) ):
+            return BlockwiseFileset.BLOCK_AVAILABLE
+        return BlockwiseFileset.BLOCK_NOT_AVAILABLE
+
+class TestLocalTaskExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.script_path = os.path.join( self.tmpdir, "task.sh" )
+        with open( self.script_path, 'w' ) as f:
+            f.write( TASK_SCRIPT )
+
+        self._poll_interval = clusterOps.LOCAL_TASK_POLL_INTERVAL_SECS
+        clusterOps.LOCAL_TASK_POLL_INTERVAL_SECS = 0.05
+
+        self.op = OpClusterize( graph=Graph() )
+        self.op.ConfigFilePath.setValue( os.path.join( self.tmpdir, "cluster_config.json" ) )
+        self.op.ProjectFilePath.setValue( os.path.join( self.tmpdir, "project.ilp" ) )
+        self.op.OutputDatasetDescription.setValue( os.path.join( self.tmpdir, "description.json" ) )
+        self.op._config = argparse.Namespace( task_executor="local",
+                                              command_format="sh " + self.script_path + " {task_name} {task_args}",
+                                              output_log_directory=self.tmpdir,
+                                              local_num_workers=2,
+                                              task_max_retries=1,
+                                              task_timeout_secs=1,
+                                              task_threadpool_size=None,
+                                              task_total_ram_mb=None )
+
+        self.progress = []
+        self.op.progressSignal.subscribe( self.progress.append )
+
+    def tearDown(self):
+        clusterOps.LOCAL_TASK_POLL_INTERVAL_SECS = self._poll_interval
+        self.op.cleanUp()
+        shutil.rmtree( self.tmpdir )
+
+    def _execute(self, taskNames):
+        taskInfos = collections.OrderedDict()
+        taskNamesByBlockStart = {}
+        for i, taskName in enumerate(taskNames):
+            roi = ( (i, 0), (i+1, 10) )
+            taskInfos[roi] = self.op._prepareTaskInfo( taskName, [] )
+            taskNamesByBlockStart[roi[0]] = taskName
+        fileset = StubFileset( self.tmpdir, taskNamesByBlockStart )
+        return self.op._executeTasksLocally( taskInfos, fileset, self.tmpdir )
+
+    def _attempts(self, taskName):
+        with open( os.path.join( self.tmpdir, taskName + ".attempts" ) ) as f:
+            return len( f.readlines() )
+
+    def testRetries(self):
+        # Failed tasks, tasks that time out and tasks that don't mark their block as available are relaunched.
+        assert self._execute( ["succeed", "fail_once", "hang_once", "forget_once"] )
+        assert self._attempts("succeed") == 1
+        assert self._attempts("fail_once") == 2
+        assert self._attempts("hang_once") == 2
+        assert self._attempts("forget_once") == 2
+
+        # The progress of the tasks is aggregated
+        assert self.progress[-1] == 100
+        assert all( 0 <= p <= 100 for p in self.progress )
+        assert any( 0 < p < 100 for p in self.progress )
+
+    def testGiveUp(self):
+        # A task that still fails after task_max_retries relaunches fails the whole run (ReturnCode False)
+        assert not self._execute( ["succeed", "always_fail"] )
+        assert self._attempts("succeed") == 1
+        assert self._attempts("always_fail") == 2
+        assert self.progress[-1] == 100
+
+class StubBlockFileset(object):
+    """
+    Stands in for the BlockwiseFileset of the BlockClaimQueue: a few blocks and their status.
+    """
+    def __init__(self, numBlocks):
+        self.blockRois = [ ( (i, 0), (i+1, 10) ) for i in range(numBlocks) ]
+        self.status = {}
+
+    def getAllBlockRois(self):
+        return self.blockRois
+
+    def getBlockStatus(self, blockStart):
+        return self.status.get( tuple(blockStart), BlockwiseFileset.BLOCK_NOT_AVAILABLE )
+
+    def setBlockStatus(self, blockStart, status):
+        self.status[ tuple(blockStart) ] = status
+
+class TestBlockClaimQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.claimDirectory = os.path.join( self.tmpdir, "claims" )
+        self.fileset = StubBlockFileset(3)
+
+    def tearDown(self):
+        shutil.rmtree( self.tmpdir )
+
+    def _queue(self, workerName, staleClaimSecs=60):
+        return BlockClaimQueue( self.claimDirectory, self.fileset, workerName, staleClaimSecs )
+
+    def _makeStale(self, roi):
+        # Age all claims of the block
+        past = time.time() - 1000
+        prefix = "_".join( map(str, roi[0]) ) + "."
+        for filename in os.listdir( self.claimDirectory ):
+            if filename.startswith( prefix ):
+                os.utime( os.path.join( self.claimDirectory, filename ), (past, past) )
+
+    def testExclusiveClaims(self):
+        queues = [ self._queue("W{}".format(i)) for i in range(4) ]
+        claimed = [ queue.claimNext() for queue in queues ]
+
+        # Each block is claimed once, the last worker gets nothing.
+        assert sorted( claimed[:3] ) == sorted( self.fileset.blockRois )
+        assert claimed[3] is None
+        for queue, roi in zip( queues, claimed[:3] ):
+            assert queue.ownsBlock( roi )
+            for other in queues:
+                if other is not queue:
+                    assert not other.ownsBlock( roi )
+
+    def testStaleTakeover(self):
+        old_owner = self._queue("W0", staleClaimSecs=10)
+        roi = old_owner.claimNext()
+        others = [ self._queue("W{}".format(i), staleClaimSecs=10) for i in range(1, 4) ]
+
+        # Live claims are not taken over
+        for queue in others[:2]:
+            assert queue.claimNext() != roi
+
+        # Once stale, the claim is taken over exactly once.
+        self._makeStale(roi)
+        new_owner = others[2]
+        assert new_owner.claimNext() == roi
+        assert others[0].claimNext() is None
+        assert new_owner.ownsBlock( roi )
+        assert not old_owner.ownsBlock( roi )
+
+        # The old owner's heartbeat and release don't affect the new claim.
+        old_owner.heartbeat()
+        old_owner.release( roi )
+        assert new_owner.ownsBlock( roi )
+        assert not old_owner.ownsBlock( roi )
+
+    def testFinishedBlocksNotReclaimed(self):
+        queue = self._queue("W0", staleClaimSecs=10)
+        roi = queue.claimNext()
+        self.fileset.setBlockStatus( roi[0], BlockwiseFileset.BLOCK_AVAILABLE )
+        queue.release( roi )
+
+        claimed = [ queue.claimNext() for _ in range(2) ]
+        assert roi not in claimed
+        for other_roi in claimed:
+            self.fileset.setBlockStatus( other_roi[0], BlockwiseFileset.BLOCK_AVAILABLE )
+            self._makeStale( other_roi )
+
+        # All done, even with stale claims left over.
+        assert self._queue("W1", staleClaimSecs=10).claimNext() is None
+
+
+if __name__ == "__main__":
+    unittest.main()
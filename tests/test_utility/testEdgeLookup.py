@@ -0,0 +1,81 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2017, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#           http://ilastik.org/license.html
+###############################################################################
+import unittest
+
+import numpy as np
+
+from ilastik.utility.edgeLookup import EdgeLookup, EdgePenChanges
+
+
+class TestEdgeLookup(unittest.TestCase):
+    def setUp(self):
+        self.edge_ids = np.array([[1, 2], [3, 7], [1, 5], [2, 3]], dtype=np.uint32)
+        self.values = np.array([0.1, 0.2, 0.3, 0.4])
+        self.lookup = EdgeLookup(self.edge_ids, self.values)
+
+    def test_batch(self):
+        query = np.array([[2, 3], [7, 3], [1, 9], [1, 2]])
+        np.testing.assert_array_equal(self.lookup.lookup(query, default=-1), [0.4, 0.2, -1, 0.1])
+        np.testing.assert_array_equal(self.lookup.contains(query), [True, True, False, True])
+
+    def test_dict_interface(self):
+        self.assertEqual(len(self.lookup), 4)
+        self.assertEqual(self.lookup[(1, 5)], 0.3)
+        self.assertEqual(self.lookup.get((5, 6), 0.0), 0.0)
+        self.assertIn((3, 7), self.lookup)
+        self.assertNotIn((3, 8), self.lookup)
+        self.assertRaises(KeyError, lambda: self.lookup[(4, 5)])
+        self.assertEqual(dict(self.lookup.items()),
+                         dict(zip(map(tuple, self.edge_ids.tolist()), self.values.tolist())))
+
+    def test_empty(self):
+        lookup = EdgeLookup(np.zeros((0, 2), dtype=np.uint32), np.zeros((0,)))
+        self.assertEqual(len(lookup), 0)
+        np.testing.assert_array_equal(lookup.lookup([[1, 2]], default=5), [5])
+        self.assertNotIn((1, 2), lookup)
+
+
+class TestEdgePenChanges(unittest.TestCase):
+    def test_changed_pens(self):
+        pen_table = ['pen{}'.format(i) for i in range(3)]
+        changes = EdgePenChanges(pen_table)
+        edge_ids = np.array([[1, 2], [3, 7], [1, 5]], dtype=np.uint32)
+
+        new_pens, overwrite = changes.changed_pens(edge_ids, [0, 1, 2])
+        self.assertTrue(overwrite)
+        self.assertEqual(new_pens, {(1, 2): 'pen0', (3, 7): 'pen1', (1, 5): 'pen2'})
+
+        new_pens, overwrite = changes.changed_pens(edge_ids, [0, 2, 2])
+        self.assertFalse(overwrite)
+        self.assertEqual(new_pens, {(3, 7): 'pen2'})
+
+        new_pens, overwrite = changes.changed_pens(edge_ids[:2], [0, 2])
+        self.assertTrue(overwrite)
+        self.assertEqual(len(new_pens), 2)
+
+        changes.reset()
+        new_pens, overwrite = changes.changed_pens(edge_ids[:2], [0, 2])
+        self.assertTrue(overwrite)
+        self.assertEqual(len(new_pens), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2017, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#           http://ilastik.org/license.html
+###############################################################################
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+from ilastik.utility import exportFile
+from ilastik.utility.exportFile import ExportFile
+
+
+class TestExportFile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.chunk_rows = exportFile.table_chunk_rows
+        exportFile.table_chunk_rows = 7
+
+        self.table = np.zeros((50,), dtype=[('x', 'f4'), ('id', 'i8'), ('name', 'U4')])
+        self.table['x'] = np.linspace(-1, 1, 50)
+        self.table['id'] = np.arange(50)
+        self.table['name'] = [u'\xe4' * (i % 4) for i in range(50)]
+
+    def tearDown(self):
+        exportFile.table_chunk_rows = self.chunk_rows
+        shutil.rmtree(self.tmpdir)
+
+    def export(self, mode, file_name):
+        export_file = ExportFile(os.path.join(self.tmpdir, file_name))
+        export_file.add_columns("table", self.table, exportFile.Mode.NumpyStructArray)
+        progress = []
+        export_file.ExportProgress.subscribe(progress.append)
+        export_file.write_all(mode)
+        return progress
+
+    def test_csv(self):
+        progress = self.export("csv", "export.csv")
+        with open(os.path.join(self.tmpdir, "export_table.csv")) as f:
+            lines = f.read().splitlines()
+
+        self.assertEqual(lines[0], "x,id,name")
+        self.assertEqual(len(lines), 51)
+        for line, row in zip(lines[1:], self.table):
+            self.assertEqual(line, ",".join(map(str, row)))
+        # one step per chunk of rows
+        self.assertEqual(len([p for p in progress if 0 < p < 100]), 7)
+
+    def test_h5(self):
+        self.export("h5", "export.h5")
+        with h5py.File(os.path.join(self.tmpdir, "export.h5"), "r") as f:
+            dset = f["table"]
+            self.assertEqual(dset.chunks, (7,))
+            np.testing.assert_array_equal(dset["x"], self.table["x"])
+            np.testing.assert_array_equal(dset["id"], self.table["id"])
+            names = [name.decode('utf-8') for name in dset["name"]]
+            self.assertEqual(names, list(self.table["name"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
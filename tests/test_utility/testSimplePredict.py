@@ -0,0 +1,63 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import unittest
+import numpy as np
+import vigra
+
+from ilastik.utility.simple_predict import FilterSpec, compute_features, presmoothing_sigmas, feature_halo
+
+class TestSimplePredict(unittest.TestCase):
+
+    def setUp(self):
+        self.filter_specs = [ FilterSpec('GaussianSmoothing', 0.7),
+                              FilterSpec('GaussianGradientMagnitude', 3.5),
+                              FilterSpec('DifferenceOfGaussians', 3.5),
+                              FilterSpec('HessianOfGaussianEigenvalues', 3.5) ]
+
+        data = np.random.RandomState(0).random_sample( (60, 70) ).astype(np.float32)
+        self.data = vigra.taggedView( vigra.filters.gaussianSmoothing(data, 1.0), 'yx' )
+
+    def test_presmoothing_sigmas(self):
+        presmoothing = presmoothing_sigmas( self.filter_specs )
+        assert presmoothing[0.7] == 0.0
+
+        # The smallest gaussian at scale 3.5 belongs to the DoG
+        assert np.isclose( presmoothing[3.5]**2 + 1.0, (0.66*3.5)**2 )
+
+    def test_block_matches_whole_volume(self):
+        for presmooth in (False, True):
+            halo = feature_halo( self.filter_specs, presmooth )
+            whole = compute_features( self.data, self.filter_specs, presmooth=presmooth )
+
+            block_roi = np.array( [(20, 30), (40, 50)] )
+            halo_roi = np.array( [ np.maximum(block_roi[0] - halo, 0),
+                                   np.minimum(block_roi[1] + halo, self.data.shape) ] )
+            block_input = self.data[halo_roi[0][0]:halo_roi[1][0], halo_roi[0][1]:halo_roi[1][1]]
+            block = compute_features( block_input, self.filter_specs, roi=block_roi - halo_roi[0], presmooth=presmooth )
+
+            assert np.allclose( block, whole[20:40, 30:50], atol=1e-3 )
+
+    def test_presmoothing_is_close(self):
+        direct = compute_features( self.data, self.filter_specs )
+        presmoothed = compute_features( self.data, self.filter_specs, presmooth=True )
+
+        # Compare away from the borders
+        assert np.allclose( presmoothed[15:-15, 15:-15], direct[15:-15, 15:-15], atol=0.01 )